@@ -1,15 +1,19 @@
 """
 Административные функции для телеграм бота
 """
-import copy
+import asyncio
 import logging
 import os
+import time
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
 import keyboards
 import database
-from utils import ensure_photos_dir, is_admin, safe_edit_message_text
+import images
+import photo_cache
+import outbox
+from utils import ensure_photos_dir, is_admin, reserve_photo_path, safe_edit_message_text
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +44,7 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # admin_add_car обрабатывается через ConversationHandler
 
     elif query.data == "admin_list_cars":
-        data = database.load_data()
+        data = database.get_catalog()
         cars = data.get("cars", [])
         if not cars:
             await safe_edit_message_text(query, "📋 Список пуст.", reply_markup=keyboards.get_admin_menu())
@@ -48,8 +52,8 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         text = "📋 *Список автомобилей:*\n\n"
         for car in cars[:10]:  # Показываем первые 10
-            status = "✅" if car.get("is_available", True) else "❌"
-            text += f"{status} *{car.get('id')}.* {car.get('brand')} {car.get('model')} - {car.get('price', 0):,} $\n"
+            status = "✅" if car.is_available else "❌"
+            text += f"{status} *{car.id}.* {car.title} - {car.price:,} $\n"
 
         if len(cars) > 10:
             text += f"\n... и еще {len(cars) - 10} автомобилей"
@@ -57,7 +61,7 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await safe_edit_message_text(query, text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboards.get_admin_menu())
 
     elif query.data == "admin_delete_car":
-        data = database.load_data()
+        data = database.get_catalog()
         cars = data.get("cars", [])
         if not cars:
             await safe_edit_message_text(query, "📋 Список пуст.", reply_markup=keyboards.get_admin_menu())
@@ -66,8 +70,8 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         kb = []
         for car in cars:
             kb.append([InlineKeyboardButton(
-                f"🗑 {car.get('brand')} {car.get('model')} (ID: {car.get('id')})",
-                callback_data=f"admin_delete_{car.get('id')}"
+                f"🗑 {car.title} (ID: {car.id})",
+                callback_data=f"admin_delete_{car.id}"
             )])
         kb.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")])
 
@@ -79,7 +83,7 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
     elif query.data == "admin_manage_photos":
-        data = database.load_data()
+        data = database.get_catalog()
         cars = data.get("cars", [])
         if not cars:
             await safe_edit_message_text(query, "📋 Список пуст.", reply_markup=keyboards.get_admin_menu())
@@ -87,10 +91,9 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         kb = []
         for car in cars:
-            photo_count = len(car.get('photos', []))
             kb.append([InlineKeyboardButton(
-                f"📸 {car.get('brand')} {car.get('model')} ({photo_count} фото)",
-                callback_data=f"admin_photos_{car.get('id')}"
+                f"📸 {car.title} ({len(car.photos)} фото)",
+                callback_data=f"admin_photos_{car.id}"
             )])
         kb.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")])
 
@@ -101,6 +104,9 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=InlineKeyboardMarkup(kb)
         )
 
+    elif query.data == "admin_outbox":
+        await _show_outbox(query)
+
     elif query.data == "admin_exit":
         await safe_edit_message_text(query, "✅ Выход из админ-панели.", reply_markup=keyboards.get_main_menu())
 
@@ -112,6 +118,53 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=keyboards.get_admin_menu()
         )
 
+async def _show_outbox(query, note=""):
+    """Список недоставленных заявок"""
+    count = await asyncio.to_thread(outbox.dead_count)
+    if not count:
+        await safe_edit_message_text(query, f"{note}📭 Недоставленных заявок нет.", reply_markup=keyboards.get_admin_menu())
+        return
+
+    text = f"{note}📮 *Недоставленные заявки: {count}*\n\n"
+    for lead in await asyncio.to_thread(outbox.dead_letters, 10):
+        created = time.strftime("%d.%m %H:%M", time.localtime(lead["created"]))
+        chats = ", ".join(str(chat_id) for chat_id in lead["chat_ids"])
+        text += f"*{lead['id']}.* {created}, не получили: {chats}\n"
+    if count > 10:
+        text += f"\n... и еще {count - 10}"
+    await safe_edit_message_text(query, text, parse_mode=ParseMode.MARKDOWN, reply_markup=keyboards.get_outbox_keyboard())
+
+async def admin_outbox_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Повтор отправки или получение недоставленных заявок"""
+    query = update.callback_query
+    await query.answer()
+    user = update.effective_user
+
+    if not is_admin(user.id, user.username):
+        await safe_edit_message_text(query, "❌ У вас нет доступа к админ-панели.")
+        return
+
+    if query.data == "admin_outbox_retry":
+        count = await asyncio.to_thread(outbox.retry_dead)
+        await _show_outbox(query, f"🔁 Поставлено на повторную отправку: {count}\n\n")
+
+    elif query.data == "admin_outbox_drain":
+        # Заявка удаляется из очереди только после того, как админ ее получил. Текст
+        # отправляется без разметки: заявка могла не дойти как раз из-за ошибки Markdown.
+        # Неудавшаяся заявка остается в очереди и не мешает остальным
+        received = failed = 0
+        for lead in await asyncio.to_thread(outbox.dead_letters, 20):
+            try:
+                await query.message.reply_text(lead["text"])
+            except Exception as e:
+                logger.error(f"Не удалось показать недоставленную заявку {lead['id']}: {e}")
+                failed += 1
+                continue
+            await asyncio.to_thread(outbox.discard, lead["id"])
+            received += 1
+        note = f"📥 Получено заявок: {received}" + (f", не удалось показать: {failed}" if failed else "")
+        await _show_outbox(query, f"{note}\n\n")
+
 async def admin_delete_car_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удаление автомобиля"""
     query = update.callback_query
@@ -121,14 +174,13 @@ async def admin_delete_car_handler(update: Update, context: ContextTypes.DEFAULT
         return
 
     car_id = int(query.data.replace("admin_delete_", ""))
-    data = database.load_data()
-    cars = data.get("cars", [])
 
-    # Удаляем фотографии
-    car_to_delete = next((c for c in cars if c.get("id") == car_id), None)
-    if car_to_delete:
+    # Сначала удаляем запись, затем фотографии именно удаленной версии автомобиля.
+    # Запись ждет блокировку и fsync, поэтому выполняется вне цикла событий
+    receipt = await asyncio.to_thread(database.delete_car, car_id)
+    if receipt:
         from config import PHOTOS_DIR
-        for photo in car_to_delete.get("photos", []):
+        for photo in receipt.car.photos:
             if not photo.startswith("http"):
                 photo_path = os.path.join(PHOTOS_DIR, photo)
                 try:
@@ -136,9 +188,7 @@ async def admin_delete_car_handler(update: Update, context: ContextTypes.DEFAULT
                         os.remove(photo_path)
                 except:
                     pass
-
-    data["cars"] = [c for c in cars if c.get("id") != car_id]
-    database.save_data(data)
+                photo_cache.forget_photo(photo)
 
     await query.edit_message_text(
         f"✅ Автомобиль с ID {car_id} удален.",
@@ -154,15 +204,14 @@ async def admin_photos_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     car_id = int(query.data.replace("admin_photos_", ""))
-    data = database.load_data()
-    car = next((c for c in data.get("cars", []) if c.get("id") == car_id), None)
+    car = database.find_car(car_id)
 
     if not car:
         await query.edit_message_text("❌ Автомобиль не найден.", reply_markup=keyboards.get_admin_menu())
         return
 
     context.user_data['admin_photo_car_id'] = car_id
-    photo_count = len(car.get("photos", []))
+    photo_count = len(car.photos)
 
     kb = [
         [InlineKeyboardButton("➕ Добавить фото", callback_data="admin_add_photo")],
@@ -172,7 +221,7 @@ async def admin_photos_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     await query.edit_message_text(
         f"📸 *Фотографии автомобиля*\n\n"
-        f"*{car.get('brand')} {car.get('model')}*\n"
+        f"*{car.title}*\n"
         f"Текущее количество фото: {photo_count}/5\n\n"
         f"Выберите действие:",
         parse_mode=ParseMode.MARKDOWN,
@@ -189,13 +238,12 @@ async def admin_delete_photo_handler(update: Update, context: ContextTypes.DEFAU
         await query.edit_message_text("❌ Ошибка. Начните заново.", reply_markup=keyboards.get_admin_menu())
         return
 
-    data = database.load_data()
-    car = next((c for c in data.get("cars", []) if c.get("id") == car_id), None)
+    car = database.find_car(car_id)
     if not car:
         await query.edit_message_text("❌ Автомобиль не найден.", reply_markup=keyboards.get_admin_menu())
         return
 
-    photos = car.get("photos", [])
+    photos = car.photos
     if not photos:
         await query.edit_message_text("❌ У автомобиля нет фотографий.", reply_markup=keyboards.get_admin_menu())
         return
@@ -210,7 +258,7 @@ async def admin_delete_photo_handler(update: Update, context: ContextTypes.DEFAU
 
     await query.edit_message_text(
         f"🗑 *Удаление фотографии*\n\n"
-        f"*{car.get('brand')} {car.get('model')}*\n\n"
+        f"*{car.title}*\n\n"
         f"Выберите фотографию для удаления:",
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=InlineKeyboardMarkup(kb)
@@ -227,19 +275,31 @@ async def admin_delete_photo_confirm(update: Update, context: ContextTypes.DEFAU
     photo_idx = int(query.data.replace("admin_del_photo_", ""))
     car_id = context.user_data.get('admin_photo_car_id')
 
-    data = database.load_data()
-    car = next((c for c in data.get("cars", []) if c.get("id") == car_id), None)
+    car = database.find_car(car_id)
     if not car:
         await query.edit_message_text("❌ Автомобиль не найден.", reply_markup=keyboards.get_admin_menu())
         return
 
-    photos = car.get("photos", [])
+    photos = car.photos
     if photo_idx >= len(photos):
         await query.edit_message_text("❌ Фотография не найдена.", reply_markup=keyboards.get_admin_menu())
         return
 
-    # Удаляем файл
     photo_filename = photos[photo_idx]
+
+    def remove_photo(car):
+        # Удаляем по имени: пока админ подтверждал, список мог измениться
+        if photo_filename not in car.photos:
+            raise database.ConflictError(f"Фото {photo_filename} уже удалено")
+        car.photos = [p for p in car.photos if p != photo_filename]
+
+    try:
+        await asyncio.to_thread(database.mutate_car, car_id, remove_photo)
+    except database.ConflictError:
+        await query.edit_message_text("❌ Фотография уже удалена.", reply_markup=keyboards.get_admin_menu())
+        return
+
+    # Удаляем файл
     if not photo_filename.startswith("http"):
         from config import PHOTOS_DIR
         photo_path = os.path.join(PHOTOS_DIR, photo_filename)
@@ -248,19 +308,7 @@ async def admin_delete_photo_confirm(update: Update, context: ContextTypes.DEFAU
                 os.remove(photo_path)
         except:
             pass
-
-    # Удаляем из списка
-    car["photos"].pop(photo_idx)
-
-    # Обновляем данные
-    cars = data.get("cars", [])
-    for i, c in enumerate(cars):
-        if c.get("id") == car_id:
-            cars[i] = car
-            break
-
-    data["cars"] = cars
-    database.save_data(data)
+        photo_cache.forget_photo(photo_filename)
 
     await query.edit_message_text(
         f"✅ Фотография удалена!",
@@ -278,16 +326,13 @@ async def admin_add_photo_handler(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_text("❌ Ошибка. Начните заново.", reply_markup=keyboards.get_admin_menu())
         return ConversationHandler.END
 
-    data = database.load_data()
-    car = next((c for c in data.get("cars", []) if c.get("id") == car_id), None)
+    car = database.find_car(car_id)
     if not car:
         await query.edit_message_text("❌ Автомобиль не найден.", reply_markup=keyboards.get_admin_menu())
         return ConversationHandler.END
 
     # Считаем только локальные файлы (не URL)
-    photos = car.get("photos", [])
-    local_photos = [p for p in photos if not (isinstance(p, str) and p.startswith("http"))]
-    photo_count = len(local_photos)
+    photo_count = len(car.local_photos)
 
     if photo_count >= 5:
         await query.edit_message_text(
@@ -305,6 +350,13 @@ async def admin_add_photo_handler(update: Update, context: ContextTypes.DEFAULT_
     )
     return ADMIN_PHOTO
 
+def _remove_file(filepath):
+    """Удаление файла без ошибки, если его уже нет"""
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
 async def admin_photo_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Получение фотографии от админа"""
     if not update.message.photo:
@@ -317,82 +369,69 @@ async def admin_photo_received(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
     ensure_photos_dir()
-    data = database.load_data()
-    cars = data.get("cars", [])
-    car = None
-    car_index = -1
-    for i, c in enumerate(cars):
-        if c.get("id") == car_id:
-            car = c
-            car_index = i
-            break
+    car = database.find_car(car_id)
 
     if not car:
         await update.message.reply_text("❌ Автомобиль не найден.", reply_markup=keyboards.get_admin_menu())
         return ConversationHandler.END
 
-    # Получаем текущий список фотографий (может быть пустым)
-    if "photos" not in car:
-        car["photos"] = []
-
-    # Фильтруем только локальные файлы (не URL)
-    local_photos = [p for p in car["photos"] if not p.startswith("http")]
+    # Считаем только локальные файлы (не URL)
+    local_photos = car.local_photos
     photo_count = len(local_photos)
 
     if photo_count >= 5:
         await update.message.reply_text("❌ Максимальное количество фотографий (5) уже достигнуто.")
         return ConversationHandler.END
 
+    filepath = None
     try:
         # Скачиваем фото
         photo = update.message.photo[-1]  # Берем фото наибольшего размера
         file = await context.bot.get_file(photo.file_id)
 
-        ext = ".jpg"
-        filename = f"car_{car_id}_{photo_count + 1}{ext}"
-        from config import PHOTOS_DIR
-        filepath = os.path.join(PHOTOS_DIR, filename)
+        filepath = reserve_photo_path(car_id, photo_count + 1, local_photos, images.output_extension(".jpg"))
+        filename = os.path.basename(filepath)
 
         logger.info(f"Скачивание фото для автомобиля {car_id} в {filepath}")
+        photo_cache.forget_photo(filename)  # Файл с таким именем мог быть загружен ранее
         await file.download_to_drive(filepath)
 
         # Проверяем, что файл действительно скачался
-        if not os.path.exists(filepath):
+        if not os.path.exists(filepath) or not os.path.getsize(filepath):
             logger.error(f"Файл не был скачан: {filepath}")
             await update.message.reply_text("❌ Ошибка при сохранении фотографии. Попробуйте еще раз.")
+            _remove_file(filepath)
             return ADMIN_PHOTO
 
-        # Добавляем в данные (создаем новый список, чтобы не изменять оригинал)
-        if "photos" not in car:
-            car["photos"] = []
-
-        # Добавляем новое фото
-        car["photos"].append(filename)
-        logger.info(f"Фото добавлено в список: {filename}, всего фото: {len(car['photos'])}")
-
-        # Обновляем данные в списке (используем глубокую копию)
-        cars[car_index] = copy.deepcopy(car)
-        data["cars"] = cars
-        database.save_data(data)
-
-        # Перезагружаем данные для проверки
-        data_check = database.load_data()
-        saved_car = next((c for c in data_check.get("cars", []) if c.get("id") == car_id), None)
-        if saved_car:
-            saved_photos = saved_car.get("photos", [])
-            if filename in saved_photos:
-                logger.info(f"✅ Фото успешно сохранено в JSON: {filename}")
-                logger.info(f"Всего фото в сохраненных данных: {len(saved_photos)}")
-            else:
-                logger.error(f"❌ Фото не найдено в сохраненных данных! Ожидалось: {filename}, найдено: {saved_photos}")
-        else:
-            logger.error(f"❌ Автомобиль не найден после сохранения!")
+        # Уменьшаем и пережимаем фото в отдельном процессе
+        filepath = await images.optimize_image_async(filepath)
+        filename = os.path.basename(filepath)
 
-        # Пересчитываем количество локальных фото из сохраненных данных
-        if saved_car:
-            new_count = len([p for p in saved_car.get("photos", []) if not (isinstance(p, str) and p.startswith("http"))])
-        else:
-            new_count = photo_count + 1
+        def append_photo(saved):
+            # Лимит проверяется по актуальной записи: пока фото скачивалось,
+            # другой админ мог добавить свои
+            if len(saved.local_photos) >= 5:
+                raise database.ConflictError("Достигнут лимит фотографий")
+            saved.photos.append(filename)
+
+        try:
+            receipt = await asyncio.to_thread(database.mutate_car, car_id, append_photo)
+        except database.ConflictError:
+            _remove_file(filepath)
+            await update.message.reply_text(
+                "❌ Максимальное количество фотографий (5) уже достигнуто.",
+                reply_markup=keyboards.get_admin_menu()
+            )
+            return ConversationHandler.END
+        if receipt is None:
+            _remove_file(filepath)
+            await update.message.reply_text("❌ Автомобиль не найден.", reply_markup=keyboards.get_admin_menu())
+            return ConversationHandler.END
+        # Запись подтверждена хранилищем (fsync), перечитывать каталог для проверки не нужно
+        saved_photos = receipt.car.photos
+        logger.info(f"Фото сохранено: {filename}, всего фото: {len(saved_photos)} "
+                    f"(версия каталога {receipt.version}, crc32 {receipt.checksum})")
+        new_count = len(receipt.car.local_photos)
 
         if new_count < 5:
             await update.message.reply_text(
@@ -410,6 +449,8 @@ async def admin_photo_received(update: Update, context: ContextTypes.DEFAULT_TYP
             return ConversationHandler.END
     except Exception as e:
         logger.error(f"Ошибка при добавлении фото: {e}", exc_info=True)
+        if filepath and os.path.exists(filepath) and not os.path.getsize(filepath):
+            _remove_file(filepath)  # Зарезервированное, но не скачанное имя
         await update.message.reply_text(f"❌ Ошибка при добавлении фотографии: {str(e)}")
         return ADMIN_PHOTO
 
@@ -539,8 +580,7 @@ async def admin_add_car_features(update: Update, context: ContextTypes.DEFAULT_T
 
     # Завершаем добавление
     new_car = context.user_data['new_car']
-    from utils import get_next_car_id
-    new_car['id'] = get_next_car_id()
+    new_car.pop('id', None)  # id назначается при записи, чтобы параллельные добавления не совпали
     new_car['is_available'] = True
 
     # Проверяем, что все обязательные поля заполнены
@@ -558,39 +598,35 @@ async def admin_add_car_features(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data.pop('admin_mode', None)
         return ConversationHandler.END
 
-    data = database.load_data()
-    data["cars"].append(new_car)
-    database.save_data(data)
-
-    # Проверяем сохранение
-    data_check = database.load_data()
-    saved_car = next((c for c in data_check.get("cars", []) if c.get("id") == new_car['id']), None)
-
-    if not saved_car:
-        logger.error(f"❌ Автомобиль не был сохранен в базу данных!")
+    try:
+        receipt = await asyncio.to_thread(database.add_car, new_car)
+    except Exception as e:
+        logger.error(f"❌ Автомобиль не был сохранен в базу данных: {e}")
         await update.message.reply_text(
             "❌ Ошибка при сохранении автомобиля. Попробуйте еще раз.",
             reply_markup=keyboards.get_admin_menu()
         )
         return ConversationHandler.END
+    car = receipt.car
+    logger.info(f"Автомобиль {car.id} записан (версия каталога {receipt.version}, crc32 {receipt.checksum})")
 
     # Формируем информацию о добавленном автомобиле
     car_info = f"""✅ *Автомобиль успешно добавлен!*
 
 📋 *Информация:*
-• ID: {new_car['id']}
-• Марка: {new_car['brand']}
-• Модель: {new_car['model']}
-• Год: {new_car['year']}
-• Цена: {new_car['price']:,} $
-• Кузов: {new_car['body_type']}
-• Двигатель: {new_car['engine_type']}, {new_car['engine_volume']} л
-• КПП: {new_car['transmission']}
-• Цвет: {new_car['color']}
-• Пробег: {new_car['mileage']:,} км
-• Описание: {new_car['description'][:50]}...
-• Особенности: {', '.join(new_car.get('features', [])) if new_car.get('features') else 'нет'}
-• Фотографии: {len(new_car.get('photos', []))} шт.
+• ID: {car.id}
+• Марка: {car.brand}
+• Модель: {car.model}
+• Год: {car.year}
+• Цена: {car.price:,} $
+• Кузов: {car.body_type}
+• Двигатель: {car.engine_type}, {car.engine_volume} л
+• КПП: {car.transmission}
+• Цвет: {car.color}
+• Пробег: {car.mileage:,} км
+• Описание: {car.description[:50]}...
+• Особенности: {', '.join(car.features) if car.features else 'нет'}
+• Фотографии: {len(car.photos)} шт.
 
 Теперь вы можете добавить фотографии через меню '📸 Управление фото'"""
 
@@ -600,7 +636,7 @@ async def admin_add_car_features(update: Update, context: ContextTypes.DEFAULT_T
         reply_markup=keyboards.get_main_menu()
     )
 
-    logger.info(f"✅ Автомобиль добавлен: {new_car['brand']} {new_car['model']} (ID: {new_car['id']})")
+    logger.info(f"✅ Автомобиль добавлен: {car.title} (ID: {car.id})")
 
     context.user_data.pop('new_car', None)
     context.user_data.pop('admin_mode', None)
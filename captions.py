@@ -0,0 +1,80 @@
+"""
+Готовые тексты карточек автомобилей
+"""
+from collections import OrderedDict
+from config import CAPTION_CACHE_SIZE
+
+# Текст строится один раз на версию автомобиля. При любом изменении каталог
+# создает новый объект Car, поэтому запись кэша действительна, пока в ней
+# лежит тот же самый объект, и отдельная инвалидация не нужна
+_caption_cache = OrderedDict()
+_caption_cache_stats = {"hits": 0, "misses": 0}
+
+def _render_caption(car):
+    """Подпись к фото автомобиля (Markdown)"""
+    return f"""*{car.title}*
+
+Год: {car.year}
+Цена: *{car.price:,} $*
+Цвет: {car.color or 'не указан'}
+Пробег: {car.mileage:,} км
+Двигатель: {car.engine_type}, {car.engine_volume} л
+КПП: {car.transmission}
+Кузов: {car.body_type}
+
+*{car.description or 'Описание отсутствует'}*
+
+Особенности:
+{chr(10).join(['• ' + f for f in car.features])}"""
+
+def _render_summary(car):
+    """Краткое описание автомобиля для заявки админу"""
+    return f"""• Марка/Модель: {car.title}
+• Год: {car.year}
+• Цена: {car.price:,} $
+• Кузов: {car.body_type}
+• Двигатель: {car.engine_type}, {car.engine_volume} л
+• КПП: {car.transmission}
+• Цвет: {car.color or 'не указан'}
+• Пробег: {car.mileage:,} км"""
+
+def _render_row(car):
+    """Строка автомобиля в списке результатов"""
+    return f"{car.title} · {car.year} · {car.price:,} $ · {car.mileage:,} км"
+
+def _cached(kind, car, render):
+    """Текст из кэша для этой версии автомобиля или новый, с LRU-вытеснением"""
+    key = (kind, car.id)
+    entry = _caption_cache.get(key)
+    if entry is not None and entry[0] is car:
+        _caption_cache.move_to_end(key)
+        _caption_cache_stats["hits"] += 1
+        return entry[1]
+
+    _caption_cache_stats["misses"] += 1
+    text = render(car)
+    _caption_cache[key] = (car, text)
+    _caption_cache.move_to_end(key)
+    if len(_caption_cache) > CAPTION_CACHE_SIZE:
+        _caption_cache.popitem(last=False)
+    return text
+
+def car_caption(car):
+    """Подпись к фото в карточке автомобиля"""
+    return _cached("caption", car, _render_caption)
+
+def car_summary(car):
+    """Описание автомобиля в заявке для админа"""
+    return _cached("summary", car, _render_summary)
+
+def car_row(car):
+    """Строка автомобиля на странице списка"""
+    return _cached("row", car, _render_row)
+
+def get_caption_cache_stats():
+    """Статистика кэша текстов: попадания, промахи, размер"""
+    return {**_caption_cache_stats, "size": len(_caption_cache)}
+
+def clear_caption_cache():
+    """Очистка кэша текстов"""
+    _caption_cache.clear()
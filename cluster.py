@@ -0,0 +1,168 @@
+"""
+Запуск бота несколькими процессами: webhook-фронт и пул воркеров
+
+Фронт принимает обновления от Telegram (WEBHOOK_URL, проверка секретного токена)
+и передает каждое воркеру по chat_id, поэтому обновления одного чата всегда
+обрабатывает один и тот же процесс в порядке поступления. Воркер - обычное
+приложение бота из main_new.build_application без собственного получения обновлений.
+
+Общее между процессами:
+- каталог - через хранилище database (JSON с журналом под файловой блокировкой или SQLite);
+- user_data, chat_data, bot_data и состояния диалогов - через persistence.SQLitePersistence;
+- кэш file_id фотографий - через photo_cache (файл перечитывается при изменении).
+
+Запуск: python cluster.py (нужен WEBHOOK_URL; UPDATE_MODE здесь не используется)
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+from config import (
+    BOT_TOKEN, CLUSTER_WORKERS, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT,
+    WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS
+)
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(processName)s] %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Как часто фронт проверяет, что воркеры живы, с
+SUPERVISE_INTERVAL = 5
+
+def chat_key(update):
+    """Ключ распределения обновления (JSON от Telegram): id чата, иначе id пользователя, иначе update_id"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        if value.get("from"):
+            return value["from"]["id"]
+    return update.get("update_id", 0)
+
+def worker_index(update, workers):
+    """Номер воркера для обновления"""
+    return chat_key(update) % workers
+
+async def _serve_worker(index, queue):
+    """Приложение бота, которое обрабатывает обновления из очереди фронта"""
+    from telegram import Update
+    from main_new import build_application
+    from persistence import SQLitePersistence
+    from utils import ensure_photos_dir
+
+    ensure_photos_dir()
+    app = build_application(persistence=SQLitePersistence(), updater=False, warm_up=index == 0)
+    loop = asyncio.get_running_loop()
+    # По SIGTERM воркер дорабатывает полученные обновления и останавливается
+    loop.add_signal_handler(signal.SIGTERM, queue.put_nowait, None)
+
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        logger.info(f"Воркер {index} запущен")
+        while True:
+            body = await loop.run_in_executor(None, queue.get)
+            if body is None:
+                break
+            try:
+                update = Update.de_json(json.loads(body), app.bot)
+            except Exception as e:
+                logger.error(f"Воркер {index}: некорректное обновление: {e}")
+                continue
+            await app.update_queue.put(update)
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    logger.info(f"Воркер {index} остановлен")
+
+def _run_worker(index, queue):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C получает вся группа процессов; воркер останавливает фронт, а не сигнал
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_serve_worker(index, queue))
+
+def _start_worker(context, index, queue):
+    process = context.Process(target=_run_worker, args=(index, queue), name=f"worker-{index}", daemon=False)
+    process.start()
+    return process
+
+async def _serve_front(context, queues, workers):
+    """HTTP-сервер webhook: проверка токена и передача тела обновления воркеру"""
+    import tornado.httpserver
+    import tornado.web
+    from telegram import Bot, Update
+
+    class WebhookHandler(tornado.web.RequestHandler):
+        def post(self):
+            if self.request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET_TOKEN:
+                logger.warning("Запрос к webhook без верного секретного токена отклонен")
+                self.set_status(403)
+                return
+            try:
+                update = json.loads(self.request.body)
+            except ValueError:
+                self.set_status(400)
+                return
+            queues[worker_index(update, len(queues))].put(self.request.body)
+
+    server = tornado.httpserver.HTTPServer(tornado.web.Application([(rf"/{WEBHOOK_PATH}/?", WebhookHandler)]))
+    server.listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+    async with Bot(BOT_TOKEN) as bot:
+        await bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    logger.info(f"Фронт слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}, воркеров: {len(workers)}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=SUPERVISE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        for index, process in enumerate(workers):
+            if not stop.is_set() and not process.is_alive():
+                # Очередь воркера сохраняется, поэтому перезапущенный процесс продолжит с того же места
+                logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапуск")
+                workers[index] = _start_worker(context, index, queues[index])
+
+    # Новые запросы не принимаются; уже переданные воркерам обновления будут обработаны
+    server.stop()
+    await server.close_all_connections()
+
+def main():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не установлен!")
+        return
+    if not WEBHOOK_URL:
+        logger.error("Для кластера нужен WEBHOOK_URL!")
+        return
+
+    # spawn: воркеры не наследуют потоки и соединения фронта
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(CLUSTER_WORKERS)]
+    workers = [_start_worker(context, index, queue) for index, queue in enumerate(queues)]
+    try:
+        asyncio.run(_serve_front(context, queues, workers))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                logger.warning(f"{process.name} не остановился за 30 с, завершение")
+                process.terminate()
+        logger.info("Кластер остановлен")
+
+if __name__ == "__main__":
+    main()
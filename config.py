@@ -1,3 +1,4 @@
+import hashlib
 import os
 from dotenv import load_dotenv
 
@@ -10,7 +11,86 @@ ADMIN_IDS = os.getenv("ADMIN_IDS", "911971063,1289170350").split(",")
 
 # Пути к файлам
 CARS_FILE = "data/datacars.json"
+JOURNAL_FILE = "data/datacars.journal"  # Журнал мелких изменений каталога
+JOURNAL_COMPACT_EVERY = 100  # Через сколько записей журнал сворачивается в снимок
 PHOTOS_DIR = "data/photos"
+FILE_IDS_FILE = "data/file_ids.json"  # Кэш file_id загруженных в Telegram фото
+IMPORT_MANIFEST_FILE = "data/import_manifest.jsonl"  # Прогресс download_images.py
+
+# Хранилище каталога: "json" (снимок + журнал выше) или "sqlite" (SQLITE_FILE).
+# При первом запуске с sqlite каталог один раз переносится из CARS_FILE
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data/catalog.db")
+SQLITE_CHANGES_KEEP = 1000  # Сколько последних изменений хранится для догоняющих процессов
+
+# Получение обновлений: "polling" (опрос getUpdates) или "webhook" (Telegram сам
+# присылает обновления на WEBHOOK_URL; нужен python-telegram-bot[webhooks]).
+# Локальный сервер слушает WEBHOOK_LISTEN:WEBHOOK_PORT, перед ним ставится
+# https-прокси или балансировщик. Запросы без секретного токена отклоняются
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный https-адрес бота, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Одинаковый для всех экземпляров за балансировщиком; по умолчанию выводится из токена бота
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Параллельных соединений от Telegram
+
+# Хранилище состояния бота (user_data, состояния диалогов), чтобы перезапуск не обрывал
+# заявку на середине: "sqlite" (PERSISTENCE_FILE), "log" (журнал PERSISTENCE_LOG_FILE,
+# только для одного процесса) или "none" (только в памяти)
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND", "sqlite")
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "data/state.db")
+PERSISTENCE_LOG_FILE = os.getenv("PERSISTENCE_LOG_FILE", "data/state.log")
+PERSISTENCE_LOG_COMPACT_EVERY = 1000  # Через сколько пачек журнал сворачивается в снимок
+PERSISTENCE_UPDATE_INTERVAL = 1  # Как часто изменения записываются в хранилище (одной пачкой), с
+
+# Очередь исходящих заявок: заявка сначала записывается в OUTBOX_FILE, затем
+# отправляется всем админам; неудачные отправки повторяются с растущей паузой,
+# после OUTBOX_MAX_ATTEMPTS попыток заявка попадает в список недоставленных (админ-панель)
+OUTBOX_FILE = os.getenv("OUTBOX_FILE", "data/outbox.db")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = 2  # Пауза перед второй попыткой, с; дальше удваивается
+OUTBOX_BACKOFF_MAX = 600  # Наибольшая пауза между попытками, с
+OUTBOX_CONCURRENCY = 10  # Сколько сообщений отправляется одновременно
+
+# Кластер (python cluster.py): webhook-фронт раздает обновления CLUSTER_WORKERS процессам
+# по chat_id, поэтому все обновления одного чата обрабатывает один процесс. Состояние
+# бота процессы хранят в общем PERSISTENCE_FILE (всегда SQLite)
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", str(os.cpu_count() or 2)))
+
+# Сколько обновлений обрабатывается одновременно: разные чаты параллельно,
+# обновления одного чата всегда по порядку (1 - последовательная обработка)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+
+# Предзагрузка фото при старте: служебный чат, куда бот отправляет фото,
+# чтобы получить file_id до первого запроса клиента (пусто - выключено)
+PHOTO_WARMUP_CHAT_ID = os.getenv("PHOTO_WARMUP_CHAT_ID", "")
+PHOTO_WARMUP_CONCURRENCY = int(os.getenv("PHOTO_WARMUP_CONCURRENCY", "3"))
+
+# Асинхронное скачивание фото по URL: число воркеров (и соединений в пуле),
+# таймаут запроса и сколько обработчик ждет загрузку, прежде чем показать placeholder
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_TIMEOUT = 10
+DOWNLOAD_WAIT_TIMEOUT = 3
+
+# Обработка фото перед сохранением: длинная сторона, качество и формат (JPEG или WEBP);
+# исходники сохраняются в ORIGINALS_DIR только если KEEP_ORIGINAL_PHOTOS
+PHOTO_MAX_EDGE = 1280
+PHOTO_QUALITY = 82
+PHOTO_FORMAT = "JPEG"
+KEEP_ORIGINAL_PHOTOS = os.getenv("KEEP_ORIGINAL_PHOTOS", "0") == "1"
+ORIGINALS_DIR = "data/photos/originals"
+IMAGE_WORKERS = 2
+
+# Листание фото и автомобилей редактирует текущее сообщение вместо отправки нового
+NAVIGATION_EDIT_IN_PLACE = True
+
+# Максимальное количество клавиатур в LRU-кэше keyboards.py
+KEYBOARD_CACHE_SIZE = 512
+
+# Максимальное количество готовых подписей автомобилей в кэше captions.py
+CAPTION_CACHE_SIZE = 2048
 
 BRANDS = ["Toyota", "BMW", "Mercedes", "Audi", "Volkswagen", "Hyundai", "Kia", "Nissan"]
 BODY_TYPES = ["Седан", "Внедорожник", "Хэтчбек", "Универсал", "Купе", "Минивэн", "Пикап"]
@@ -23,3 +103,32 @@ PRICE_RANGES = [
     "20000 - 50000 $",
     "Свыше 50000 $"
 ]
+# Границы ценовых диапазонов (включительно), None - без ограничения
+PRICE_RANGE_BOUNDS = {
+    "До 5000 $": (None, 5000),
+    "5000 - 10000 $": (5000, 10000),
+    "10000 - 20000 $": (10000, 20000),
+    "20000 - 50000 $": (20000, 50000),
+    "Свыше 50000 $": (50000, None)
+}
+# Числовые фильтры-диапазоны: поле -> (название, единица измерения)
+RANGE_FILTERS = {
+    "price": ("Цена", "$"),
+    "year": ("Год выпуска", ""),
+    "mileage": ("Пробег", "км"),
+    "engine_volume": ("Объем двигателя", "л"),
+}
+# Число диапазонов в меню фильтра; границы подбираются по фактическим значениям так,
+# чтобы в каждом диапазоне было примерно поровну автомобилей
+RANGE_BUCKETS = 5
+
+# Режимы сортировки результатов: ключ -> (название, поле, по убыванию)
+SORT_MODES = {
+    "default": ("По умолчанию", None, False),
+    "price_asc": ("Сначала дешевле", "price", False),
+    "price_desc": ("Сначала дороже", "price", True),
+    "year_desc": ("Сначала новее", "year", True),
+    "mileage_asc": ("Меньше пробег", "mileage", False),
+}
+# Сколько автомобилей показывается на одной странице списка
+CARS_PER_PAGE = 10
@@ -1,57 +1,711 @@
 """
 Функции для работы с базой данных автомобилей
 """
+import copy
 import json
+import logging
+import math
 import os
-from config import CARS_FILE
+import sqlite3
+import threading
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+import fileutil
+import search
+import sqlite_store
+from models import Car
+from config import CARS_FILE, JOURNAL_FILE, JOURNAL_COMPACT_EVERY, PRICE_RANGE_BOUNDS, STORAGE_BACKEND, SORT_MODES, RANGE_BUCKETS
 
-def load_data():
-    """Загрузка данных из JSON"""
+logger = logging.getLogger(__name__)
+
+class ConflictError(Exception):
+    """Запись основана на устаревшей версии каталога или автомобиля"""
+
+# Подтверждение записи: версия каталога после нее, CRC32 записанных байт
+# и запись автомобиля (новая, для delete_car - удаленная, для mutate_cars - список новых)
+WriteReceipt = namedtuple("WriteReceipt", ["version", "checksum", "car"])
+
+# Поля, по которым строится инвертированный индекс (значение -> множество id)
+INDEXED_FIELDS = ('brand', 'body_type', 'engine_type', 'transmission')
+# Числовые поля, по которым поддерживаются отсортированные массивы (для сортировки и диапазонов)
+SORTED_FIELDS = ('price', 'year', 'mileage', 'engine_volume')
+
+# Разобранный каталог хранится в памяти процесса и перечитывается с диска
+# только если у файлов каталога изменились mtime/размер или запись прошла через этот модуль.
+#
+# На диске каталог - это снимок CARS_FILE плюс журнал JOURNAL_FILE с мелкими
+# изменениями (по одной JSON-записи на строку). Журнал проигрывается поверх
+# снимка при чтении и сворачивается в новый снимок каждые JOURNAL_COMPACT_EVERY записей.
+# При STORAGE_BACKEND = "sqlite" те же записи применяются к базе (sqlite_store),
+# а изменения из других процессов догоняются по номеру последнего изменения rev.
+#
+# Запись сериализуется: внутри процесса - блокировкой _write_lock, между процессами
+# (бот и download_images.py) - flock на файле LOCK_FILE. Читатели эти блокировки
+# не берут. Каталог и индексы в памяти - неизменяемый снимок Snapshot: запись
+# собирает новую версию в стороне (индексы - через _fork_index, копируя только
+# затронутые контейнеры) и публикует ее одной заменой ссылки _cache["snapshot"],
+# поэтому читатели продолжают работать со старой версией, не дожидаясь записи.
+# _lock - короткая блокировка перечитывания хранилища и публикации снимка.
+#
+# Блокировки записи и fsync синхронные: из цикла событий бота запись вызывается
+# через asyncio.to_thread.
+Snapshot = namedtuple("Snapshot", ["data", "index", "version", "stamp", "journal_len", "rev", "generation"])
+_EMPTY = Snapshot(None, None, 0, None, 0, 0, None)
+_lock = threading.RLock()
+_write_lock = threading.RLock()
+_cache = {"snapshot": None}
+LOCK_FILE = f"{CARS_FILE}.lock"
+_writer_state = {"depth": 0}
+
+def _stat(path):
+    """(mtime, размер) файла или None, если файла нет"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _file_stamp():
+    """Отпечаток хранилища: файлы снимка и журнала или счетчик изменений SQLite"""
+    if STORAGE_BACKEND == "sqlite":
+        return ("sqlite", sqlite_store.data_version())
+    return (_stat(CARS_FILE), _stat(JOURNAL_FILE))
+
+@contextmanager
+def _writer():
+    """Эксклюзивный доступ на запись: блокировка процесса и файловая блокировка"""
+    with _write_lock:
+        # Повторный вход (mutate_car -> update_car) уже держит файловую блокировку
+        if _writer_state["depth"]:
+            _writer_state["depth"] += 1
+            try:
+                yield
+            finally:
+                _writer_state["depth"] -= 1
+            return
+        with fileutil.file_lock(LOCK_FILE):
+            _writer_state["depth"] += 1
+            try:
+                yield
+            finally:
+                _writer_state["depth"] -= 1
+
+def _from_storage(data):
+    """Каталог в памяти из записей хранилища: автомобили становятся объектами Car"""
+    return {**data, "cars": [Car.from_dict(car) for car in data.get("cars", [])]}
+
+def _to_storage(data):
+    """Каталог для записи в хранилище: автомобили (Car или словари) в виде словарей"""
+    return {**data, "cars": [car.to_dict() if isinstance(car, Car) else car for car in data.get("cars", [])]}
+
+def _apply_record(data, record):
+    """Применение записи журнала к каталогу (словари из хранилища). Записи идемпотентны, повтор безопасен"""
+    cars = data.setdefault("cars", [])
+    op = record.get("op")
+    if op == "batch":
+        for sub_record in record["records"]:
+            _apply_record(data, sub_record)
+    elif op == "update":
+        for car in cars:
+            if car.get("id") == record["id"]:
+                car.update(record["fields"])
+                break
+    elif op == "add":
+        data["cars"] = [car for car in cars if car.get("id") != record["car"].get("id")]
+        data["cars"].append(record["car"])
+    elif op == "delete":
+        data["cars"] = [car for car in cars if car.get("id") != record["id"]]
+
+def _read_file():
+    """Чтение снимка и проигрывание журнала; возвращает (данные, число записей журнала)"""
+    data = {"cars": [], "contacts": {}}
     if os.path.exists(CARS_FILE):
+        with open(CARS_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+    journal_len = 0
+    if os.path.exists(JOURNAL_FILE):
+        with open(JOURNAL_FILE, 'rb') as f:
+            for line in f:
+                # Строка без перевода строки не подтверждена: ее дописывает другой процесс
+                # или она оборвалась при сбое. Читатель ее только пропускает - отрезает
+                # оборванный конец писатель под блокировкой (_append_journal)
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Пропущена поврежденная запись журнала {JOURNAL_FILE}")
+                    continue
+                _apply_record(data, record)
+                journal_len += 1
+    return data, journal_len
+
+def _write_snapshot(data):
+    """Атомарная запись снимка (временный файл + fsync + rename) и сброс журнала.
+
+    Возвращает CRC32 записанного файла.
+    """
+    content = json.dumps(_to_storage(data), ensure_ascii=False, indent=2).encode('utf-8')
+    fileutil.write_atomic(CARS_FILE, content)
+    # Журнал удаляется только после того, как снимок со всеми изменениями на диске
+    if os.path.exists(JOURNAL_FILE):
+        os.remove(JOURNAL_FILE)
+        fileutil.fsync_dir(JOURNAL_FILE)
+    return zlib.crc32(content)
+
+def _append_journal(record):
+    """Дописывание записи в журнал с fsync (вызывать под _writer); возвращает CRC32 записанной строки"""
+    line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n").encode('utf-8')
+    # Оборванная при сбое запись не была подтверждена - отрезаем ее, чтобы новая
+    # запись начиналась с новой строки
+    fileutil.truncate_tail(JOURNAL_FILE, fileutil.lines_end(JOURNAL_FILE))
+    with open(JOURNAL_FILE, 'ab') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    return zlib.crc32(line)
+
+def _index_add(index, car):
+    """Добавление автомобиля в индексы"""
+    car_id = car.id
+    index["by_id"][car_id] = car
+    for field in INDEXED_FIELDS:
+        value = getattr(car, field)
+        if value:
+            index["fields"][field].setdefault(value, set()).add(car_id)
+    for field in SORTED_FIELDS:
+        order = index["sorted"][field]
+        key = (getattr(car, field), car_id)
+        pos = bisect_right(order["keys"], key)
+        order["keys"].insert(pos, key)
+        order["ids"].insert(pos, car_id)
+    search.add(index["search"], car)
+
+def _index_remove(index, car):
+    """Удаление автомобиля из индексов (пустые значения убираются из фасетов)"""
+    car_id = car.id
+    index["by_id"].pop(car_id, None)
+    for field in INDEXED_FIELDS:
+        value = getattr(car, field)
+        ids = index["fields"][field].get(value)
+        if ids is not None:
+            ids.discard(car_id)
+            if not ids:
+                del index["fields"][field][value]
+    for field in SORTED_FIELDS:
+        order = index["sorted"][field]
+        key = (getattr(car, field), car_id)
+        pos = bisect_left(order["keys"], key)
+        if pos < len(order["keys"]) and order["keys"][pos] == key:
+            del order["keys"][pos]
+            del order["ids"][pos]
+    search.remove(index["search"], car)
+
+def _build_index(data):
+    """Построение вторичных индексов по доступным автомобилям"""
+    cars = data.get("cars", [])
+    available = [car for car in cars if car.is_available]
+    fields = {field: {} for field in INDEXED_FIELDS}
+    for car in available:
+        for field in INDEXED_FIELDS:
+            value = getattr(car, field)
+            if value:
+                fields[field].setdefault(value, set()).add(car.id)
+    # Для каждого числового поля - ключи (значение, id) по возрастанию и id в том же порядке
+    sorted_fields = {}
+    for field in SORTED_FIELDS:
+        keys = sorted((getattr(car, field), car.id) for car in available)
+        sorted_fields[field] = {"keys": keys, "ids": [car_id for _, car_id in keys]}
+    return {
+        "available": available,
+        "by_id": {car.id: car for car in available},
+        "order": {car.id: pos for pos, car in enumerate(cars)},
+        "fields": fields,
+        "sorted": sorted_fields,
+        "search": search.build(available),
+    }
+
+def _diff(old_data, new_data):
+    """Пары (старая, новая запись) автомобилей, различающихся между версиями каталога.
+
+    Новые автомобили должны добавляться в конец списка; если порядок существующих
+    автомобилей изменился, возвращается None - индексы нужно строить заново.
+    """
+    old_cars = old_data.get("cars", [])
+    new_cars = new_data.get("cars", [])
+    old_ids = [car.id for car in old_cars]
+    new_ids = [car.id for car in new_cars]
+    kept = set(new_ids)
+    survivors = [car_id for car_id in old_ids if car_id in kept]
+    if (new_ids[:len(survivors)] != survivors or len(kept) != len(new_ids)
+            or len(set(old_ids)) != len(old_ids)):
+        return None
+
+    old_by_id = {car.id: car for car in old_cars}
+    changes = [(car, None) for car_id, car in old_by_id.items() if car_id not in kept]
+    for car in new_cars:
+        old_car = old_by_id.get(car.id)
+        if old_car is not car and old_car != car:
+            changes.append((old_car, car))
+    return changes
+
+def _fork_index(index, changes):
+    """Копия индексов для изменения автомобилей из changes.
+
+    Копируются верхние словари и списки и те вложенные контейнеры, которые
+    изменение затронет; остальное остается общим со старой версией, которую
+    в это время могут читать другие обработчики.
+    """
+    cars = [car for pair in changes for car in pair if car is not None]
+    fields = {}
+    for field, values in index["fields"].items():
+        values = dict(values)
+        for car in cars:
+            value = getattr(car, field)
+            if value in values:
+                values[value] = set(values[value])
+        fields[field] = values
+    return {
+        "by_id": dict(index["by_id"]),
+        "order": dict(index["order"]),
+        "fields": fields,
+        "sorted": {field: {"keys": list(order["keys"]), "ids": list(order["ids"])}
+                   for field, order in index["sorted"].items()},
+        "search": search.fork(index["search"], cars),
+    }
+
+def _next_index(index, old_data, new_data, changes=None):
+    """Индексы для новой версии каталога; index не изменяется.
+
+    changes - список пар (старая запись, новая запись) для точечного обновления,
+    иначе пары вычисляются по разнице между версиями.
+    """
+    if index is None:
+        return _build_index(new_data)
+    if changes is None:
+        changes = _diff(old_data, new_data)
+        if changes is None:
+            return _build_index(new_data)
+    index = _fork_index(index, changes)
+    order = index["order"]
+    next_pos = max(order.values(), default=-1) + 1
+    for old_car, new_car in changes:
+        if old_car is not None and old_car.is_available:
+            _index_remove(index, old_car)
+        if new_car is not None:
+            if new_car.is_available:
+                _index_add(index, new_car)
+            if new_car.id not in order:
+                order[new_car.id] = next_pos
+                next_pos += 1
+        else:
+            order.pop(old_car.id, None)
+    index["available"] = sorted(index["by_id"].values(), key=lambda car: order[car.id])
+    return index
+
+def _publish(data, index, stamp, **state):
+    """Публикация новой версии каталога одной заменой ссылки; возвращает снимок.
+
+    state - journal_len, rev, generation, если они изменились.
+    """
+    with _lock:
+        current = _cache["snapshot"] or _EMPTY
+        snapshot = current._replace(data=data, index=index, version=current.version + 1, stamp=stamp, **state)
+        _cache["snapshot"] = snapshot
+        return snapshot
+
+def _load_sqlite(current, stamp):
+    """Новый снимок из SQLite: догрузка записей после rev или чтение целиком (вызывать под _lock)"""
+    records = None
+    if current is not None:
+        records = sqlite_store.changes_since(current.rev, current.generation)
+    if records is None:
+        data, rev, generation = sqlite_store.read_all()
+        data = _from_storage(data)
+        return _publish(data, _build_index(data), stamp, rev=rev, generation=generation)
+    data, index, rev = current.data, current.index, current.rev
+    for rev, record in records:
+        new_data, changes = _plan(data, record)
+        index = _next_index(index, data, new_data, changes)
+        data = new_data
+    return _publish(data, index, stamp, rev=rev)
+
+def _migrate_to_sqlite():
+    """Однократный перенос каталога из JSON (снимок + журнал) в SQLite"""
+    with _writer():
+        if sqlite_store.is_initialized():
+            return  # Уже перенесен другим процессом
+        data, _ = _read_file()
+        sqlite_store.write_all(_to_storage(_from_storage(data)))
+        logger.info(f"Каталог перенесен из {CARS_FILE} в SQLite: {len(data.get('cars', []))} авто")
+
+def _reload():
+    """Перечитывание хранилища, если его изменил другой процесс; возвращает актуальный снимок"""
+    if STORAGE_BACKEND == "sqlite" and _cache["snapshot"] is None and not sqlite_store.is_initialized():
+        # Перенос берет блокировку записи, поэтому выполняется до _lock
+        _migrate_to_sqlite()
+    with _lock:
+        # Отпечаток снимается до чтения: если хранилище изменится во время чтения,
+        # следующее обращение перечитает его снова
+        stamp = _file_stamp()
+        current = _cache["snapshot"]
+        if current is not None and current.stamp == stamp:
+            return current
         try:
-            with open(CARS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {"cars": [], "contacts": {}}
-    return {"cars": [], "contacts": {}}
-
-def save_data(data):
-    """Сохранение данных в JSON"""
-    with open(CARS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def get_cars(filters=None):
-    """Получение автомобилей с фильтрацией"""
-    data = load_data()
-    cars = [car for car in data["cars"] if car.get("is_available", True)]
-
-    if not filters:
-        return cars
-
-    filtered = []
-    for car in cars:
-        match = True
-        if filters.get('brand') and car.get('brand') != filters['brand']:
-            match = False
-        if filters.get('body_type') and car.get('body_type') != filters['body_type']:
-            match = False
-        if filters.get('engine_type') and car.get('engine_type') != filters['engine_type']:
-            match = False
-        if filters.get('transmission') and car.get('transmission') != filters['transmission']:
-            match = False
-        if filters.get('price_range'):
-            price = car.get('price', 0)
-            pr = filters['price_range']
-            if pr == "До 5000 $" and price > 5000:
-                match = False
-            elif pr == "5000 - 10000 $" and (price < 5000 or price > 10000):
-                match = False
-            elif pr == "10000 - 20000 $" and (price < 10000 or price > 20000):
-                match = False
-            elif pr == "20000 - 50000 $" and (price < 20000 or price > 50000):
-                match = False
-            elif pr == "Свыше 50000 $" and price < 50000:
-                match = False
-        if match:
-            filtered.append(car)
-    return filtered
+            if STORAGE_BACKEND == "sqlite":
+                return _load_sqlite(current, stamp)
+            data, journal_len = _read_file()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            if current is None:
+                raise
+            # Не подменяем рабочий каталог пустым из-за ошибки чтения
+            logger.error(f"Не удалось прочитать каталог, используется последняя версия: {e}")
+            _cache["snapshot"] = current._replace(stamp=stamp)
+            return _cache["snapshot"]
+        data = _from_storage(data)
+        if current is None:
+            index = _build_index(data)
+        else:
+            index = _next_index(current.index, current.data, data)
+        return _publish(data, index, stamp, journal_len=journal_len)
+
+def _current():
+    """Актуальный снимок каталога (без блокировок, если хранилище не менялось)"""
+    snapshot = _cache["snapshot"]
+    if snapshot is not None and snapshot.stamp == _file_stamp():
+        return snapshot
+    return _reload()
+
+def get_catalog():
+    """Каталог из памяти процесса (общий объект, только для чтения)"""
+    return _current().data
+
+def _get_index():
+    """Индексы для текущей версии каталога"""
+    return _current().index
+
+def get_catalog_version():
+    """Номер версии каталога, увеличивается при каждой перезагрузке или записи"""
+    return _current().version
+
+def load_data():
+    """Загрузка каталога (копия, которую можно изменять и передавать в save_data)"""
+    return copy.deepcopy(get_catalog())
+
+def save_data(data, expected_version=None):
+    """Сохранение данных (полный снимок, атомарно). Возвращает WriteReceipt.
+
+    Если задан expected_version, запись выполняется только когда каталог не менялся
+    с этой версии (get_catalog_version), иначе выбрасывается ConflictError.
+    """
+    with _writer():
+        current = _current()
+        if expected_version is not None and expected_version != current.version:
+            raise ConflictError(f"Каталог изменился: версия {current.version}, ожидалась {expected_version}")
+        stored = _to_storage(data)
+        if STORAGE_BACKEND == "sqlite":
+            rev, generation, checksum = sqlite_store.write_all(stored)
+            state = {"rev": rev, "generation": generation}
+        else:
+            checksum = _write_snapshot(stored)
+            state = {"journal_len": 0}
+        # Автомобили пересоздаются из записанных словарей, поэтому вызывающий код
+        # может дальше менять свою копию data
+        new_data = _from_storage(stored)
+        index = _next_index(current.index, current.data, new_data)
+        return WriteReceipt(_publish(new_data, index, _file_stamp(), **state).version, checksum, None)
+
+def _commit(current, record, new_data, changes=None, car=None):
+    """Запись изменения в хранилище и публикация новой версии каталога (вызывать под _writer).
+
+    current - снимок, на основе которого построена new_data. Возвращает WriteReceipt
+    с переданной записью автомобиля.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        cars = {}
+        for car_id in _record_ids(record):
+            new_car = _find_car(new_data, car_id)
+            cars[car_id] = new_car.to_dict() if new_car else None
+        rev, checksum = sqlite_store.append(record, cars)
+        state = {"rev": rev}
+    else:
+        checksum = _append_journal(record)
+        state = {"journal_len": current.journal_len + 1}
+        if state["journal_len"] >= JOURNAL_COMPACT_EVERY:
+            _write_snapshot(new_data)
+            state["journal_len"] = 0
+    index = _next_index(current.index, current.data, new_data, changes)
+    return WriteReceipt(_publish(new_data, index, _file_stamp(), **state).version, checksum, car)
+
+def _record_ids(record):
+    """id автомобилей, которые меняет запись журнала"""
+    op = record.get("op")
+    if op == "batch":
+        return [car_id for sub_record in record["records"] for car_id in _record_ids(sub_record)]
+    return [record["car"]["id"] if op == "add" else record["id"]]
+
+def _find_car(data, car_id):
+    """Запись автомобиля по id или None"""
+    return next((car for car in data.get("cars", []) if car.id == car_id), None)
+
+def _replace_car(data, car_id, new_car):
+    """Новая версия каталога с замененным (или удаленным при new_car=None) автомобилем.
+
+    Общие объекты не изменяются: читатели могут продолжать держать старые версии.
+    """
+    old_car = _find_car(data, car_id)
+    cars = []
+    for car in data.get("cars", []):
+        if car.id != car_id:
+            cars.append(car)
+        elif new_car is not None:
+            cars.append(new_car)
+    return {**data, "cars": cars}, old_car
+
+def _plan(data, record):
+    """Новая версия каталога после записи журнала и пары (старая, новая запись) для индексов.
+
+    Вместо пар возвращается None, если индексы нужно пересчитать по разнице.
+    """
+    op = record.get("op")
+    if op == "batch":
+        changes = []
+        for sub_record in record["records"]:
+            data, sub_changes = _plan(data, sub_record)
+            changes = None if changes is None or sub_changes is None else changes + sub_changes
+        return data, changes
+    if op == "update":
+        old_car = _find_car(data, record["id"])
+        if old_car is None:
+            return data, []
+        new_car = old_car.replace(record["fields"])
+        new_data, _ = _replace_car(data, record["id"], new_car)
+        return new_data, [(old_car, new_car)]
+    if op == "add":
+        new_car = Car.from_dict(record["car"])
+        new_data, old_car = _replace_car(data, new_car.id, None)
+        new_data["cars"].append(new_car)
+        # Повторное добавление существующего id меняет порядок - индексы пересчитываются по разнице
+        return new_data, ([(None, new_car)] if old_car is None else None)
+    if op == "delete":
+        new_data, old_car = _replace_car(data, record["id"], None)
+        return new_data, ([(old_car, None)] if old_car is not None else [])
+    return data, []
+
+def update_car(car_id, fields, expected=None):
+    """Изменение полей автомобиля одной записью журнала.
+
+    Возвращает WriteReceipt с обновленным автомобилем или None, если автомобиля нет.
+
+    expected - запись автомобиля, на основе которой сделано изменение (например,
+    полученная из get_catalog до await). Если с тех пор автомобиль изменился,
+    выбрасывается ConflictError.
+    """
+    with _writer():
+        current = _current()
+        old_car = _find_car(current.data, car_id)
+        if old_car is None:
+            return None
+        if expected is not None and expected is not old_car and expected != old_car:
+            raise ConflictError(f"Автомобиль {car_id} изменен другой операцией")
+        record = {"op": "update", "id": car_id, "fields": fields}
+        new_data, changes = _plan(current.data, record)
+        return _commit(current, record, new_data, changes, car=changes[0][1])
+
+def mutate_car(car_id, fn):
+    """Атомарное изменение автомобиля: fn получает копию актуальной записи и изменяет ее.
+
+    fn вызывается под блокировкой записи, поэтому не должна ничего ждать. Если fn
+    выбрасывает исключение (например, ConflictError), каталог не меняется.
+    Возвращает WriteReceipt с обновленным автомобилем или None, если автомобиля нет.
+    """
+    with _writer():
+        current = _current()
+        old_car = _find_car(current.data, car_id)
+        if old_car is None:
+            return None
+        car = old_car.copy()
+        fn(car)
+        old, new = old_car.to_dict(), car.to_dict()
+        fields = {key: value for key, value in new.items() if old.get(key, object()) != value}
+        if not fields:
+            return WriteReceipt(current.version, None, old_car)  # Записывать нечего
+        return update_car(car_id, fields)
+
+def mutate_cars(car_ids, fn):
+    """Атомарное изменение нескольких автомобилей одной записью журнала (одна запись и один fsync).
+
+    fn вызывается для копии актуальной записи каждого автомобиля, как в mutate_car;
+    автомобили, которых нет в каталоге, пропускаются. Возвращает WriteReceipt, в котором
+    car - список измененных автомобилей.
+    """
+    with _writer():
+        current = _current()
+        by_id = {car.id: car for car in current.data.get("cars", [])}
+        records = []
+        for car_id in dict.fromkeys(car_ids):
+            old_car = by_id.get(car_id)
+            if old_car is None:
+                continue
+            car = old_car.copy()
+            fn(car)
+            old, new = old_car.to_dict(), car.to_dict()
+            fields = {key: value for key, value in new.items() if old.get(key, object()) != value}
+            if fields:
+                records.append({"op": "update", "id": car_id, "fields": fields})
+        if not records:
+            return WriteReceipt(current.version, None, [])  # Записывать нечего
+        record = {"op": "batch", "records": records}
+        new_data, changes = _plan(current.data, record)
+        updated = [_find_car(new_data, sub_record["id"]) for sub_record in records]
+        return _commit(current, record, new_data, changes, car=updated)
+
+def add_car(car):
+    """Добавление автомобиля (Car или словарь) одной записью журнала. Возвращает WriteReceipt с добавленным автомобилем.
+
+    Если у автомобиля нет id, он назначается под блокировкой записи,
+    поэтому параллельные добавления не получат одинаковый id.
+    """
+    with _writer():
+        current = _current()
+        new_car = (car if isinstance(car, Car) else Car.from_dict(car)).to_dict()
+        if not new_car["id"]:
+            new_car["id"] = max((c.id for c in current.data.get("cars", [])), default=0) + 1
+        record = {"op": "add", "car": new_car}
+        new_data, changes = _plan(current.data, record)
+        return _commit(current, record, new_data, changes, car=new_data["cars"][-1])
+
+def delete_car(car_id):
+    """Удаление автомобиля одной записью журнала. Возвращает WriteReceipt с удаленным автомобилем или None"""
+    with _writer():
+        current = _current()
+        old_car = _find_car(current.data, car_id)
+        if old_car is None:
+            return None
+        record = {"op": "delete", "id": car_id}
+        new_data, changes = _plan(current.data, record)
+        return _commit(current, record, new_data, changes, car=old_car)
+
+def _range_ids(index, field, lower, upper):
+    """Множество id автомобилей, у которых значение поля в [lower, upper] (None - без ограничения)"""
+    order = index["sorted"][field]
+    keys = order["keys"]
+    start = bisect_left(keys, (lower,)) if lower is not None else 0
+    end = bisect_right(keys, (upper, math.inf)) if upper is not None else len(keys)
+    return set(order["ids"][start:end])
+
+def _filter_sets(index, filters, exclude=None):
+    """Множества id, соответствующие каждому заданному фильтру (кроме exclude).
+
+    filters["ranges"] - числовые диапазоны {поле: (нижняя граница, верхняя граница)};
+    filters["price_range"] - ценовой диапазон по названию из PRICE_RANGES (прежний формат).
+    """
+    matches = []
+    for field in INDEXED_FIELDS:
+        if field != exclude and filters.get(field):
+            matches.append(index["fields"][field].get(filters[field], set()))
+    for field, (lower, upper) in (filters.get('ranges') or {}).items():
+        if field != exclude and field in SORTED_FIELDS:
+            matches.append(_range_ids(index, field, lower, upper))
+    if exclude != 'price' and filters.get('price_range') in PRICE_RANGE_BOUNDS:
+        matches.append(_range_ids(index, 'price', *PRICE_RANGE_BOUNDS[filters['price_range']]))
+    if exclude != 'text' and filters.get('text'):
+        matches.append(set(search.match(index["search"], filters['text'])))
+    matches.sort(key=len)
+    return matches
+
+def get_cars(filters=None, sort=None):
+    """Получение автомобилей с фильтрацией.
+
+    filters["text"] - поисковый запрос (см. search.match).
+    sort - ключ SORT_MODES; без сортировки автомобили идут в порядке каталога,
+    а при поиске по тексту - по убыванию релевантности.
+    """
+    index = _get_index()
+    by_id = index["by_id"]
+    # Пересекаем множества id по каждому заданному фильтру
+    matches = _filter_sets(index, filters, exclude='text') if filters else []
+    scores = search.match(index["search"], filters['text']) if filters and filters.get('text') else None
+    if scores is not None:
+        matches.append(set(scores))
+        matches.sort(key=len)
+    ids = matches[0].intersection(*matches[1:]) if matches else None
+
+    field, descending = SORT_MODES.get(sort, (None, None, False))[1:]
+    if field is None:
+        if ids is None:
+            return list(index["available"])
+        order = index["order"]
+        if scores is not None:
+            return [by_id[car_id] for car_id in sorted(ids, key=lambda car_id: (-scores[car_id], order[car_id]))]
+        return [by_id[car_id] for car_id in sorted(ids, key=order.__getitem__)]
+
+    # Порядок берется из заранее отсортированного массива, сортировать на запрос не нужно
+    sorted_ids = index["sorted"][field]["ids"]
+    if descending:
+        sorted_ids = reversed(sorted_ids)
+    if ids is None:
+        return [by_id[car_id] for car_id in sorted_ids]
+    return [by_id[car_id] for car_id in sorted_ids if car_id in ids]
+
+def get_car(car_id):
+    """Доступный автомобиль по id (из общего каталога в памяти) или None"""
+    return _get_index()["by_id"].get(car_id)
+
+def find_car(car_id):
+    """Автомобиль каталога по id, включая снятые с продажи, или None"""
+    return _find_car(get_catalog(), car_id)
+
+def get_range_buckets(field, filters=None, count=RANGE_BUCKETS):
+    """Диапазоны значений числового поля с примерно равным числом автомобилей.
+
+    Границы берутся по квантилям значений у автомобилей, подходящих под остальные
+    фильтры; одинаковые значения всегда попадают в один диапазон, поэтому диапазонов
+    может быть меньше count. У первого диапазона нет нижней границы, у последнего -
+    верхней. Возвращает список (нижняя граница, верхняя граница, число автомобилей).
+    """
+    index = _get_index()
+    keys = index["sorted"][field]["keys"]
+    matches = _filter_sets(index, filters or {}, exclude=field)
+    if matches:
+        ids = matches[0].intersection(*matches[1:])
+        values = [value for value, car_id in keys if car_id in ids]
+    else:
+        values = [value for value, _ in keys]
+
+    buckets = []
+    start = 0
+    for i in range(1, count + 1):
+        end = len(values) * i // count
+        if end <= start:
+            continue
+        end = bisect_right(values, values[end - 1], end - 1)
+        buckets.append([values[start], values[end - 1], end - start])
+        start = end
+    if buckets:
+        buckets[0][0] = None
+        buckets[-1][1] = None
+    return [tuple(bucket) for bucket in buckets]
+
+def get_facet_counts(field, filters=None):
+    """Количество доступных автомобилей по каждому значению поля с учетом остальных фильтров.
+
+    Собственный фильтр поля не учитывается, чтобы пользователь мог сменить выбор.
+    Значения, для которых нет автомобилей, в результат не попадают.
+    """
+    index = _get_index()
+    values = index["fields"][field]
+    matches = _filter_sets(index, filters or {}, exclude=field)
+    if not matches:
+        return {value: len(ids) for value, ids in values.items()}
+
+    base = matches[0].intersection(*matches[1:])
+    counts = {}
+    for value, ids in values.items():
+        count = len(base & ids)
+        if count:
+            counts[value] = count
+    return counts
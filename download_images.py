@@ -1,17 +1,30 @@
 """
 Скрипт для скачивания изображений из JSON и сохранения их локально
+
+Загрузка идет параллельно (пул потоков, переиспользуемые HTTP-соединения).
+Каждое скачанное фото сразу записывается в манифест, поэтому прерванный
+запуск продолжается с того же места, а каталог обновляется пачками.
+
+    python download_images.py --workers 8 --batch-size 20
 """
+import argparse
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 import logging
+import database
+import images
+from utils import reserve_photo_path
+from config import PHOTOS_DIR, IMPORT_MANIFEST_FILE
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-CARS_FILE = "data/datacars.json"
-PHOTOS_DIR = "data/photos"
+_local = threading.local()
 
 def ensure_photos_dir():
     """Создает папку для фотографий если её нет"""
@@ -19,18 +32,51 @@ def ensure_photos_dir():
         os.makedirs(PHOTOS_DIR)
         logger.info(f"Создана папка {PHOTOS_DIR}")
 
-def download_image(url, filepath):
-    """Скачивает изображение по URL и сохраняет в файл"""
+def get_session(pool_size=10):
+    """HTTP-сессия текущего потока (соединения переиспользуются между запросами)"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+def download_image(url, car_id, number, taken=()):
+    """Скачивает изображение по URL, сохраняет и обрабатывает его, возвращает итоговый путь или None.
+
+    Имя car_<id>_<number> резервируется (utils.reserve_photo_path) сразу с расширением
+    после обработки, поэтому ни загрузка, ни optimize_image не перезаписывают фото,
+    добавленное админом или скачанное ботом.
+    """
     try:
-        response = requests.get(url, timeout=10)
+        response = get_session().get(url, timeout=10)
         response.raise_for_status()
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
+        filepath = reserve_photo_path(car_id, number, taken, images.output_extension(get_file_extension(url)))
+        # Пишем во временный файл, чтобы прерванная загрузка не выглядела завершенной
+        tmp_path = f"{filepath}.part"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, filepath)
+        except BaseException:
+            for path in (tmp_path, filepath):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
         logger.info(f"Скачано: {url} -> {filepath}")
-        return True
     except Exception as e:
         logger.error(f"Ошибка скачивания {url}: {e}")
-        return False
+        return None
+
+    try:
+        return images.optimize_image(filepath)
+    except Exception as e:
+        logger.error(f"Ошибка обработки {filepath}: {e}")
+        return filepath
 
 def get_file_extension(url):
     """Получает расширение файла из URL"""
@@ -40,59 +86,110 @@ def get_file_extension(url):
         return os.path.splitext(path)[1]
     return '.jpg'  # По умолчанию jpg
 
-def download_all_images():
-    """Скачивает все изображения из JSON"""
-    ensure_photos_dir()
-    
-    if not os.path.exists(CARS_FILE):
-        logger.error(f"Файл {CARS_FILE} не найден!")
+def load_manifest():
+    """Уже скачанные URL из манифеста: {url: имя файла}"""
+    done = {}
+    if os.path.exists(IMPORT_MANIFEST_FILE):
+        with open(IMPORT_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Недописанная строка после сбоя
+                done[record["url"]] = record["filename"]
+    return done
+
+def append_manifest(manifest_file, url, filename):
+    """Фиксация скачанного фото в манифесте"""
+    manifest_file.write(json.dumps({"url": url, "filename": filename}, ensure_ascii=False) + "\n")
+    manifest_file.flush()
+    os.fsync(manifest_file.fileno())
+
+def commit_batch(results):
+    """Замена URL на локальные файлы в каталоге для пачки автомобилей"""
+    if not results:
         return
-    
-    with open(CARS_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    updated = False
+
+    def replace(car):
+        replacements = results[car.id]
+        car.photos = [replacements.get(photo, photo) for photo in car.photos]
+
+    # Вся пачка - одна запись журнала поверх актуальных версий автомобилей,
+    # поэтому запущенный параллельно бот не теряет свои изменения
+    receipt = database.mutate_cars(list(results), replace)
+    logger.info(f"Каталог обновлен: {len(receipt.car)} авто")
+
+def collect_tasks(data):
+    """Список загрузок: (id авто, URL, номер фото, имена фото авто, которые нельзя занимать)"""
+    tasks = []
     for car in data.get('cars', []):
-        car_id = car.get('id')
+        car_id = car.id
         if not car_id:
             continue
-        
-        photos = car.get('photos', [])
-        if not photos:
-            continue
-        
-        local_photos = []
-        for idx, photo_url in enumerate(photos):
-            if isinstance(photo_url, str) and photo_url.startswith('http'):
-                # Это URL, нужно скачать
-                ext = get_file_extension(photo_url)
-                filename = f"car_{car_id}_{idx+1}{ext}"
-                filepath = os.path.join(PHOTOS_DIR, filename)
-                
-                if not os.path.exists(filepath):
-                    if download_image(photo_url, filepath):
-                        local_photos.append(filename)
-                    else:
-                        # Если не удалось скачать, оставляем URL
-                        local_photos.append(photo_url)
-                else:
-                    # Файл уже существует
-                    local_photos.append(filename)
-            else:
-                # Уже локальный файл
-                local_photos.append(photo_url)
-        
-        if local_photos != photos:
-            car['photos'] = local_photos
-            updated = True
-    
-    if updated:
-        with open(CARS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info("JSON обновлен с локальными путями к фотографиям")
-    else:
+        taken = frozenset(car.photos)
+        for idx, photo_url in enumerate(car.photos):
+            if photo_url.startswith('http'):
+                tasks.append((car_id, photo_url, idx + 1, taken))
+    return tasks
+
+def download_all_images(workers=8, batch_size=20):
+    """Скачивает все изображения из JSON"""
+    ensure_photos_dir()
+
+    tasks = collect_tasks(database.get_catalog())
+    if not tasks:
         logger.info("Все фотографии уже скачаны или обновление не требуется")
+        return
 
-if __name__ == "__main__":
-    download_all_images()
+    done = load_manifest()
+    pending_per_car = {}
+    for car_id, *_ in tasks:
+        pending_per_car[car_id] = pending_per_car.get(car_id, 0) + 1
 
+    results = {}  # id авто -> {URL: имя файла} для еще не записанной пачки
+    finished_cars = []
+
+    def finish(car_id, url, filename):
+        if filename:
+            results.setdefault(car_id, {})[url] = filename
+        pending_per_car[car_id] -= 1
+        if pending_per_car[car_id] == 0:
+            finished_cars.append(car_id)
+            if len(finished_cars) >= batch_size:
+                commit_batch({cid: results.pop(cid) for cid in finished_cars if cid in results})
+                finished_cars.clear()
+
+    to_download = []
+    for car_id, url, number, taken in tasks:
+        if url in done and os.path.exists(os.path.join(PHOTOS_DIR, done[url])):
+            finish(car_id, url, done[url])  # Скачано в прошлом запуске
+        else:
+            to_download.append((car_id, url, number, taken))
+
+    logger.info(f"К скачиванию: {len(to_download)} из {len(tasks)} фото, потоков: {workers}")
+    failed = 0
+    with open(IMPORT_MANIFEST_FILE, 'a', encoding='utf-8') as manifest_file, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(download_image, url, car_id, number, taken): (car_id, url)
+                   for car_id, url, number, taken in to_download}
+        for future in as_completed(futures):
+            car_id, url = futures[future]
+            saved_path = future.result()
+            if saved_path:
+                filename = os.path.basename(saved_path)
+                append_manifest(manifest_file, url, filename)
+                finish(car_id, url, filename)
+            else:
+                # Если не удалось скачать, оставляем URL
+                failed += 1
+                finish(car_id, url, None)
+
+    commit_batch({cid: results.pop(cid) for cid in finished_cars if cid in results})
+    logger.info(f"Готово: скачано {len(to_download) - failed}, ошибок {failed}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Скачивание фотографий каталога по URL")
+    parser.add_argument("--workers", type=int, default=8, help="Количество параллельных загрузок")
+    parser.add_argument("--batch-size", type=int, default=20, help="Сколько авто записывать в каталог за раз")
+    args = parser.parse_args()
+    download_all_images(workers=args.workers, batch_size=args.batch_size)
@@ -0,0 +1,132 @@
+"""
+Асинхронное скачивание фотографий по URL без блокировки цикла событий
+"""
+import asyncio
+import logging
+import os
+import httpx
+import images
+from config import DOWNLOAD_WORKERS, DOWNLOAD_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Один пул соединений и очередь с фиксированным числом воркеров на процесс;
+# повторные запросы того же URL ждут уже идущую загрузку
+_state = {"client": None, "queue": None, "workers": []}
+_inflight = {}
+
+def _get_extension(content_type):
+    """Расширение файла по Content-Type"""
+    if 'jpeg' in content_type or 'jpg' in content_type:
+        return '.jpg'
+    elif 'png' in content_type:
+        return '.png'
+    elif 'webp' in content_type:
+        return '.webp'
+    return '.jpg'  # По умолчанию
+
+def _write_file(car_id, photo_index, extension, content):
+    """Запись скачанного файла под свободным именем (выполняется в потоке); возвращает путь.
+
+    Имя резервируется так же, как для фото от админа, поэтому скачанный файл
+    не перезаписывает уже существующее фото автомобиля.
+    """
+    import database
+    from utils import ensure_photos_dir, reserve_photo_path
+    ensure_photos_dir()
+    car = database.find_car(car_id)
+    filepath = reserve_photo_path(car_id, photo_index, car.photos if car else (), extension)
+    try:
+        with open(filepath, 'wb') as f:
+            f.write(content)
+    except BaseException:
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+        raise
+    return filepath
+
+def _replace_url_in_catalog(car_id, url, filename):
+    """Замена URL фотографии на локальный файл в каталоге (выполняется в потоке)"""
+    import database
+
+    def replace(car):
+        car.photos = [filename if photo == url else photo for photo in car.photos]
+
+    # Замена выполняется над актуальной записью, поэтому не затирает правки админа,
+    # сделанные пока шло скачивание
+    if database.mutate_car(car_id, replace) is not None:
+        logger.info(f"Обновлен JSON: URL заменен на {filename}")
+
+async def _fetch(url, car_id, photo_index):
+    """Скачивание одного URL, сохранение файла и обновление каталога"""
+    response = await _state["client"].get(url)
+    response.raise_for_status()
+
+    extension = images.output_extension(_get_extension(response.headers.get('content-type', '')))
+    filepath = await asyncio.to_thread(_write_file, car_id, photo_index, extension, response.content)
+    logger.info(f"Изображение скачано: {url} -> {filepath}")
+
+    filepath = await images.optimize_image_async(filepath)
+    filename = os.path.basename(filepath)
+
+    await asyncio.to_thread(_replace_url_in_catalog, car_id, url, filename)
+    return filename
+
+async def _worker():
+    """Воркер очереди загрузок"""
+    queue = _state["queue"]
+    while True:
+        url, car_id, photo_index, future = await queue.get()
+        result = None
+        try:
+            result = await _fetch(url, car_id, photo_index)
+        except Exception as e:
+            logger.error(f"Ошибка скачивания изображения {url}: {e}")
+        finally:
+            # future разрешается и при отмене воркера, иначе ожидающие его обработчики зависнут
+            _inflight.pop(url, None)
+            queue.task_done()
+            if not future.done():
+                future.set_result(result)
+
+def _ensure_started():
+    """Ленивый запуск клиента и воркеров в текущем цикле событий"""
+    if _state["queue"] is None:
+        _state["client"] = httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=DOWNLOAD_WORKERS, max_keepalive_connections=DOWNLOAD_WORKERS)
+        )
+        _state["queue"] = asyncio.Queue()
+        _state["workers"] = [asyncio.create_task(_worker()) for _ in range(DOWNLOAD_WORKERS)]
+
+def download_image_from_url(url, car_id, photo_index):
+    """Постановка URL в очередь загрузки.
+
+    Возвращает future с именем сохраненного файла (None при ошибке). Повторный
+    вызов для URL, который уже скачивается, возвращает тот же future.
+    """
+    future = _inflight.get(url)
+    if future is not None:
+        return future
+
+    _ensure_started()
+    future = asyncio.get_running_loop().create_future()
+    _inflight[url] = future
+    _state["queue"].put_nowait((url, car_id, photo_index, future))
+    return future
+
+async def close():
+    """Остановка воркеров и закрытие пула соединений"""
+    for task in _state["workers"]:
+        task.cancel()
+    await asyncio.gather(*_state["workers"], return_exceptions=True)
+    if _state["client"] is not None:
+        await _state["client"].aclose()
+    for future in _inflight.values():
+        if not future.done():
+            future.set_result(None)
+    _inflight.clear()
+    _state.update(client=None, queue=None, workers=[])
@@ -0,0 +1,131 @@
+"""
+Общие операции с файлами хранилищ: блокировка между процессами, атомарная запись
+файла и журналы с дописыванием (строки JSON или записи с длиной и CRC32)
+"""
+import logging
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка между процессами недоступна
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Заголовок записи журнала: длина и CRC32 тела
+_FRAME_HEADER = struct.Struct("<II")
+
+@contextmanager
+def file_lock(path):
+    """Эксклюзивная файловая блокировка (flock) на path между процессами; без fcntl - ничего"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def fsync_dir(path):
+    """fsync каталога файла path, чтобы переименование или удаление пережило сбой питания"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_atomic(path, content, durable=True):
+    """Атомарная замена файла содержимым content (bytes): временный файл + rename.
+
+    С durable данные и переименование дополнительно сбрасываются на диск (fsync),
+    иначе файл переживает только падение процесса.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if durable:
+        fsync_dir(path)
+
+def lines_end(path, chunk_size=4096):
+    """Размер файла до конца последней завершенной строки (0, если файла нет)"""
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - chunk_size)
+            f.seek(start)
+            chunk = f.read(end - start)
+            pos = chunk.rfind(b"\n")
+            if pos != -1:
+                return start + pos + 1
+            end = start
+        return 0
+
+def truncate_tail(path, valid_size):
+    """Отрезание недописанного конца файла после valid_size.
+
+    Вызывать только под блокировкой записи: читатель не может отличить оборванную
+    при сбое запись от записи, которую другой процесс дописывает прямо сейчас.
+    """
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return
+    if size > valid_size:
+        logger.warning(f"Отброшен недописанный конец файла {path}: {size - valid_size} байт")
+        with open(path, 'r+b') as f:
+            f.truncate(valid_size)
+
+def encode_frame(body):
+    """Запись журнала с длиной и CRC32: целиком проверяется при чтении"""
+    return _FRAME_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+def read_frames(path):
+    """Тела записей журнала до первой недописанной или поврежденной.
+
+    Возвращает (список тел, размер проверенной части файла) - конец после него
+    писатель отрезает через truncate_tail.
+    """
+    bodies = []
+    valid_size = 0
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return bodies, valid_size
+    with f:
+        while True:
+            header = f.read(_FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                break
+            size, checksum = _FRAME_HEADER.unpack(header)
+            body = f.read(size)
+            if len(body) < size or zlib.crc32(body) != checksum:
+                break
+            bodies.append(body)
+            valid_size = f.tell()
+    return bodies, valid_size
@@ -1,13 +1,23 @@
 """
 Обработчики команд и сообщений для телеграм бота
 """
+import asyncio
 import logging
-from telegram import Update
+from array import array
+from telegram import Update, Message, InputMediaPhoto
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
+from telegram.helpers import escape_markdown
 import keyboards
 import database
-from utils import safe_edit_message_text
+import captions
+import photo_cache
+import downloader
+import outbox
+from config import ADMIN_IDS, NAVIGATION_EDIT_IN_PLACE, DOWNLOAD_WAIT_TIMEOUT, RANGE_FILTERS, CARS_PER_PAGE, SORT_MODES
+from models import FIELD_TYPES
+from utils import safe_edit_message_text, format_range
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +46,7 @@ async def show_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.callback_query.edit_message_text(text, reply_markup=keyboards.get_catalog_menu())
 
 async def show_contacts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = database.load_data()
+    data = database.get_catalog()
     contacts = data.get("contacts", {})
     text = f"""Контакты
 
@@ -64,38 +74,66 @@ async def show_filter_params(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def show_all_cars(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    cars = database.get_cars()
+    cars = database.get_cars(sort=context.user_data.get('current_sort'))
     if not cars:
         await safe_edit_message_text(query, "На данный момент нет доступных автомобилей.")
         return
-    context.user_data['current_cars'] = cars
+    _remember_results(context, cars, {})
     context.user_data['current_index'] = 0
-    await show_car(query, context, 0)
+    await show_results_page(query, context, 0)
 
 async def filter_brand(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await safe_edit_message_text(query, "Выберите марку автомобиля:", reply_markup=keyboards.get_brands_keyboard())
+    await safe_edit_message_text(query, "Выберите марку автомобиля:", reply_markup=keyboards.get_brands_keyboard(context.user_data.get('filters')))
 
 async def filter_body(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await safe_edit_message_text(query, "Выберите тип кузова:", reply_markup=keyboards.get_body_types_keyboard())
+    await safe_edit_message_text(query, "Выберите тип кузова:", reply_markup=keyboards.get_body_types_keyboard(context.user_data.get('filters')))
 
 async def filter_engine(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await safe_edit_message_text(query, "Выберите тип двигателя:", reply_markup=keyboards.get_engine_types_keyboard())
+    await safe_edit_message_text(query, "Выберите тип двигателя:", reply_markup=keyboards.get_engine_types_keyboard(context.user_data.get('filters')))
 
 async def filter_transmission(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await safe_edit_message_text(query, "Выберите коробку передач:", reply_markup=keyboards.get_transmission_keyboard())
+    await safe_edit_message_text(query, "Выберите коробку передач:", reply_markup=keyboards.get_transmission_keyboard(context.user_data.get('filters')))
 
 async def filter_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await safe_edit_message_text(query, "Выберите ценовой диапазон:", reply_markup=keyboards.get_price_ranges_keyboard())
+    await safe_edit_message_text(query, "Выберите ценовой диапазон:", reply_markup=keyboards.get_range_keyboard('price', context.user_data.get('filters')))
+
+async def filter_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    field = query.data.replace('filter_range_', '')
+    if field not in RANGE_FILTERS:
+        return
+    await safe_edit_message_text(query, f"{RANGE_FILTERS[field][0]}: выберите диапазон", reply_markup=keyboards.get_range_keyboard(field, context.user_data.get('filters')))
+
+def _parse_range(data):
+    """Поле и границы из callback_data вида select_range_<поле>_<от>_<до>; для select_range_<поле>_any - (поле, None).
+
+    Для неизвестного поля или некорректных границ возвращается None: callback_data
+    приходит от клиента и может быть подделана.
+    """
+    data = data.replace('select_range_', '')
+    if data.endswith('_any'):
+        field = data[:-len('_any')]
+        return (field, None) if field in RANGE_FILTERS else None
+    parts = data.rsplit('_', 2)
+    if len(parts) != 3 or parts[0] not in RANGE_FILTERS:
+        return None
+    field, lower, upper = parts
+    kind = FIELD_TYPES[field][0]
+    try:
+        return field, (kind(lower) if lower else None, kind(upper) if upper else None)
+    except ValueError:
+        return None
 
 async def handle_filter_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -115,8 +153,22 @@ async def handle_filter_selection(update: Update, context: ContextTypes.DEFAULT_
     elif data.startswith('select_transmission_'):
         context.user_data['filters']['transmission'] = data.replace('select_transmission_', '')
         text = f"КПП: {context.user_data['filters']['transmission']}\n\nВыберите следующий параметр или проверьте наличие:"
+    elif data.startswith('select_range_'):
+        parsed = _parse_range(data)
+        if parsed is None:
+            return
+        field, bounds = parsed
+        ranges = context.user_data['filters'].setdefault('ranges', {})
+        if field == 'price':
+            context.user_data['filters'].pop('price_range', None)
+        if bounds is None:
+            ranges.pop(field, None)
+        else:
+            ranges[field] = bounds
+        text = f"{RANGE_FILTERS[field][0]}: {format_range(field, *(bounds or (None, None)))}\n\nВыберите следующий параметр или проверьте наличие:"
     elif data.startswith('select_price_'):
         context.user_data['filters']['price_range'] = data.replace('select_price_', '')
+        context.user_data['filters'].get('ranges', {}).pop('price', None)
         text = f"Цена: {context.user_data['filters']['price_range']}\n\nВыберите следующий параметр или проверьте наличие:"
     else:
         return
@@ -138,7 +190,9 @@ async def check_availability(update: Update, context: ContextTypes.DEFAULT_TYPE)
         filters_text += f"• КПП: {filters['transmission']}\n"
     if filters.get('price_range'):
         filters_text += f"• Цена: {filters['price_range']}\n"
-    if not filters:
+    for field, bounds in (filters.get('ranges') or {}).items():
+        filters_text += f"• {RANGE_FILTERS[field][0]}: {format_range(field, *bounds)}\n"
+    if not any(filters.values()):
         filters_text = "Фильтры не установлены\n"
     await safe_edit_message_text(query, f"Проверка наличия\n\n{filters_text}\nДоступно {count} авто", reply_markup=keyboards.get_availability_keyboard(count))
 
@@ -146,13 +200,13 @@ async def view_available_cars(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     filters = context.user_data.get('filters', {})
-    cars = database.get_cars(filters)
+    cars = database.get_cars(filters, sort=context.user_data.get('current_sort'))
     if not cars:
         await safe_edit_message_text(query, "По вашим параметрам не найдено доступных автомобилей.")
         return
-    context.user_data['current_cars'] = cars
+    _remember_results(context, cars, filters)
     context.user_data['current_index'] = 0
-    await show_car(query, context, 0)
+    await show_results_page(query, context, 0)
 
 async def new_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -164,19 +218,19 @@ async def handle_car_navigation(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     if query.data.startswith('prev_'):
-        await show_car(query, context, int(query.data.split('_')[1]), 0)
+        await show_car(query, context, int(query.data.split('_')[1]), 0, edit=True)
     elif query.data.startswith('next_'):
-        await show_car(query, context, int(query.data.split('_')[1]), 0)
+        await show_car(query, context, int(query.data.split('_')[1]), 0, edit=True)
     elif query.data.startswith('photo_prev_'):
         parts = query.data.split('_')
         car_index = int(parts[2])
         photo_index = int(parts[3])
-        await show_car(query, context, car_index, photo_index)
+        await show_car(query, context, car_index, photo_index, edit=True)
     elif query.data.startswith('photo_next_'):
         parts = query.data.split('_')
         car_index = int(parts[2])
         photo_index = int(parts[3])
-        await show_car(query, context, car_index, photo_index)
+        await show_car(query, context, car_index, photo_index, edit=True)
 
 async def back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -219,49 +273,150 @@ async def back_to_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     await safe_edit_message_text(query, "Подбор по параметрам\n\nВыберите параметр для фильтрации:", reply_markup=keyboards.get_filters_menu())
 
-async def show_car(update, context: ContextTypes.DEFAULT_TYPE, index: int, photo_index: int = 0):
+def _remember_results(context, cars, filters):
+    """Сохранение выборки пользователя: массив id (4 байта на автомобиль) и фильтры, по которым она получена"""
+    context.user_data['current_cars'] = array('I', (car.id for car in cars))
+    context.user_data['current_query'] = dict(filters or {})
+
+def _requery(context):
+    """Пересчет выборки пользователя по сохраненным фильтрам и сортировке"""
+    filters = context.user_data.get('current_query')
+    _remember_results(context, database.get_cars(filters, sort=context.user_data.get('current_sort')), filters)
+    return context.user_data['current_cars']
+
+def _resolve_car(context, index):
+    """Автомобиль выборки пользователя по позиции из общего каталога: (автомобиль, позиция, размер выборки).
+
+    Если автомобиль удален или снят с продажи, выборка пересчитывается по сохраненным фильтрам.
+    """
+    ids = context.user_data.get('current_cars')
+    if not ids:
+        return None, index, 0
+    car = database.get_car(ids[index]) if index < len(ids) else None
+    if car is None:
+        ids = _requery(context)
+        index = min(index, len(ids) - 1)
+        car = database.get_car(ids[index]) if ids else None
+    return car, index, len(ids)
+
+def _results_page(context, page):
+    """Текст и клавиатура страницы выборки или None, если в выборке не осталось автомобилей"""
+
+    ids = context.user_data.get('current_cars')
+    if ids and any(database.get_car(car_id) is None for car_id in ids[page * CARS_PER_PAGE:(page + 1) * CARS_PER_PAGE]):
+        ids = _requery(context)
+    if not ids:
+        return None
+
+    total_pages = (len(ids) + CARS_PER_PAGE - 1) // CARS_PER_PAGE
+    page = max(0, min(page, total_pages - 1))
+    start = page * CARS_PER_PAGE
+    rows = tuple(
+        (index, captions.car_row(database.get_car(ids[index])))
+        for index in range(start, min(start + CARS_PER_PAGE, len(ids)))
+    )
+    sort = context.user_data.get('current_sort') or 'default'
+    return (f"Найдено авто: {len(ids)} (стр. {page + 1}/{total_pages})\n\nВыберите автомобиль:",
+            keyboards.get_results_page_keyboard(rows, page, total_pages, sort))
+
+async def show_results_page(query, context: ContextTypes.DEFAULT_TYPE, page: int):
+    """Страница выборки: CARS_PER_PAGE строк, по нажатию открывается карточка автомобиля"""
+    results = _results_page(context, page)
+    if results is None:
+        await safe_edit_message_text(query, "На данный момент нет доступных автомобилей.",
+                                     reply_markup=keyboards.get_filters_menu())
+        return
+    text, reply_markup = results
+    await safe_edit_message_text(query, text, reply_markup=reply_markup)
+
+async def handle_results_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await show_results_page(query, context, int(query.data.split('_')[2]))
+
+async def open_car(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    index = int(query.data.split('_')[2])
+    context.user_data['current_index'] = index
+    await show_car(query, context, index)
+
+async def show_sort_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    sort = context.user_data.get('current_sort') or 'default'
+    await safe_edit_message_text(query, "Порядок сортировки:", reply_markup=keyboards.get_sort_keyboard(sort))
+
+async def set_sort(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+    query = update.callback_query
+    await query.answer()
+    sort = query.data[len('set_sort_'):]
+    if sort not in SORT_MODES:
+        sort = 'default'
+    context.user_data['current_sort'] = sort
+    _requery(context)
+    await show_results_page(query, context, 0)
+
+# Состояние ConversationHandler поиска
+SEARCH = 0
+SEARCH_PROMPT = "Поиск по каталогу\n\nВведите марку, модель или особенность автомобиля, например: «camry кожа»"
+
+async def _send_search_results(message, context, text):
+    """Поиск по тексту и отправка первой страницы результатов"""
+    filters = {'text': text}
+    cars = database.get_cars(filters, sort=context.user_data.get('current_sort'))
+    if not cars:
+        await message.reply_text(f"По запросу «{text}» ничего не найдено.\n\nПопробуйте другой запрос: /search",
+                                 reply_markup=keyboards.get_catalog_menu())
+        return
+    _remember_results(context, cars, filters)
+    context.user_data['current_index'] = 0
+    page_text, reply_markup = _results_page(context, 0)
+    await message.reply_text(page_text, reply_markup=reply_markup)
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/search [запрос]: поиск сразу по аргументам или ожидание текста запроса"""
+    if context.args:
+        await _send_search_results(update.message, context, " ".join(context.args))
+        return ConversationHandler.END
+    await update.message.reply_text(SEARCH_PROMPT)
+    return SEARCH
+
+async def search_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await safe_edit_message_text(query, SEARCH_PROMPT)
+    return SEARCH
+
+async def get_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _send_search_results(update.message, context, update.message.text.strip())
+    return ConversationHandler.END
+
+async def cancel_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Поиск отменен.", reply_markup=keyboards.get_main_menu())
+    return ConversationHandler.END
+
+async def show_car(update, context: ContextTypes.DEFAULT_TYPE, index: int, photo_index: int = 0, edit: bool = False):
+    """Показ автомобиля; при edit=True фото меняется в текущем сообщении вместо отправки нового"""
     from config import ADMIN_IDS, PHOTOS_DIR
     import os
-    from telegram import InputMediaPhoto
 
-    cars = context.user_data.get('current_cars', [])
-    if not cars or index >= len(cars):
+    car, index, total_cars = _resolve_car(context, index)
+    if car is None:
         if hasattr(update, 'edit_message_text'):
             await update.edit_message_text("Автомобиль не найден")
         return
-    car = cars[index]
-    
-    # Получаем список фотографий
-    photos = car.get('photos', [])
-    if isinstance(photos, str):
-        photos = [photos]
-    
-    # Фильтруем только существующие фотографии
-    valid_photos = []
-    for photo in photos:
-        if isinstance(photo, str):
-            valid_photos.append(photo)
     
+    # Список фотографий уже приведен к списку строк при загрузке каталога (models.Car)
+    valid_photos = car.photos
     total_photos = len(valid_photos)
     
     # Проверяем корректность индекса фотографии
     if photo_index >= total_photos:
         photo_index = 0
     
-    caption = f"""*{car['brand']} {car['model']}*
-
-Год: {car['year']}
-Цена: *{car['price']:,} $*
-Цвет: {car.get('color', 'не указан')}
-Пробег: {car.get('mileage', 0):,} км
-Двигатель: {car['engine_type']}, {car.get('engine_volume', 0)} л
-КПП: {car['transmission']}
-Кузов: {car['body_type']}
-
-*{car.get('description', 'Описание отсутствует')}*
-
-Особенности:
-{chr(10).join(['• ' + f for f in car.get('features', [])])}"""
+    caption = captions.car_caption(car)
     
     # Определяем, является ли update callback_query
     query = update if hasattr(update, 'edit_message_media') else None
@@ -271,29 +426,18 @@ async def show_car(update, context: ContextTypes.DEFAULT_TYPE, index: int, photo
         
         # Проверяем, это локальный файл или URL
         if photo_path.startswith('http'):
-            # Это URL - скачиваем и сохраняем локально
+            # Это URL - скачиваем в фоне (JSON обновится после загрузки) и ждем ограниченное время
             logger.info(f"Обнаружен URL фото: {photo_path}, скачиваем...")
-            from utils import download_image_from_url
-            downloaded_filename = download_image_from_url(photo_path, car['id'], 1)
-            
+            download = downloader.download_image_from_url(photo_path, car.id, photo_index + 1)
+            try:
+                downloaded_filename = await asyncio.wait_for(asyncio.shield(download), DOWNLOAD_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                downloaded_filename = None
+
             if downloaded_filename:
-                # Обновляем данные в JSON
-                data = database.load_data()
-                for c in data.get("cars", []):
-                    if c.get("id") == car['id']:
-                        if isinstance(c.get('photos'), list):
-                            # Заменяем URL на локальный файл
-                            for i, p in enumerate(c['photos']):
-                                if p == photo_path:
-                                    c['photos'][i] = downloaded_filename
-                                    break
-                        database.save_data(data)
-                        logger.info(f"Обновлен JSON: URL заменен на {downloaded_filename}")
-                        break
-                
                 photo_source = os.path.join(PHOTOS_DIR, downloaded_filename)
             else:
-                # Не удалось скачать, используем placeholder
+                # Не удалось скачать (или загрузка еще идет), используем placeholder
                 logger.warning(f"Не удалось скачать изображение по URL: {photo_path}, используем placeholder")
                 photo_source = os.path.join(PHOTOS_DIR, "placeholder.jpg")
                 # Продолжаем с placeholder вместо возврата
@@ -305,78 +449,76 @@ async def show_car(update, context: ContextTypes.DEFAULT_TYPE, index: int, photo
                 photo_source = os.path.join(PHOTOS_DIR, "placeholder.jpg")
                 # Продолжаем с placeholder
         
-        logger.info(f"Отправка фото для автомобиля {car['id']}: {photo_source}")
-        
-        # Проверяем, есть ли сохраненный file_id для этого фото
-        photo_cache_key = f"photo_{car['id']}_{photo_index}"
-        cached_file_id = context.bot_data.get(photo_cache_key)
-        
-        try:
-            # Всегда отправляем новое сообщение с фото
-            if cached_file_id:
-                # Используем кэшированный file_id для быстрой отправки
-                result = await context.bot.send_photo(
-                    chat_id=query.message.chat_id if query else update.message.chat_id,
-                    photo=cached_file_id,
-                    caption=caption,
-                    parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=keyboards.get_car_navigation_keyboard(index, len(cars), photo_index, total_photos)
-                )
-            else:
-                # Открываем файл и отправляем
-                with open(photo_source, 'rb') as photo_file:
-                    result = await (query.message.reply_photo if query else update.message.reply_photo)(
-                        photo=photo_file,
-                        caption=caption,
-                        parse_mode=ParseMode.MARKDOWN,
-                        reply_markup=keyboards.get_car_navigation_keyboard(index, len(cars), photo_index, total_photos)
-                    )
-                    # Сохраняем file_id для будущего использования
-                    if result.photo:
-                        context.bot_data[photo_cache_key] = result.photo[-1].file_id
-        except Exception as e:
-            # Если отправка фото не удалась, отправляем текст
-            logger.error(f"Ошибка отправки фото {photo_source}: {e}")
-            text_message = await (query.message.reply_text if query else update.message.reply_text)(
-                caption, 
-                parse_mode=ParseMode.MARKDOWN, 
-                reply_markup=keyboards.get_car_navigation_keyboard(index, len(cars), photo_index, total_photos)
-            )
+        logger.info(f"Отправка фото для автомобиля {car.id}: {photo_source}")
+        reply_markup = keyboards.get_car_navigation_keyboard(index, total_cars, photo_index, total_photos)
     else:
         # Если фото нет, используем placeholder для плавного переключения
-        logger.info(f"У автомобиля {car['id']} нет фото, используем placeholder")
+        logger.info(f"У автомобиля {car.id} нет фото, используем placeholder")
         photo_source = os.path.join(PHOTOS_DIR, "placeholder.jpg")
-        photo_cache_key = f"photo_placeholder"
-        cached_file_id = context.bot_data.get(photo_cache_key)
-        
-        try:
-            # Всегда отправляем новое сообщение с placeholder
-            if cached_file_id:
-                result = await context.bot.send_photo(
-                    chat_id=query.message.chat_id if query else update.message.chat_id,
-                    photo=cached_file_id,
+        reply_markup = keyboards.get_car_navigation_keyboard(index, total_cars, 0, 0)
+
+    if edit and query and NAVIGATION_EDIT_IN_PLACE:
+        if await _edit_car_photo(query, photo_source, caption, reply_markup):
+            return
+
+    # Проверяем, есть ли сохраненный file_id для этого фото
+    cached_file_id = photo_cache.get_file_id(photo_source)
+
+    try:
+        if cached_file_id:
+            # Используем кэшированный file_id для быстрой отправки
+            await context.bot.send_photo(
+                chat_id=query.message.chat_id if query else update.message.chat_id,
+                photo=cached_file_id,
+                caption=caption,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=reply_markup
+            )
+        else:
+            # Открываем файл и отправляем
+            with open(photo_source, 'rb') as photo_file:
+                result = await (query.message.reply_photo if query else update.message.reply_photo)(
+                    photo=photo_file,
                     caption=caption,
                     parse_mode=ParseMode.MARKDOWN,
-                    reply_markup=keyboards.get_car_navigation_keyboard(index, len(cars), 0, 0)
+                    reply_markup=reply_markup
                 )
-            else:
-                with open(photo_source, 'rb') as photo_file:
-                    result = await (query.message.reply_photo if query else update.message.reply_photo)(
-                        photo=photo_file,
-                        caption=caption,
-                        parse_mode=ParseMode.MARKDOWN,
-                        reply_markup=keyboards.get_car_navigation_keyboard(index, len(cars), 0, 0)
-                    )
-                    if result.photo:
-                        context.bot_data[photo_cache_key] = result.photo[-1].file_id
-        except Exception as e:
-            # Если отправка фото не удалась, отправляем текст
-            logger.error(f"Ошибка отправки placeholder: {e}")
-            await (query.message.reply_text if query else update.message.reply_text)(
-                caption, 
-                parse_mode=ParseMode.MARKDOWN, 
-                reply_markup=keyboards.get_car_navigation_keyboard(index, len(cars), 0, 0)
-            )
+                # Сохраняем file_id для будущего использования
+                if result.photo:
+                    await asyncio.to_thread(photo_cache.remember_file_id, photo_source, result.photo[-1].file_id)
+    except Exception as e:
+        # Если отправка фото не удалась, отправляем текст
+        logger.error(f"Ошибка отправки фото {photo_source}: {e}")
+        await (query.message.reply_text if query else update.message.reply_text)(
+            caption,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=reply_markup
+        )
+
+async def _edit_car_photo(query, photo_source, caption, reply_markup):
+    """Замена фото и подписи в текущем сообщении; False, если редактирование невозможно"""
+    if not query.message or not query.message.photo:
+        return False
+
+    cached_file_id = photo_cache.get_file_id(photo_source)
+    try:
+        if cached_file_id:
+            media = InputMediaPhoto(cached_file_id, caption=caption, parse_mode=ParseMode.MARKDOWN)
+            await query.edit_message_media(media, reply_markup=reply_markup)
+        else:
+            with open(photo_source, 'rb') as photo_file:
+                media = InputMediaPhoto(photo_file, caption=caption, parse_mode=ParseMode.MARKDOWN)
+            result = await query.edit_message_media(media, reply_markup=reply_markup)
+            if isinstance(result, Message) and result.photo:
+                await asyncio.to_thread(photo_cache.remember_file_id, photo_source, result.photo[-1].file_id)
+        return True
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return True
+        logger.warning(f"Не удалось отредактировать фото, отправляем новое сообщение: {e}")
+    except Exception as e:
+        logger.warning(f"Не удалось отредактировать фото, отправляем новое сообщение: {e}")
+    return False
 
 # Состояния для заявок
 NAME, PHONE, PREFERENCES = range(3)
@@ -387,10 +529,9 @@ async def start_application(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Проверяем, есть ли информация о выбранном автомобиле
     if query.data.startswith('create_application_'):
-        car_index = int(query.data.split('_')[2])
-        cars = context.user_data.get('current_cars', [])
-        if cars and car_index < len(cars):
-            context.user_data['selected_car'] = cars[car_index]
+        car, _, _ = _resolve_car(context, int(query.data.split('_')[2]))
+        if car:
+            context.user_data['selected_car'] = car
 
     await safe_edit_message_text(query, "Оставить заявку\n\nПожалуйста, укажите ваше имя:", reply_markup=keyboards.get_application_cancel())
     return NAME
@@ -410,20 +551,23 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return PREFERENCES
 
 async def send_application_to_admin(bot, user, app_data):
-    """Отправка заявки всем админам"""
-    # Формируем сообщение для админа
+    """Постановка заявки в очередь отправки всем админам (см. outbox).
+
+    Возвращает True, когда заявка надежно записана; сама отправка идет в фоне.
+    """
+    # Формируем сообщение для админа; текст клиента экранируется, чтобы не ломать Markdown
     preferences = app_data.get('application_preferences', 'не указано')
 
     application_text = f"""Новая заявка от клиента
 
-Имя клиента: {app_data['application_name']}
-Телефон: {app_data['application_phone']}
-Комментарий: {preferences}
+Имя клиента: {escape_markdown(app_data['application_name'])}
+Телефон: {escape_markdown(app_data['application_phone'])}
+Комментарий: {escape_markdown(preferences)}
 
 ━━━━━━━━━━━━━━━━━━━━
 Telegram профиль:
-• Имя: {user.first_name} {user.last_name or ''}
-• Username: @{user.username or 'не указан'}
+• Имя: {escape_markdown(user.first_name)} {escape_markdown(user.last_name or '')}
+• Username: @{escape_markdown(user.username or 'не указан')}
 • ID: `{user.id}`"""
 
     # Добавляем информацию о выбранном автомобиле, если есть
@@ -433,37 +577,25 @@ Telegram профиль:
 
 ━━━━━━━━━━━━━━━━━━━━
 Интересующий автомобиль:
-• Марка/Модель: {selected_car.get('brand')} {selected_car.get('model')}
-• Год: {selected_car.get('year')}
-• Цена: {selected_car.get('price', 0):,} $
-• Кузов: {selected_car.get('body_type')}
-• Двигатель: {selected_car.get('engine_type')}, {selected_car.get('engine_volume')} л
-• КПП: {selected_car.get('transmission')}
-• Цвет: {selected_car.get('color', 'не указан')}
-• Пробег: {selected_car.get('mileage', 0):,} км"""
-
-    # Отправляем уведомление всем админам
-    success_count = 0
-    for admin_id in ADMIN_IDS:
-        admin_id = admin_id.strip()
-        try:
-            admin_id_int = int(admin_id)
-            await bot.send_message(
-                chat_id=admin_id_int,
-                text=application_text,
-                parse_mode=ParseMode.MARKDOWN
-            )
-            logger.info(f"Заявка успешно отправлена админу {admin_id_int}")
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Ошибка отправки заявки админу {admin_id}: {e}")
+{escape_markdown(captions.car_summary(selected_car))}"""
 
-    if success_count > 0:
-        return True
-    else:
+    try:
+        return await outbox.enqueue_lead(bot, application_text, ADMIN_IDS) is not None
+    except Exception as e:
+        logger.error(f"Не удалось записать заявку в очередь: {e}")
         logger.info(f"ЗАЯВКА (не доставлена): {application_text}")
         return False
 
+def _application_reply(queued):
+    """Ответ клиенту после отправки заявки"""
+    if queued:
+        return ("Спасибо за вашу заявку!\n\n"
+                "Наш менеджер свяжется с вами в ближайшее время для уточнения деталей.\n\n"
+                "Хорошего дня!")
+    phone = database.get_catalog().get("contacts", {}).get("phone")
+    return ("Не удалось отправить заявку, попробуйте еще раз позже."
+            + (f"\n\nИли позвоните нам: {phone}" if phone else ""))
+
 async def get_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
     preferences = update.message.text
     context.user_data['application_preferences'] = preferences
@@ -473,14 +605,11 @@ async def get_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
     app_data = context.user_data
 
     # Отправляем заявку админу
-    await send_application_to_admin(context.bot, user, app_data)
+    queued = await send_application_to_admin(context.bot, user, app_data)
 
     # Отправляем подтверждение клиенту
     await update.message.reply_text(
-        "Спасибо за вашу заявку!\n\n"
-        "Наш менеджер свяжется с вами в ближайшее время для уточнения деталей.\n\n"
-        "Хорошего дня!",
-        parse_mode=ParseMode.MARKDOWN,
+        _application_reply(queued),
         reply_markup=keyboards.get_main_menu()
     )
 
@@ -504,14 +633,11 @@ async def skip_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Клиент {user.first_name} пропустил комментарий")
 
     # Отправляем заявку админу
-    await send_application_to_admin(context.bot, user, app_data)
+    queued = await send_application_to_admin(context.bot, user, app_data)
 
     # Отправляем подтверждение клиенту
     await query.message.reply_text(
-        "Спасибо за вашу заявку!\n\n"
-        "Наш менеджер свяжется с вами в ближайшее время для уточнения деталей.\n\n"
-        "Хорошего дня!",
-        parse_mode=ParseMode.MARKDOWN,
+        _application_reply(queued),
         reply_markup=keyboards.get_main_menu()
     )
 
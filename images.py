@@ -0,0 +1,95 @@
+"""
+Подготовка фотографий для Telegram: уменьшение, пережатие и удаление метаданных
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from config import (
+    PHOTO_MAX_EDGE, PHOTO_QUALITY, PHOTO_FORMAT, KEEP_ORIGINAL_PHOTOS, ORIGINALS_DIR, IMAGE_WORKERS
+)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+_state = {"pool": None}
+
+def output_extension(extension):
+    """Расширение, которое получит файл с расширением extension после optimize_image.
+
+    Имя нового фото резервируется сразу с ним, чтобы обработка не меняла расширение
+    и не заменяла другой файл с тем же именем.
+    """
+    if Image is None:
+        return extension
+    return _EXTENSIONS.get(PHOTO_FORMAT, ".jpg")
+
+def optimize_image(filepath):
+    """Заменяет файл уменьшенной копией без метаданных, возвращает путь к результату.
+
+    Длинная сторона ограничивается PHOTO_MAX_EDGE, расширение файла меняется
+    под PHOTO_FORMAT. Исходник переносится в ORIGINALS_DIR, если включено
+    KEEP_ORIGINAL_PHOTOS, иначе удаляется.
+    """
+    if Image is None:
+        logger.warning("Pillow не установлен, фото сохраняется без обработки")
+        return filepath
+
+    target = os.path.splitext(filepath)[0] + _EXTENSIONS.get(PHOTO_FORMAT, ".jpg")
+    tmp_path = f"{target}.tmp"
+    with Image.open(filepath) as source:
+        # Исходник уже подходящего размера, формата и без метаданных пережимать незачем,
+        # если это не уменьшит файл
+        already_clean = (source.format == PHOTO_FORMAT and max(source.size) <= PHOTO_MAX_EDGE
+                         and not source.info.get("exif") and not source.info.get("icc_profile"))
+        # Поворот по EXIF применяем до того, как метаданные будут отброшены
+        img = ImageOps.exif_transpose(source)
+        img.thumbnail((PHOTO_MAX_EDGE, PHOTO_MAX_EDGE), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(tmp_path, format=PHOTO_FORMAT, quality=PHOTO_QUALITY, optimize=True)
+
+    if already_clean and filepath == target and os.path.getsize(tmp_path) >= os.path.getsize(filepath):
+        os.remove(tmp_path)
+        return filepath
+
+    if KEEP_ORIGINAL_PHOTOS:
+        os.makedirs(ORIGINALS_DIR, exist_ok=True)
+        shutil.move(filepath, os.path.join(ORIGINALS_DIR, os.path.basename(filepath)))
+    elif filepath != target:
+        os.remove(filepath)
+    os.replace(tmp_path, target)
+
+    logger.info(f"Фото обработано: {filepath} -> {target} ({os.path.getsize(target)} байт)")
+    return target
+
+def _get_pool():
+    """Пул процессов для обработки изображений (создается при первом использовании)"""
+    if _state["pool"] is None:
+        _state["pool"] = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _state["pool"]
+
+async def optimize_image_async(filepath):
+    """optimize_image в пуле процессов; при ошибке возвращается исходный путь"""
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_get_pool(), optimize_image, filepath)
+    except Exception as e:
+        logger.error(f"Ошибка обработки фото {filepath}: {e}")
+        return filepath
+
+def shutdown():
+    """Остановка пула процессов"""
+    if _state["pool"] is not None:
+        _state["pool"].shutdown(cancel_futures=True)
+        _state["pool"] = None
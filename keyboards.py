@@ -1,20 +1,70 @@
 """
 Клавиатуры и меню для телеграм бота
 """
+from collections import OrderedDict
+from functools import wraps
 from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
 import database
-from config import BRANDS, BODY_TYPES, ENGINE_TYPES, TRANSMISSIONS, PRICE_RANGES
-
+from config import (
+    BRANDS, BODY_TYPES, ENGINE_TYPES, TRANSMISSIONS, PRICE_RANGES, KEYBOARD_CACHE_SIZE, SORT_MODES, CARS_PER_PAGE
+)
+from utils import format_range
+
+# Готовые клавиатуры неизменяемы, поэтому одну и ту же разметку можно отдавать
+# повторно, пока не изменилась версия каталога или аргументы
+_keyboard_cache = OrderedDict()
+_keyboard_cache_stats = {"hits": 0, "misses": 0}
+
+def _freeze(value):
+    """Приведение аргументов к хешируемому виду (словарь фильтров -> кортеж пар)"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items() if v))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def cached_keyboard(func):
+    """Мемоизация клавиатуры по версии каталога и аргументам с LRU-вытеснением"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, database.get_catalog_version(), _freeze(args), _freeze(kwargs))
+        markup = _keyboard_cache.get(key)
+        if markup is not None:
+            _keyboard_cache.move_to_end(key)
+            _keyboard_cache_stats["hits"] += 1
+            return markup
+
+        _keyboard_cache_stats["misses"] += 1
+        markup = func(*args, **kwargs)
+        _keyboard_cache[key] = markup
+        if len(_keyboard_cache) > KEYBOARD_CACHE_SIZE:
+            _keyboard_cache.popitem(last=False)
+        return markup
+    return wrapper
+
+def get_keyboard_cache_stats():
+    """Статистика кэша клавиатур: попадания, промахи и текущий размер"""
+    return {**_keyboard_cache_stats, "size": len(_keyboard_cache), "maxsize": KEYBOARD_CACHE_SIZE}
+
+def clear_keyboard_cache():
+    """Очистка кэша клавиатур и статистики"""
+    _keyboard_cache.clear()
+    _keyboard_cache_stats.update(hits=0, misses=0)
+
+@cached_keyboard
 def get_main_menu():
     return ReplyKeyboardMarkup([["Каталог авто"], ["Контакты", "Помощь"]], resize_keyboard=True)
 
+@cached_keyboard
 def get_catalog_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Подбор по параметрам", callback_data="filter_params")],
         [InlineKeyboardButton("Смотреть все авто", callback_data="show_all")],
+        [InlineKeyboardButton("Поиск по названию", callback_data="search_start")],
         [InlineKeyboardButton("Назад в главное меню", callback_data="back_to_main_from_catalog")]
     ])
 
+@cached_keyboard
 def get_filters_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Марка", callback_data="filter_brand")],
@@ -22,115 +72,74 @@ def get_filters_menu():
         [InlineKeyboardButton("Тип двигателя", callback_data="filter_engine")],
         [InlineKeyboardButton("Коробка передач", callback_data="filter_transmission")],
         [InlineKeyboardButton("Цена", callback_data="filter_price")],
+        [InlineKeyboardButton("Год выпуска", callback_data="filter_range_year")],
+        [InlineKeyboardButton("Пробег", callback_data="filter_range_mileage")],
+        [InlineKeyboardButton("Объем двигателя", callback_data="filter_range_engine_volume")],
         [InlineKeyboardButton("Смотреть наличие", callback_data="check_availability")],
         [InlineKeyboardButton("Назад", callback_data="back_to_catalog")]
     ])
 
-def get_brands_keyboard():
-    """Динамическая клавиатура с марками из доступных автомобилей"""
-    data = database.load_data()
-    cars = [c for c in data.get("cars", []) if c.get("is_available", True)]
-
-    # Получаем уникальные марки из доступных автомобилей
-    available_brands = sorted(set(c.get('brand', '') for c in cars if c.get('brand')))
+def _facet_keyboard(field, prefix, fallback, filters=None):
+    """Клавиатура значений поля с количеством авто с учетом уже выбранных фильтров"""
+    counts = database.get_facet_counts(field, filters)
 
-    if not available_brands:
-        available_brands = BRANDS  # Fallback на все марки если нет авто
+    if counts:
+        kb = [[InlineKeyboardButton(f"{value} ({counts[value]})", callback_data=f"{prefix}{value}")]
+              for value in sorted(counts)]
+    elif filters and database.get_facet_counts(field):
+        kb = []  # При текущих фильтрах подходящих авто нет
+    else:
+        kb = [[InlineKeyboardButton(value, callback_data=f"{prefix}{value}")] for value in fallback]  # Fallback если нет авто
 
-    kb = [[InlineKeyboardButton(b, callback_data=f"select_brand_{b}")] for b in available_brands]
     kb.append([InlineKeyboardButton("Смотреть наличие", callback_data="check_availability")])
     kb.append([InlineKeyboardButton("Назад", callback_data="back_to_filters")])
     return InlineKeyboardMarkup(kb)
 
-def get_body_types_keyboard():
-    """Динамическая клавиатура с типами кузова из доступных автомобилей"""
-    data = database.load_data()
-    cars = [c for c in data.get("cars", []) if c.get("is_available", True)]
-
-    # Получаем уникальные типы кузова из доступных автомобилей
-    available_bodies = sorted(set(c.get('body_type', '') for c in cars if c.get('body_type')))
-
-    if not available_bodies:
-        available_bodies = BODY_TYPES  # Fallback
+@cached_keyboard
+def get_brands_keyboard(filters=None):
+    """Динамическая клавиатура с марками из доступных автомобилей"""
+    return _facet_keyboard('brand', "select_brand_", BRANDS, filters)
 
-    kb = [[InlineKeyboardButton(b, callback_data=f"select_body_{b}")] for b in available_bodies]
-    kb.append([InlineKeyboardButton("Смотреть наличие", callback_data="check_availability")])
-    kb.append([InlineKeyboardButton("Назад", callback_data="back_to_filters")])
-    return InlineKeyboardMarkup(kb)
+@cached_keyboard
+def get_body_types_keyboard(filters=None):
+    """Динамическая клавиатура с типами кузова из доступных автомобилей"""
+    return _facet_keyboard('body_type', "select_body_", BODY_TYPES, filters)
 
-def get_engine_types_keyboard():
+@cached_keyboard
+def get_engine_types_keyboard(filters=None):
     """Динамическая клавиатура с типами двигателя из доступных автомобилей"""
-    data = database.load_data()
-    cars = [c for c in data.get("cars", []) if c.get("is_available", True)]
-
-    # Получаем уникальные типы двигателя из доступных автомобилей
-    available_engines = sorted(set(c.get('engine_type', '') for c in cars if c.get('engine_type')))
-
-    if not available_engines:
-        available_engines = ENGINE_TYPES  # Fallback
-
-    kb = [[InlineKeyboardButton(e, callback_data=f"select_engine_{e}")] for e in available_engines]
-    kb.append([InlineKeyboardButton("Смотреть наличие", callback_data="check_availability")])
-    kb.append([InlineKeyboardButton("Назад", callback_data="back_to_filters")])
-    return InlineKeyboardMarkup(kb)
+    return _facet_keyboard('engine_type', "select_engine_", ENGINE_TYPES, filters)
 
-def get_transmission_keyboard():
+@cached_keyboard
+def get_transmission_keyboard(filters=None):
     """Динамическая клавиатура с типами КПП из доступных автомобилей"""
-    data = database.load_data()
-    cars = [c for c in data.get("cars", []) if c.get("is_available", True)]
-
-    # Получаем уникальные типы КПП из доступных автомобилей
-    available_transmissions = sorted(set(c.get('transmission', '') for c in cars if c.get('transmission')))
-
-    if not available_transmissions:
-        available_transmissions = TRANSMISSIONS  # Fallback
-
-    kb = [[InlineKeyboardButton(t, callback_data=f"select_transmission_{t}")] for t in available_transmissions]
-    kb.append([InlineKeyboardButton("Смотреть наличие", callback_data="check_availability")])
-    kb.append([InlineKeyboardButton("Назад", callback_data="back_to_filters")])
-    return InlineKeyboardMarkup(kb)
-
-def get_price_ranges_keyboard():
-    """Динамическая клавиатура с ценовыми диапазонами"""
-    data = database.load_data()
-    cars = [c for c in data.get("cars", []) if c.get("is_available", True)]
-
-    if not cars:
-        # Если нет автомобилей, показываем все диапазоны
-        kb = [[InlineKeyboardButton(p, callback_data=f"select_price_{p}")] for p in PRICE_RANGES]
+    return _facet_keyboard('transmission', "select_transmission_", TRANSMISSIONS, filters)
+
+def _range_bound(value):
+    """Граница диапазона для callback_data (пустая строка - без ограничения)"""
+    return "" if value is None else str(value)
+
+@cached_keyboard
+def get_range_keyboard(field, filters=None):
+    """Клавиатура диапазонов числового поля с количеством авто с учетом уже выбранных фильтров"""
+    buckets = database.get_range_buckets(field, filters)
+
+    if buckets:
+        kb = [[InlineKeyboardButton(f"{format_range(field, lower, upper)} ({count})",
+                                    callback_data=f"select_range_{field}_{_range_bound(lower)}_{_range_bound(upper)}")]
+              for lower, upper, count in buckets]
+    elif field == 'price' and not database.get_range_buckets(field):
+        kb = [[InlineKeyboardButton(p, callback_data=f"select_price_{p}")] for p in PRICE_RANGES]  # Fallback если нет авто
     else:
-        # Определяем, какие диапазоны актуальны
-        prices = [c.get('price', 0) for c in cars if c.get('price')]
-        min_price = min(prices) if prices else 0
-        max_price = max(prices) if prices else 0
-
-        available_ranges = []
-        for price_range in PRICE_RANGES:
-            # Парсим диапазон
-            if "до" in price_range:
-                upper = int(price_range.split()[1].replace(',', ''))
-                if min_price <= upper:
-                    available_ranges.append(price_range)
-            elif "от" in price_range and "до" in price_range:
-                parts = price_range.split()
-                lower = int(parts[1].replace(',', ''))
-                upper = int(parts[3].replace(',', ''))
-                if not (max_price < lower or min_price > upper):
-                    available_ranges.append(price_range)
-            elif "от" in price_range:
-                lower = int(price_range.split()[1].replace(',', ''))
-                if max_price >= lower:
-                    available_ranges.append(price_range)
-
-        if not available_ranges:
-            available_ranges = PRICE_RANGES  # Fallback
-
-        kb = [[InlineKeyboardButton(p, callback_data=f"select_price_{p}")] for p in available_ranges]
+        kb = []  # При текущих фильтрах подходящих авто нет
 
+    if filters and field in (filters.get('ranges') or {}):
+        kb.append([InlineKeyboardButton("Любой", callback_data=f"select_range_{field}_any")])
     kb.append([InlineKeyboardButton("Смотреть наличие", callback_data="check_availability")])
     kb.append([InlineKeyboardButton("Назад", callback_data="back_to_filters")])
     return InlineKeyboardMarkup(kb)
 
+@cached_keyboard
 def get_availability_keyboard(count):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(f"Смотреть {count} авто", callback_data="view_available_cars")],
@@ -138,6 +147,7 @@ def get_availability_keyboard(count):
         [InlineKeyboardButton("Назад", callback_data="back_to_filters")]
     ])
 
+@cached_keyboard
 def get_car_navigation_keyboard(car_index, total_cars, photo_index=0, total_photos=1):
     kb = []
 
@@ -162,25 +172,61 @@ def get_car_navigation_keyboard(car_index, total_cars, photo_index=0, total_phot
         kb.append(nav)
 
     kb.extend([
-        [InlineKeyboardButton("Оставить заявку", callback_data=f"create_application_{car_index}")]
+        [InlineKeyboardButton("Оставить заявку", callback_data=f"create_application_{car_index}")],
+        [InlineKeyboardButton("К списку", callback_data=f"list_page_{car_index // CARS_PER_PAGE}")]
     ])
     return InlineKeyboardMarkup(kb)
 
+@cached_keyboard
+def get_results_page_keyboard(rows, page, total_pages, sort="default"):
+    """Страница списка: строка на автомобиль (открывает карточку), листание и сортировка.
+
+    rows - пары (позиция в выборке, текст строки).
+    """
+    kb = [[InlineKeyboardButton(text, callback_data=f"open_car_{index}")] for index, text in rows]
+
+    if total_pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀", callback_data=f"list_page_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data="current"))
+        if page < total_pages - 1:
+            nav.append(InlineKeyboardButton("▶", callback_data=f"list_page_{page + 1}"))
+        kb.append(nav)
+
+    kb.append([InlineKeyboardButton(f"Сортировка: {SORT_MODES[sort][0]}", callback_data="sort_menu")])
+    kb.append([InlineKeyboardButton("Назад", callback_data="back_to_catalog")])
+    return InlineKeyboardMarkup(kb)
+
+@cached_keyboard
+def get_sort_keyboard(current="default"):
+    """Выбор режима сортировки результатов"""
+    kb = [
+        [InlineKeyboardButton(("✓ " if mode == current else "") + label, callback_data=f"set_sort_{mode}")]
+        for mode, (label, _, _) in SORT_MODES.items()
+    ]
+    kb.append([InlineKeyboardButton("Назад", callback_data="list_page_0")])
+    return InlineKeyboardMarkup(kb)
+
+@cached_keyboard
 def get_contacts_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Оставить заявку", callback_data="create_application")],
         [InlineKeyboardButton("Назад", callback_data="back_to_main")]
     ])
 
+@cached_keyboard
 def get_application_cancel():
     return InlineKeyboardMarkup([[InlineKeyboardButton("Отмена", callback_data="cancel_application")]])
 
+@cached_keyboard
 def get_application_skip():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("Пропустить", callback_data="skip_preferences")],
         [InlineKeyboardButton("Отмена", callback_data="cancel_application")]
     ])
 
+@cached_keyboard
 def get_admin_menu():
     """Меню админ-панели"""
     return InlineKeyboardMarkup([
@@ -188,5 +234,14 @@ def get_admin_menu():
         [InlineKeyboardButton("Список автомобилей", callback_data="admin_list_cars")],
         [InlineKeyboardButton("Удалить автомобиль", callback_data="admin_delete_car")],
         [InlineKeyboardButton("Управление фото", callback_data="admin_manage_photos")],
+        [InlineKeyboardButton("Недоставленные заявки", callback_data="admin_outbox")],
         [InlineKeyboardButton("Выход", callback_data="admin_exit")]
     ])
+
+def get_outbox_keyboard():
+    """Действия с недоставленными заявками"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Повторить отправку", callback_data="admin_outbox_retry")],
+        [InlineKeyboardButton("Получить здесь и удалить", callback_data="admin_outbox_drain")],
+        [InlineKeyboardButton("⬅️ Назад", callback_data="admin_back")]
+    ])
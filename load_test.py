@@ -0,0 +1,104 @@
+"""
+Нагрузочный тест обработки обновлений: задержка ответа при N одновременных пользователях
+
+Обновления подаются прямо в очередь Application, без обращения к Telegram.
+Обработчик имитирует работу бота: обычно отвечает быстро, но часть запросов
+"медленные" (отправка фото, скачивание файла). Тест сравнивает последовательную
+обработку с ChatOrderedUpdateProcessor и проверяет, что обновления каждого чата
+обработаны строго в порядке отправки.
+
+Запуск: python load_test.py --users 100 --messages 3 --concurrency 16
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from telegram import Chat, Message, Update, User
+from telegram.ext import Application, ExtBot, MessageHandler, filters
+from config import UPDATE_CONCURRENCY
+from update_processor import ChatOrderedUpdateProcessor
+
+class OfflineBot(ExtBot):
+    """Бот без сетевых запросов: get_me возвращает фиктивного пользователя"""
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(1, "Load test", True, username="load_test_bot")
+        return self._bot_user
+
+def percentile(values, share):
+    """Перцентиль по отсортированному списку (ближайший ранг)"""
+    return values[min(len(values) - 1, max(0, round(share * len(values)) - 1))]
+
+async def run(args, concurrency):
+    """Прогон теста; возвращает отсортированные задержки в секундах и время прогона"""
+    builder = Application.builder().bot(OfflineBot("0:load-test")).updater(None)
+    if concurrency > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(concurrency))
+    app = builder.build()
+
+    rng = random.Random(args.seed)
+    sent = {}
+    latencies = []
+    seen = {}
+    done = asyncio.Event()
+    total = args.users * args.messages
+
+    async def handle(update, context):
+        seen.setdefault(update.effective_chat.id, []).append(int(update.message.text))
+        slow = rng.random() < args.slow_share
+        await asyncio.sleep(args.slow if slow else args.fast)
+        latencies.append(time.perf_counter() - sent[update.update_id])
+        if len(latencies) == total:
+            done.set()
+
+    app.add_handler(MessageHandler(filters.TEXT, handle))
+
+    async def user(user_id):
+        tg_user = User(user_id, f"user{user_id}", False)
+        chat = Chat(user_id, Chat.PRIVATE)
+        for number in range(args.messages):
+            await asyncio.sleep(rng.uniform(0, args.think))
+            update_id = user_id * args.messages + number
+            message = Message(number, datetime.now(timezone.utc), chat, from_user=tg_user, text=str(number))
+            sent[update_id] = time.perf_counter()
+            await app.update_queue.put(Update(update_id, message=message))
+
+    async with app:
+        await app.start()
+        started = time.perf_counter()
+        await asyncio.gather(*(user(user_id) for user_id in range(1, args.users + 1)))
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+        await app.stop()
+
+    for chat_id, numbers in seen.items():
+        assert numbers == sorted(numbers), f"Нарушен порядок обновлений в чате {chat_id}: {numbers}"
+    return sorted(latencies), elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100, help="число одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=3, help="обновлений от каждого пользователя")
+    parser.add_argument("--concurrency", type=int, default=UPDATE_CONCURRENCY, help="параллельных обработок")
+    parser.add_argument("--fast", type=float, default=0.005, help="время обычного ответа, с")
+    parser.add_argument("--slow", type=float, default=0.5, help="время медленного ответа, с")
+    parser.add_argument("--slow-share", type=float, default=0.05, help="доля медленных ответов")
+    parser.add_argument("--think", type=float, default=0.2, help="максимальная пауза между сообщениями пользователя, с")
+    parser.add_argument("--timeout", type=float, default=600, help="ограничение времени прогона, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--skip-sequential", action="store_true", help="не запускать последовательный прогон")
+    args = parser.parse_args()
+
+    modes = [("последовательно", 1)] if not args.skip_sequential else []
+    modes.append((f"параллельно ({args.concurrency})", args.concurrency))
+    print(f"Пользователей: {args.users}, обновлений: {args.users * args.messages}")
+    print(f"{'режим':<22}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}{'обн/с':>10}")
+    for name, concurrency in modes:
+        latencies, elapsed = asyncio.run(run(args, concurrency))
+        row = [percentile(latencies, share) * 1000 for share in (0.5, 0.95, 0.99)] + [latencies[-1] * 1000]
+        print(f"{name:<22}" + "".join(f"{value:>10.0f}" for value in row) + f"{len(latencies) / elapsed:>10.0f}")
+    print("Порядок обновлений внутри каждого чата сохранен")
+
+if __name__ == "__main__":
+    main()
@@ -17,18 +17,30 @@ from telegram import error as telegram_error
 from telegram.constants import ParseMode
 
 # Импорты из модулей
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN, PHOTO_WARMUP_CHAT_ID, PHOTO_WARMUP_CONCURRENCY, UPDATE_CONCURRENCY,
+    UPDATE_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS
+)
+from update_processor import ChatOrderedUpdateProcessor
 from utils import ensure_photos_dir
+from persistence import create_persistence
+import photo_cache
+import downloader
+import images
+import outbox
 from handlers import (
     start, help_command, show_catalog, show_contacts,
-    filter_brand, filter_body, filter_engine, filter_transmission, filter_price,
+    filter_brand, filter_body, filter_engine, filter_transmission, filter_price, filter_range,
     handle_filter_selection, check_availability, view_available_cars, new_search,
     handle_car_navigation, back_to_main, back_to_main_from_catalog, back_to_filters,
     start_application, get_name, get_phone, get_preferences, skip_preferences, cancel_application,
-    show_all_cars, show_filter_params, show_car
+    show_all_cars, show_filter_params, show_car,
+    handle_results_page, open_car, show_sort_menu, set_sort,
+    search_command, search_start, get_search_query, cancel_search
 )
 from admin import (
-    admin_command, admin_menu_handler, admin_delete_car_handler,
+    admin_command, admin_menu_handler, admin_outbox_handler, admin_delete_car_handler,
     admin_photos_handler, admin_delete_photo_handler, admin_delete_photo_confirm,
     admin_add_photo_handler, admin_photo_received,
     admin_add_car_brand, admin_add_car_model, admin_add_car_year, admin_add_car_price,
@@ -41,15 +53,44 @@ from admin import (
 )
 
 # Импорты состояний для ConversationHandler
-from handlers import NAME, PHONE, PREFERENCES
+from handlers import NAME, PHONE, PREFERENCES, SEARCH
 
 logger = logging.getLogger(__name__)
 
-def main():
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN не установлен!")
-        return
-    app = Application.builder().token(BOT_TOKEN).build()
+def build_application(persistence=None, updater=True, warm_up=True):
+    """Application со всеми обработчиками.
+
+    persistence - хранилище состояния (user_data, состояния диалогов); updater=False -
+    без получения обновлений (их подает cluster.py); warm_up - запускать предзагрузку фото.
+    """
+    async def post_init(application: Application):
+        """Отправка заявок из очереди и фоновая предзагрузка фото, чтобы клиенты сразу получали кэшированные file_id"""
+        outbox.start(application.bot)
+        if warm_up and PHOTO_WARMUP_CHAT_ID:
+            application.create_task(
+                photo_cache.warm_up(application.bot, PHOTO_WARMUP_CHAT_ID, PHOTO_WARMUP_CONCURRENCY)
+            )
+
+    async def post_stop(application: Application):
+        """Остановка очереди заявок, пока бот еще может дослать начатые отправки"""
+        await outbox.stop()
+
+    async def post_shutdown(application: Application):
+        """Закрытие пула соединений загрузчика фото и пула обработки изображений"""
+        await downloader.close()
+        images.shutdown()
+
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if UPDATE_CONCURRENCY > 1:
+        # Разные чаты обрабатываются параллельно, обновления одного чата - по порядку
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    # Состояния диалогов сохраняются, только если подключено хранилище
+    persistent = persistence is not None
 
     # Основные команды
     app.add_handler(CommandHandler("start", start))
@@ -68,11 +109,16 @@ def main():
     app.add_handler(CallbackQueryHandler(filter_engine, pattern="^filter_engine$"))
     app.add_handler(CallbackQueryHandler(filter_transmission, pattern="^filter_transmission$"))
     app.add_handler(CallbackQueryHandler(filter_price, pattern="^filter_price$"))
+    app.add_handler(CallbackQueryHandler(filter_range, pattern="^filter_range_"))
     app.add_handler(CallbackQueryHandler(handle_filter_selection, pattern="^select_"))
     app.add_handler(CallbackQueryHandler(check_availability, pattern="^check_availability$"))
     app.add_handler(CallbackQueryHandler(view_available_cars, pattern="^view_available_cars$"))
     app.add_handler(CallbackQueryHandler(new_search, pattern="^new_search$"))
     app.add_handler(CallbackQueryHandler(handle_car_navigation, pattern="^(prev_|next_|photo_prev_|photo_next_)"))
+    app.add_handler(CallbackQueryHandler(handle_results_page, pattern="^list_page_\\d+$"))
+    app.add_handler(CallbackQueryHandler(open_car, pattern="^open_car_\\d+$"))
+    app.add_handler(CallbackQueryHandler(show_sort_menu, pattern="^sort_menu$"))
+    app.add_handler(CallbackQueryHandler(set_sort, pattern="^set_sort_"))
     app.add_handler(CallbackQueryHandler(show_catalog, pattern="^back_to_catalog$"))
     app.add_handler(CallbackQueryHandler(back_to_main, pattern="^back_to_main$"))
     app.add_handler(CallbackQueryHandler(back_to_main_from_catalog, pattern="^back_to_main_from_catalog$"))
@@ -90,10 +136,29 @@ def main():
             ],
         },
         fallbacks=[CallbackQueryHandler(cancel_application, pattern="^cancel_application$")],
-        per_message=False
+        per_message=False,
+        name="application",
+        persistent=persistent
     )
     app.add_handler(app_handler)
 
+    # ConversationHandler для поиска по тексту
+    search_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("search", search_command),
+            CallbackQueryHandler(search_start, pattern="^search_start$")
+        ],
+        states={
+            SEARCH: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_search_query)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_search)],
+        allow_reentry=True,
+        per_message=False,
+        name="search",
+        persistent=persistent
+    )
+    app.add_handler(search_handler)
+
     # ConversationHandler для добавления автомобиля
     async def admin_add_car_start(update: Update, context):
         """Начало добавления автомобиля"""
@@ -133,7 +198,9 @@ def main():
             ADMIN_FEATURES: [MessageHandler(filters.TEXT, admin_add_car_features)],
         },
         fallbacks=[CallbackQueryHandler(admin_cancel, pattern="^admin_cancel$")],
-        per_message=False
+        per_message=False,
+        name="admin_add_car",
+        persistent=persistent
     )
     app.add_handler(admin_car_handler)
 
@@ -144,13 +211,16 @@ def main():
             ADMIN_PHOTO: [MessageHandler(filters.PHOTO, admin_photo_received)],
         },
         fallbacks=[MessageHandler(filters.TEXT & filters.Regex("^/cancel$"), admin_cancel)],
-        per_message=False
+        per_message=False,
+        name="admin_add_photo",
+        persistent=persistent
     )
     app.add_handler(admin_photo_handler)
 
     # Админ-панель
     app.add_handler(CommandHandler("admin", admin_command))
-    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^admin_(list_cars|delete_car|manage_photos|exit|back)$"))
+    app.add_handler(CallbackQueryHandler(admin_menu_handler, pattern="^admin_(list_cars|delete_car|manage_photos|outbox|exit|back)$"))
+    app.add_handler(CallbackQueryHandler(admin_outbox_handler, pattern="^admin_outbox_(retry|drain)$"))
     app.add_handler(CallbackQueryHandler(admin_delete_car_handler, pattern="^admin_delete_\\d+$"))
     app.add_handler(CallbackQueryHandler(admin_photos_handler, pattern="^admin_photos_\\d+$"))
     app.add_handler(CallbackQueryHandler(admin_delete_photo_handler, pattern="^admin_delete_photo$"))
@@ -180,11 +250,36 @@ def main():
                 pass
 
     app.add_error_handler(error_handler)
+    return app
+
+def main():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN не установлен!")
+        return
 
+    app = build_application(persistence=create_persistence())
     ensure_photos_dir()
-    logger.info("Бот запускается...")
     try:
-        app.run_polling()
+        if UPDATE_MODE == "webhook":
+            if not WEBHOOK_URL:
+                logger.error("UPDATE_MODE=webhook, но WEBHOOK_URL не установлен!")
+                return
+            logger.info(f"Бот запускается в режиме webhook на {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+            # Сервер PTB проверяет заголовок X-Telegram-Bot-Api-Secret-Token и по SIGINT/SIGTERM
+            # перестает принимать запросы, дорабатывает полученные обновления и вызывает post_shutdown.
+            # Webhook при остановке не удаляется: остальные экземпляры продолжают принимать обновления
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET_TOKEN,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            logger.info("Бот запускается...")
+            app.run_polling()
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
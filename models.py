@@ -0,0 +1,102 @@
+"""
+Модель автомобиля каталога
+"""
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Поля автомобиля: тип и значение по умолчанию (для списков - фабрика)
+FIELD_TYPES = {
+    'id': (int, 0),
+    'brand': (str, ''),
+    'model': (str, ''),
+    'year': (int, 0),
+    'price': (int, 0),
+    'body_type': (str, ''),
+    'engine_type': (str, ''),
+    'engine_volume': (float, 0.0),
+    'transmission': (str, ''),
+    'color': (str, ''),
+    'mileage': (int, 0),
+    'description': (str, ''),
+    'features': (list, list),
+    'photos': (list, list),
+    'is_available': (bool, True),
+}
+FIELDS = tuple(FIELD_TYPES)
+
+def _convert(field, value, car_id):
+    """Приведение значения поля к его типу; некорректное значение заменяется значением по умолчанию"""
+    kind, default = FIELD_TYPES[field]
+    if value is None:
+        return default() if callable(default) else default
+    try:
+        if kind is list:
+            # Одиночная строка (например, photos: "car_1_1.jpg") становится списком
+            items = [value] if isinstance(value, str) else list(value)
+            return [item for item in items if isinstance(item, str)]
+        if kind is int and isinstance(value, str):
+            return int(float(value.replace(' ', '').replace(',', '.')))
+        if kind is float and isinstance(value, str):
+            return float(value.replace(',', '.'))
+        return kind(value)
+    except (TypeError, ValueError):
+        logger.warning(f"Автомобиль {car_id}: некорректное значение {field}={value!r}, используется значение по умолчанию")
+        return default() if callable(default) else default
+
+class Car:
+    """Автомобиль каталога с типизированными полями.
+
+    Создается один раз при загрузке каталога. Объекты из каталога общие для всех
+    обработчиков и не изменяются; для изменения берется copy() (см. database.mutate_car).
+    Поля, которых нет в модели, сохраняются в extra и записываются обратно без изменений.
+    """
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, **fields):
+        car_id = fields.get('id')
+        for field in FIELDS:
+            setattr(self, field, _convert(field, fields.get(field), car_id))
+        self.extra = {key: value for key, value in fields.items() if key not in FIELD_TYPES}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Автомобиль из записи хранилища"""
+        return cls(**data)
+
+    def to_dict(self):
+        """Запись для хранилища (JSON)"""
+        data = {field: getattr(self, field) for field in FIELDS}
+        data['features'] = list(self.features)
+        data['photos'] = list(self.photos)
+        data.update(copy.deepcopy(self.extra))
+        return data
+
+    def copy(self):
+        """Независимая копия для изменения"""
+        return copy.deepcopy(self)
+
+    def replace(self, fields):
+        """Новый автомобиль с измененными полями (поля - как в записи хранилища)"""
+        return Car.from_dict({**self.to_dict(), **fields})
+
+    @property
+    def title(self):
+        """Марка и модель"""
+        return f"{self.brand} {self.model}"
+
+    @property
+    def local_photos(self):
+        """Фотографии, сохраненные локально (без URL)"""
+        return [photo for photo in self.photos if not photo.startswith('http')]
+
+    def __eq__(self, other):
+        if not isinstance(other, Car):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Car(id={self.id}, {self.title!r}, price={self.price})"
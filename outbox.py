@@ -0,0 +1,304 @@
+"""
+Очередь исходящих заявок админам (OUTBOX_FILE)
+
+Заявка сначала записывается в SQLite (synchronous=FULL) - только после этого клиент
+видит подтверждение, поэтому сбой Telegram или перезапуск бота не теряет заявку.
+Для каждого админа хранится своя доставка: число попыток и время следующей.
+Новая заявка сразу отправляется всем админам одновременно (asyncio.gather) отдельной
+задачей, так что ответ клиенту не зависит от числа админов. Неудачные доставки
+повторяет фоновый диспетчер (start/stop): при 429 - через retry_after от Telegram,
+при других ошибках - с удваивающейся паузой. После OUTBOX_MAX_ATTEMPTS попыток или
+при постоянной ошибке (бот заблокирован, чат не найден) доставка становится
+недоставленной; такие заявки админ просматривает и повторяет в админ-панели.
+
+Перед отправкой доставка "арендуется" (время следующей попытки сдвигается на
+LEASE), поэтому несколько процессов (cluster.py) не отправляют одну заявку дважды,
+а доставки процесса, который упал во время отправки, повторит любой другой.
+"""
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+import sqlite_util
+from config import OUTBOX_FILE, OUTBOX_MAX_ATTEMPTS, OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX, OUTBOX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# На сколько секунд доставка закрепляется за процессом, который ее отправляет
+LEASE = 120
+# Сколько доставок диспетчер берет за один проход
+BATCH = 100
+# Как часто диспетчер проверяет очередь без сигнала о новых доставках, с
+IDLE_POLL = 30
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leads (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deliveries (
+    lead_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL,
+    dead INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (lead_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS deliveries_due ON deliveries(dead, next_try);
+"""
+
+_INSERT_LEAD = "INSERT INTO leads (text, created) VALUES (?, ?)"
+_INSERT_DELIVERY = "INSERT INTO deliveries (lead_id, chat_id, next_try) VALUES (?, ?, ?)"
+_DUE = ("SELECT d.lead_id, d.chat_id, d.attempts, l.text FROM deliveries d JOIN leads l ON l.id = d.lead_id "
+        "WHERE d.dead = 0 AND d.next_try <= ? ORDER BY d.next_try LIMIT ?")
+_LEASE = "UPDATE deliveries SET next_try = ? WHERE lead_id = ? AND chat_id = ?"
+_NEXT_DUE = "SELECT MIN(next_try) FROM deliveries WHERE dead = 0"
+_RESCHEDULE = "UPDATE deliveries SET attempts = ?, next_try = ?, error = ? WHERE lead_id = ? AND chat_id = ?"
+_KILL = "UPDATE deliveries SET attempts = ?, dead = 1, error = ? WHERE lead_id = ? AND chat_id = ?"
+_DELETE_DELIVERY = "DELETE FROM deliveries WHERE lead_id = ? AND chat_id = ?"
+_DELETE_LEAD = "DELETE FROM leads WHERE id = ? AND NOT EXISTS (SELECT 1 FROM deliveries WHERE lead_id = ?)"
+_DEAD = ("SELECT l.id, l.text, l.created, GROUP_CONCAT(d.chat_id), MAX(d.error) FROM deliveries d "
+         "JOIN leads l ON l.id = d.lead_id WHERE d.dead = 1 GROUP BY l.id ORDER BY l.id LIMIT ?")
+_DEAD_COUNT = "SELECT COUNT(DISTINCT lead_id) FROM deliveries WHERE dead = 1"
+_REVIVE = "UPDATE deliveries SET dead = 0, attempts = 0, next_try = ?, error = NULL WHERE dead = 1"
+_DISCARD = "DELETE FROM deliveries WHERE lead_id = ? AND dead = 1"
+
+_db = sqlite_util.LazyConnection(OUTBOX_FILE, schema=_SCHEMA)
+_state = {"dispatcher": None, "wake": None, "loop": None, "sending": None, "tasks": set()}
+
+def _transaction():
+    """Транзакция с блокировкой записи"""
+    return _db.transaction(immediate=True)
+
+def _chat_ids(admin_ids):
+    """Числовые id чатов админов (записи вида @username боту недоступны для отправки)"""
+    chat_ids = []
+    for admin_id in admin_ids:
+        admin_id = str(admin_id).strip()
+        try:
+            chat_ids.append(int(admin_id))
+        except ValueError:
+            logger.warning(f"Админ {admin_id} указан не числовым id, заявки ему не отправляются")
+    return list(dict.fromkeys(chat_ids))
+
+def _insert_lead(text, chat_ids):
+    """Запись заявки и ее доставок (выполняется в потоке); возвращает id заявки"""
+    now = time.time()
+    with _transaction() as conn:
+        lead_id = conn.execute(_INSERT_LEAD, (text, now)).lastrowid
+        # Доставки сразу арендованы этим процессом: их отправит задача enqueue_lead
+        conn.executemany(_INSERT_DELIVERY, [(lead_id, chat_id, now + LEASE) for chat_id in chat_ids])
+    return lead_id
+
+async def enqueue_lead(bot, text, admin_ids):
+    """Запись заявки в очередь и запуск ее отправки всем админам.
+
+    Возвращает id заявки после того, как она надежно записана; отправка идет
+    в фоне. None - отправлять некому. Транзакция с fsync и ожиданием блокировки
+    других процессов выполняется в потоке, а не в цикле событий.
+    """
+    chat_ids = _chat_ids(admin_ids)
+    if not chat_ids:
+        logger.error(f"ЗАЯВКА (не доставлена, нет админов с числовым id): {text}")
+        return None
+    lead_id = await asyncio.to_thread(_insert_lead, text, chat_ids)
+    logger.info(f"Заявка {lead_id} записана в очередь, админов: {len(chat_ids)}")
+    _spawn(_deliver_all(bot, [(lead_id, chat_id, 0, text) for chat_id in chat_ids]))
+    return lead_id
+
+def _spawn(coroutine):
+    """Фоновая задача отправки; ссылка хранится до ее завершения"""
+    task = asyncio.get_running_loop().create_task(coroutine)
+    _state["tasks"].add(task)
+    task.add_done_callback(_state["tasks"].discard)
+    return task
+
+def _backoff(attempts):
+    """Пауза перед следующей попыткой: удваивается с каждой неудачей, со случайным разбросом"""
+    delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+def _sending():
+    """Семафор одновременных отправок (создается в цикле событий, где используется)"""
+    if _state["sending"] is None:
+        _state["sending"] = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+    return _state["sending"]
+
+async def _deliver_all(bot, deliveries):
+    """Одновременная отправка доставок"""
+    await asyncio.gather(*(_deliver(bot, *delivery) for delivery in deliveries))
+
+async def _deliver(bot, lead_id, chat_id, attempts, text):
+    """Одна попытка доставки заявки админу и запись ее результата"""
+    try:
+        async with _sending():
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+    except RetryAfter as e:
+        # Ограничение частоты - не ошибка доставки: попытка не засчитывается
+        logger.warning(f"Заявка {lead_id} админу {chat_id}: лимит Telegram, повтор через {e.retry_after} с")
+        await _record(_reschedule, lead_id, chat_id, attempts, time.time() + e.retry_after, str(e))
+    except (Forbidden, BadRequest) as e:
+        # Бот заблокирован, чат не найден и т.п. - повтор не поможет
+        await _record(_kill, lead_id, chat_id, attempts + 1, str(e))
+    except TelegramError as e:
+        attempts += 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            await _record(_kill, lead_id, chat_id, attempts, str(e))
+        else:
+            delay = _backoff(attempts)
+            logger.warning(f"Заявка {lead_id} админу {chat_id}: {e}, попытка {attempts}, повтор через {delay:.0f} с")
+            await _record(_reschedule, lead_id, chat_id, attempts, time.time() + delay, str(e))
+    except Exception as e:
+        # Неожиданная ошибка не должна оставлять доставку арендованной до истечения LEASE
+        logger.error(f"Заявка {lead_id} админу {chat_id}: {e}")
+        await _record(_reschedule, lead_id, chat_id, attempts + 1, time.time() + _backoff(attempts + 1), str(e))
+    else:
+        await _finish(lead_id, chat_id)
+
+async def _record(write, *args):
+    """Запись результата попытки в потоке; ошибка базы только логируется.
+
+    Если запись не удалась, доставка остается арендованной и будет повторена
+    после истечения LEASE - для неудачной попытки это и нужно.
+    """
+    try:
+        await asyncio.to_thread(write, *args)
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось записать результат доставки {args[0]} админу {args[1]}: {e}")
+
+async def _finish(lead_id, chat_id):
+    """Удаление доставленной заявки из очереди.
+
+    Аренда, оставшаяся после неудачного удаления, через LEASE отправила бы заявку
+    админу второй раз, поэтому удаление повторяется, пока аренда не подходит к концу.
+    """
+    deadline = time.monotonic() + LEASE / 2
+    delay = 0.5
+    while True:
+        try:
+            await asyncio.to_thread(_delete_delivery, lead_id, chat_id)
+            break
+        except sqlite3.Error as e:
+            if time.monotonic() + delay > deadline:
+                logger.error(f"Заявка {lead_id} доставлена админу {chat_id}, но не удалена из очереди "
+                             f"и может прийти повторно: {e}")
+                return
+            logger.warning(f"Заявка {lead_id} доставлена админу {chat_id}, удаление из очереди не удалось: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+    logger.info(f"Заявка {lead_id} доставлена админу {chat_id}")
+
+def _delete_delivery(lead_id, chat_id):
+    with _transaction() as conn:
+        conn.execute(_DELETE_DELIVERY, (lead_id, chat_id))
+        conn.execute(_DELETE_LEAD, (lead_id, lead_id))
+
+def _reschedule(lead_id, chat_id, attempts, next_try, error):
+    with _transaction() as conn:
+        conn.execute(_RESCHEDULE, (attempts, next_try, error, lead_id, chat_id))
+    _wake()
+
+def _kill(lead_id, chat_id, attempts, error):
+    with _transaction() as conn:
+        conn.execute(_KILL, (attempts, error, lead_id, chat_id))
+        text = conn.execute("SELECT text FROM leads WHERE id = ?", (lead_id,)).fetchone()[0]
+    logger.error(f"Заявка {lead_id} не доставлена админу {chat_id} ({error}), попыток: {attempts}")
+    logger.info(f"ЗАЯВКА (не доставлена): {text}")
+
+def _claim(now):
+    """Доставки, срок которых подошел, с арендой на LEASE секунд"""
+    with _transaction() as conn:
+        due = conn.execute(_DUE, (now, BATCH)).fetchall()
+        conn.executemany(_LEASE, [(now + LEASE, lead_id, chat_id) for lead_id, chat_id, _, _ in due])
+    return due
+
+def _next_due():
+    """Время ближайшей попытки или None, если ждать нечего"""
+    with _db.lock:
+        return _db.get().execute(_NEXT_DUE).fetchone()[0]
+
+def _wake():
+    """Сигнал диспетчеру пересчитать время ближайшей попытки (можно вызывать из любого потока)"""
+    wake, loop = _state["wake"], _state["loop"]
+    if wake is not None:
+        loop.call_soon_threadsafe(wake.set)
+
+async def _dispatch(bot):
+    """Фоновый цикл повторных отправок"""
+    wake = _state["wake"]
+    while True:
+        wake.clear()
+        try:
+            due = await asyncio.to_thread(_claim, time.time())
+            next_try = None if len(due) == BATCH else await asyncio.to_thread(_next_due)
+        except sqlite3.Error as e:
+            logger.error(f"Очередь заявок недоступна: {e}")
+            due, next_try = [], None
+        if due:
+            _spawn(_deliver_all(bot, due))
+            if len(due) == BATCH:
+                continue
+        timeout = IDLE_POLL if next_try is None else min(IDLE_POLL, max(0.0, next_try - time.time()))
+        try:
+            await asyncio.wait_for(wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def start(bot):
+    """Запуск диспетчера; доставки, оставшиеся с прошлого запуска, отправляются сразу"""
+    if _state["dispatcher"] is None:
+        _state["wake"] = asyncio.Event()
+        _state["loop"] = asyncio.get_running_loop()
+        _state["dispatcher"] = asyncio.get_running_loop().create_task(_dispatch(bot))
+
+async def stop(timeout=10):
+    """Остановка диспетчера; идущие отправки получают до timeout секунд.
+
+    Отправки, не успевшие завершиться, отменяются - их аренда истечет,
+    и они будут повторены после запуска.
+    """
+    dispatcher = _state["dispatcher"]
+    if dispatcher is not None:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+    tasks = list(_state["tasks"])
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    _state.update(dispatcher=None, wake=None, loop=None, sending=None)
+    _db.close()
+
+def dead_count():
+    """Число недоставленных заявок"""
+    with _db.lock:
+        return _db.get().execute(_DEAD_COUNT).fetchone()[0]
+
+def dead_letters(limit=20):
+    """Недоставленные заявки: [{'id', 'text', 'created', 'chat_ids', 'error'}]"""
+    with _db.lock:
+        rows = _db.get().execute(_DEAD, (limit,)).fetchall()
+    return [
+        {"id": lead_id, "text": text, "created": created,
+         "chat_ids": [int(chat_id) for chat_id in chat_ids.split(",")], "error": error}
+        for lead_id, text, created, chat_ids, error in rows
+    ]
+
+def retry_dead():
+    """Повтор всех недоставленных заявок с обнулением попыток; возвращает число доставок"""
+    with _transaction() as conn:
+        count = conn.execute(_REVIVE, (time.time(),)).rowcount
+    _wake()
+    return count
+
+def discard(lead_id):
+    """Удаление недоставленной заявки из очереди (после того как админ ее получил)"""
+    with _transaction() as conn:
+        conn.execute(_DISCARD, (lead_id,))
+        conn.execute(_DELETE_LEAD, (lead_id, lead_id))
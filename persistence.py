@@ -0,0 +1,359 @@
+"""
+Хранилище состояния бота: user_data, chat_data, bot_data и состояния диалогов
+
+Подключается к Application через builder().persistence() (см. create_persistence).
+PTB передает изменения раз в PERSISTENCE_UPDATE_INTERVAL секунд; все изменения
+одного такого цикла записываются одной пачкой - одной транзакцией SQLite или одной
+записью журнала, без fsync на каждое обновление. После перезапуска бота клиент
+продолжает заявку с того шага, на котором остановился.
+
+Два вида хранилища:
+- SQLitePersistence - файл SQLite (WAL); с ним могут работать несколько процессов
+  (см. cluster.py): у каждой записи есть номер версии, и перед обработкой обновления
+  данные пользователя и чата перечитываются, только если их записал другой процесс;
+- LogPersistence - журнал в файле, в который только дописываются пачки изменений;
+  для одного процесса, периодически сворачивается в снимок.
+"""
+import abc
+import asyncio
+import json
+import logging
+import os
+import pickle
+import threading
+from telegram.ext import BasePersistence, PersistenceInput
+from config import (
+    PERSISTENCE_BACKEND, PERSISTENCE_FILE, PERSISTENCE_LOG_FILE, PERSISTENCE_LOG_COMPACT_EVERY,
+    PERSISTENCE_UPDATE_INTERVAL
+)
+import fileutil
+import sqlite_util
+
+logger = logging.getLogger(__name__)
+
+# Виды данных; bot_data хранится одной записью с ключом 0
+_TABLES = ("user_data", "chat_data", "bot_data")
+
+class _BatchedPersistence(BasePersistence, abc.ABC):
+    """Общая часть хранилищ: изменения копятся и записываются одной пачкой.
+
+    Ключ изменения - (вид, ключ): для данных вид - одна из _TABLES, для диалогов -
+    ("conversations", (имя, ключ диалога)). Значение сериализуется pickle в момент
+    передачи, None означает удаление. Пачка собирается до следующего шага цикла
+    событий, когда PTB передаст все изменения текущего цикла, и записывается в
+    потоке (asyncio.to_thread): транзакция SQLite может ждать другие процессы
+    кластера, и цикл событий ее не ждет. При flush записывается остаток.
+
+    _lock защищает только накопленные изменения и недолго, записи по очереди идут
+    под _write_lock.
+    """
+
+    def __init__(self, update_interval):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._pending = {}
+        self._writing = {}  # Пачка, которая записывается прямо сейчас
+        self._scheduled = False
+        self._tasks = set()
+
+    def _stage(self, kind, key, value):
+        with self._lock:
+            self._pending[(kind, key)] = None if value is None else pickle.dumps(value)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        try:
+            asyncio.get_running_loop().call_soon(self._start_write)
+        except RuntimeError:
+            self._write_pending()
+
+    def _start_write(self):
+        """Запуск записи накопленной пачки в потоке"""
+        task = asyncio.get_running_loop().create_task(asyncio.to_thread(self._write_pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending, self._scheduled = self._pending, {}, False
+                self._writing = batch
+            if not batch:
+                return
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Не удалось сохранить состояние бота ({len(batch)} изменений): {e}")
+                # Изменения возвращаются в очередь (если их не заменили более новые)
+                # и записываются вместе со следующей пачкой или при flush
+                with self._lock:
+                    for change, blob in batch.items():
+                        self._pending.setdefault(change, blob)
+            finally:
+                with self._lock:
+                    self._writing = {}
+
+    @abc.abstractmethod
+    def _write_batch(self, batch):
+        """Запись пачки изменений {(вид, ключ): pickle или None} (в потоке, под _write_lock)"""
+
+    @abc.abstractmethod
+    def _read(self, kind):
+        """Все записи вида: {ключ: pickle}"""
+
+    def _load(self, kind):
+        result = {}
+        for key, blob in self._read(kind).items():
+            try:
+                result[key] = pickle.loads(blob)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать {kind} {key}: {e}")
+        return result
+
+    def _close(self):
+        pass
+
+    async def get_user_data(self):
+        return self._load("user_data")
+
+    async def get_chat_data(self):
+        return self._load("chat_data")
+
+    async def get_bot_data(self):
+        return self._load("bot_data").get(0, {})
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {key[1]: state for key, state in self._load("conversations").items() if key[0] == name}
+
+    async def update_conversation(self, name, key, new_state):
+        self._stage("conversations", (name, tuple(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._stage("user_data", user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage("chat_data", chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._stage("bot_data", 0, data)
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._stage("user_data", user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._stage("chat_data", chat_id, None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.to_thread(self._write_pending)
+        with self._write_lock:
+            self._close()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, rev INTEGER NOT NULL, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, rev INTEGER NOT NULL, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), rev INTEGER NOT NULL, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+class SQLitePersistence(_BatchedPersistence):
+    """Хранилище состояния бота в SQLite (WAL; пишут несколько процессов).
+
+    Данные сериализуются pickle, поэтому в user_data можно хранить не только JSON
+    (например, array с id выборки). callback_data не хранится: бот использует
+    обычные строковые callback_data.
+    """
+
+    def __init__(self, filepath=PERSISTENCE_FILE, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(update_interval)
+        self.filepath = filepath
+        # В режиме WAL транзакция переживает падение процесса и без fsync на каждый коммит.
+        # Отдельное соединение для чтения: перечитывание перед обновлением не ждет записи
+        self._db = sqlite_util.LazyConnection(filepath, synchronous="NORMAL", schema=_SCHEMA)
+        self._reader = sqlite_util.LazyConnection(filepath, synchronous="NORMAL")
+        # Версии записей, которые этот процесс прочитал или записал последними
+        self._revs = {table: {} for table in _TABLES}
+
+    def _reader_connection(self):
+        """Соединение для чтения (схему при первом обращении создает соединение для записи)"""
+        if not self._reader.is_open:
+            self._db.get()
+        return self._reader.get()
+
+    def _read(self, kind):
+        with self._lock:
+            conn = self._reader_connection()
+            if kind == "conversations":
+                rows = conn.execute("SELECT name, key, state FROM conversations").fetchall()
+                return {(name, tuple(json.loads(key))): state for name, key, state in rows}
+            rows = conn.execute(f"SELECT id, rev, data FROM {kind}").fetchall()
+        for row_id, rev, _ in rows:
+            self._revs[kind][row_id] = rev
+        return {row_id: data for row_id, _, data in rows}
+
+    def _write_batch(self, batch):
+        revs = {}
+        with self._db.transaction(immediate=True) as conn:
+            for (kind, key), blob in batch.items():
+                if kind == "conversations":
+                    name, conversation_key = key[0], json.dumps(key[1])
+                    if blob is None:
+                        conn.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, conversation_key))
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                     (name, conversation_key, blob))
+                elif blob is None:
+                    conn.execute(f"DELETE FROM {kind} WHERE id = ?", (key,))
+                    revs[(kind, key)] = None
+                else:
+                    row = conn.execute(f"SELECT rev FROM {kind} WHERE id = ?", (key,)).fetchone()
+                    rev = (row[0] if row else 0) + 1
+                    conn.execute(f"INSERT OR REPLACE INTO {kind} (id, rev, data) VALUES (?, ?, ?)", (key, rev, blob))
+                    revs[(kind, key)] = rev
+        with self._lock:
+            for (kind, key), rev in revs.items():
+                if rev is None:
+                    self._revs[kind].pop(key, None)
+                else:
+                    self._revs[kind][key] = rev
+
+    def _refresh(self, kind, row_id, data):
+        """Перечитывание записи, если после нашего последнего чтения ее записал другой процесс.
+
+        Записи, которые этот процесс еще не записал или записывает сейчас, не перечитываются.
+        """
+        with self._lock:
+            if (kind, row_id) in self._pending or (kind, row_id) in self._writing:
+                return
+            row = self._reader_connection().execute(f"SELECT rev, data FROM {kind} WHERE id = ?", (row_id,)).fetchone()
+            if row is None or row[0] == self._revs[kind].get(row_id):
+                return
+        try:
+            fresh = pickle.loads(row[1])
+        except Exception as e:
+            logger.error(f"Не удалось прочитать {kind} {row_id}: {e}")
+            return
+        data.clear()
+        data.update(fresh)
+        self._revs[kind][row_id] = row[0]
+
+    def _close(self):
+        self._reader.close()
+        self._db.close()
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._refresh("user_data", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        self._refresh("chat_data", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        self._refresh("bot_data", 0, bot_data)
+
+class LogPersistence(_BatchedPersistence):
+    """Хранилище состояния бота в журнале, в который только дописываются пачки изменений.
+
+    Запись пачки - один write без fsync: пачка переживает падение процесса, а после
+    сбоя питания может потеряться только последняя секунда изменений. Недописанная
+    последняя запись при чтении отбрасывается. Каждые PERSISTENCE_LOG_COMPACT_EVERY
+    пачек журнал переписывается одной записью с текущим состоянием. Только для одного процесса.
+    """
+
+    def __init__(self, filepath=PERSISTENCE_LOG_FILE, update_interval=PERSISTENCE_UPDATE_INTERVAL,
+                 compact_every=PERSISTENCE_LOG_COMPACT_EVERY):
+        super().__init__(update_interval)
+        self.filepath = filepath
+        self.compact_every = compact_every
+        self._state = None
+        self._records = 0
+        self._file = None
+
+    def _replay(self):
+        """Состояние из журнала (читается один раз)"""
+        if self._state is not None:
+            return self._state
+        state = {}
+        bodies, valid_size = fileutil.read_frames(self.filepath)
+        for body in bodies:
+            for change, blob in pickle.loads(body):
+                if blob is None:
+                    state.pop(change, None)
+                else:
+                    state[change] = blob
+        # Недописанная запись после сбоя не была подтверждена - отрезаем ее
+        # (журнал пишет только этот процесс, поэтому читатель здесь и писатель)
+        fileutil.truncate_tail(self.filepath, valid_size)
+        self._state, self._records = state, len(bodies)
+        return state
+
+    def _read(self, kind):
+        with self._write_lock:
+            return {key: blob for (change_kind, key), blob in self._replay().items() if change_kind == kind}
+
+    @staticmethod
+    def _encode(changes):
+        """Запись журнала (fileutil.encode_frame) с pickle списка изменений [((вид, ключ), pickle или None)]"""
+        return fileutil.encode_frame(pickle.dumps(changes))
+
+    def _write_batch(self, batch):
+        state = self._replay()
+        if self._records >= self.compact_every:
+            self._compact(state, batch)
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+            self._file = open(self.filepath, 'ab', buffering=0)
+        self._file.write(self._encode(list(batch.items())))
+        self._records += 1
+        for change, blob in batch.items():
+            if blob is None:
+                state.pop(change, None)
+            else:
+                state[change] = blob
+
+    def _compact(self, state, batch):
+        """Перезапись журнала одной записью с текущим состоянием (временный файл + fsync + rename)"""
+        for change, blob in batch.items():
+            if blob is None:
+                state.pop(change, None)
+            else:
+                state[change] = blob
+        self._close()
+        fileutil.write_atomic(self.filepath, self._encode(list(state.items())))
+        self._records = 1
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def create_persistence():
+    """Хранилище по PERSISTENCE_BACKEND: "sqlite", "log" или None ("none" - состояние только в памяти)"""
+    if PERSISTENCE_BACKEND == "sqlite":
+        return SQLitePersistence()
+    if PERSISTENCE_BACKEND == "log":
+        return LogPersistence()
+    if PERSISTENCE_BACKEND != "none":
+        logger.error(f"Неизвестный PERSISTENCE_BACKEND={PERSISTENCE_BACKEND!r}, состояние хранится только в памяти")
+    return None
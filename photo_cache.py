@@ -0,0 +1,203 @@
+"""
+Постоянный кэш file_id фотографий, уже загруженных в Telegram
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from telegram.error import RetryAfter
+import fileutil
+from config import FILE_IDS_FILE
+
+logger = logging.getLogger(__name__)
+
+# Через сколько загруженных при предзагрузке фото их file_id записываются в кэш
+WARMUP_SAVE_EVERY = 20
+# Сколько раз предзагрузка повторяет фото после ограничения частоты Telegram (RetryAfter)
+WARMUP_RETRIES = 5
+
+# Ключ кэша - имя файла + хеш содержимого, поэтому перезаписанный или
+# сдвинувшийся в списке файл никогда не получит чужой file_id
+# Кэш общий для всех процессов бота (см. cluster.py): файл перечитывается, если его
+# изменил другой процесс, а запись идет под файловой блокировкой поверх свежей копии
+_lock = threading.RLock()
+_store = {"file_ids": None, "stamp": None}
+_digests = {}
+
+def _stamp():
+    """mtime и размер файла кэша (None, если файла нет)"""
+    try:
+        st = os.stat(FILE_IDS_FILE)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _load():
+    """Кэш в памяти; перечитывается с диска, если файл изменился"""
+    stamp = _stamp()
+    if _store["file_ids"] is None or stamp != _store["stamp"]:
+        file_ids = {}
+        if stamp is not None:
+            try:
+                with open(FILE_IDS_FILE, 'r', encoding='utf-8') as f:
+                    file_ids = json.load(f)
+            except Exception as e:
+                logger.error(f"Не удалось прочитать кэш file_id {FILE_IDS_FILE}: {e}")
+        _store.update(file_ids=file_ids, stamp=stamp)
+    return _store["file_ids"]
+
+def _save():
+    """Атомарная запись кэша на диск"""
+    content = json.dumps(_store["file_ids"], ensure_ascii=False, indent=2).encode('utf-8')
+    # Потерянный при сбое питания file_id просто будет получен заново, поэтому без fsync
+    fileutil.write_atomic(FILE_IDS_FILE, content, durable=False)
+    _store["stamp"] = _stamp()
+
+@contextmanager
+def _writing():
+    """Изменение кэша: блокировка между процессами и свежая копия с диска"""
+    with _lock, fileutil.file_lock(f"{FILE_IDS_FILE}.lock"):
+        yield _load()
+
+def _file_digest(path):
+    """Хеш содержимого файла (пересчитывается только при изменении mtime/размера)"""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _digests.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    _digests[path] = (stamp, digest.hexdigest())
+    return _digests[path][1]
+
+def photo_key(path):
+    """Ключ кэша для локального файла: имя файла и хеш содержимого"""
+    return f"{os.path.basename(path)}:{_file_digest(path)}"
+
+def get_file_id(path):
+    """Сохраненный file_id для локального файла или None"""
+    try:
+        with _lock:
+            return _load().get(photo_key(path))
+    except OSError:
+        return None
+
+def remember_file_ids(files):
+    """Запоминание file_id нескольких загруженных файлов одной записью кэша: {путь: file_id}.
+
+    Кэш каждый раз переписывается целиком, поэтому при массовой загрузке
+    (warm_up) file_id сохраняются пачками, а не по одному.
+    """
+    keys = {}
+    for path, file_id in files.items():
+        try:
+            keys[photo_key(path)] = file_id
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить file_id для {path}: {e}")
+    if not keys:
+        return
+    try:
+        with _writing() as file_ids:
+            file_ids.update(keys)
+            _save()
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить file_id ({len(keys)} фото): {e}")
+
+def remember_file_id(path, file_id):
+    """Запоминание file_id после загрузки файла в Telegram"""
+    remember_file_ids({path: file_id})
+
+def forget_photo(filename):
+    """Удаление всех file_id для файла (вызывается при удалении или замене фото)"""
+    filename = os.path.basename(filename)
+    with _writing() as file_ids:
+        stale = [key for key in file_ids if key.rsplit(':', 1)[0] == filename]
+        for key in stale:
+            del file_ids[key]
+        for path in [p for p in _digests if os.path.basename(p) == filename]:
+            del _digests[path]
+        if stale:
+            try:
+                _save()
+            except OSError as e:
+                logger.warning(f"Не удалось обновить кэш file_id: {e}")
+
+def catalog_photo_paths():
+    """Пути ко всем локальным фотографиям каталога, включая placeholder"""
+    import database
+    from config import PHOTOS_DIR
+    paths = []
+    for car in database.get_catalog().get("cars", []):
+        for photo in car.local_photos:
+            path = os.path.join(PHOTOS_DIR, photo) if not os.path.isabs(photo) else photo
+            if os.path.exists(path) and path not in paths:
+                paths.append(path)
+    placeholder = os.path.join(PHOTOS_DIR, "placeholder.jpg")
+    if os.path.exists(placeholder):
+        paths.append(placeholder)
+    return paths
+
+def _uncached_paths():
+    """Фото каталога без file_id (хеширует все файлы, поэтому вызывается в потоке)"""
+    return [path for path in catalog_photo_paths() if get_file_id(path) is None]
+
+async def _send_photo(bot, chat_id, path):
+    """Отправка фото в служебный чат; при ограничении частоты ждет retry_after и повторяет"""
+    for attempt in range(WARMUP_RETRIES + 1):
+        try:
+            with open(path, 'rb') as photo_file:
+                return await bot.send_photo(chat_id=chat_id, photo=photo_file, disable_notification=True)
+        except RetryAfter as e:
+            if attempt == WARMUP_RETRIES:
+                raise
+            logger.warning(f"Предзагрузка фото: лимит Telegram, повтор {path} через {e.retry_after} с")
+            await asyncio.sleep(e.retry_after)
+
+async def warm_up(bot, chat_id, concurrency=3):
+    """Загрузка в служебный чат всех фото без file_id, чтобы клиенты получали их из кэша"""
+    paths = await asyncio.to_thread(_uncached_paths)
+    if not paths:
+        logger.info("Предзагрузка фото: все фотографии уже в кэше")
+        return 0, 0
+
+    logger.info(f"Предзагрузка фото: {len(paths)} файлов, параллельно {concurrency}")
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = {"uploaded": 0, "failed": 0}
+    found = {}
+
+    async def save():
+        batch = dict(found)
+        found.clear()
+        await asyncio.to_thread(remember_file_ids, batch)
+
+    async def upload(path):
+        async with semaphore:
+            try:
+                message = await _send_photo(bot, chat_id, path)
+                found[path] = message.photo[-1].file_id
+                stats["uploaded"] += 1
+                if len(found) >= WARMUP_SAVE_EVERY:
+                    await save()
+                try:
+                    await message.delete()
+                except Exception as delete_error:
+                    logger.debug(f"Не удалось удалить служебное сообщение: {delete_error}")
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error(f"Предзагрузка фото: ошибка загрузки {path}: {e}")
+            done = stats["uploaded"] + stats["failed"]
+            if done % 10 == 0 or done == len(paths):
+                logger.info(f"Предзагрузка фото: {done}/{len(paths)} (ошибок: {stats['failed']})")
+
+    await asyncio.gather(*(upload(path) for path in paths))
+    if found:
+        await save()
+    logger.info(f"Предзагрузка фото завершена: загружено {stats['uploaded']}, ошибок {stats['failed']}")
+    return stats["uploaded"], stats["failed"]
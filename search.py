@@ -0,0 +1,254 @@
+"""
+Полнотекстовый поиск по каталогу: инвертированный индекс слов
+
+Слова марки, модели, описания и комплектации приводятся к нормальной форме
+(нижний регистр, ё -> е, без русских окончаний) и хранятся в словаре
+слово -> {id автомобиля: вес поля}. Слова словаря дополнительно лежат
+отсортированным списком для поиска по префиксу, а варианты слов без одной
+буквы - в отдельном словаре для поиска с опечаткой. Марки и модели хранятся
+латиницей, а ищут их часто по-русски, поэтому их слова индексируются и в
+транслитерации, а слова запроса дополняются синонимами из ALIASES. Индекс обновляется
+точечно при добавлении и удалении автомобиля (см. database._index_add) в копии
+из fork, поэтому опубликованный индекс не меняется.
+"""
+import re
+from bisect import bisect_left, insort
+
+# Вес совпадения в зависимости от поля автомобиля
+FIELD_WEIGHTS = {'brand': 3, 'model': 3, 'features': 2, 'description': 1}
+# Поля, слова которых индексируются и в транслитерации
+TRANSLITERATED_FIELDS = ('brand', 'model')
+# Вес совпадения в зависимости от его вида
+EXACT, PREFIX, FUZZY = 3, 2, 1
+# Минимальная длина слова запроса для поиска по префиксу и с опечаткой
+PREFIX_MIN_LEN = 2
+FUZZY_MIN_LEN = 4
+
+# Русские написания марок, которые не получаются транслитерацией (слово запроса -> слово каталога)
+ALIASES = {
+    "фольксваген": "volkswagen", "фольцваген": "volkswagen",
+    "хендай": "hyundai", "хундай": "hyundai", "хендэ": "hyundai", "хюндай": "hyundai",
+    "пежо": "peugeot", "рено": "renault", "шевроле": "chevrolet", "шкода": "skoda",
+    "ситроен": "citroen", "бмв": "bmw", "мерседес": "mercedes", "мерс": "mercedes",
+    "мицубиси": "mitsubishi", "мицубиши": "mitsubishi", "ауди": "audi", "лексус": "lexus",
+    "инфинити": "infiniti", "опель": "opel", "ягуар": "jaguar", "порше": "porsche", "сузуки": "suzuki",
+}
+
+_WORD = re.compile(r"\w+")
+_CYRILLIC = re.compile(r"^[а-я]+$")
+_LATIN = re.compile(r"^[a-z]+$")
+# Транслитерация для поиска марок и моделей, которые хранятся латиницей, по-русски и наоборот
+_TO_LATIN = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s",
+    "т": "t", "у": "u", "ф": "f", "х": "h", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+_TO_CYRILLIC = (
+    ("sch", "щ"), ("zh", "ж"), ("kh", "х"), ("ts", "ц"), ("ch", "ч"), ("sh", "ш"), ("yu", "ю"), ("ya", "я"),
+    ("a", "а"), ("b", "б"), ("c", "к"), ("d", "д"), ("e", "е"), ("f", "ф"), ("g", "г"), ("h", "х"),
+    ("i", "и"), ("j", "дж"), ("k", "к"), ("l", "л"), ("m", "м"), ("n", "н"), ("o", "о"), ("p", "п"),
+    ("q", "к"), ("r", "р"), ("s", "с"), ("t", "т"), ("u", "у"), ("v", "в"), ("w", "в"), ("x", "кс"),
+    ("y", "й"), ("z", "з"),
+)
+# Окончания, которые отбрасываются у русских слов (сначала длинные)
+_ENDINGS = tuple(sorted((
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими",
+    "ий", "ый", "ой", "ая", "яя", "ое", "ее", "ые", "ие", "ом", "ем", "ах", "ях",
+    "ов", "ев", "ей", "ам", "ям", "ью", "ья", "ье",
+    "ы", "и", "а", "я", "о", "е", "у", "ю", "ь", "й",
+), key=len, reverse=True))
+
+def _stem(word):
+    """Отбрасывание окончания русского слова (основа не короче трех букв)"""
+    if _CYRILLIC.match(word):
+        for ending in _ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                return word[:-len(ending)]
+    return word
+
+def normalize(text):
+    """Список нормализованных слов текста"""
+    return [_stem(word) for word in _WORD.findall(text.lower().replace('ё', 'е'))]
+
+def _transliterate(word):
+    """Нормализованное слово другим алфавитом (кириллица -> латиница и наоборот) или None"""
+    if _CYRILLIC.match(word):
+        return "".join(_TO_LATIN.get(char, char) for char in word)
+    if _LATIN.match(word):
+        result = []
+        pos = 0
+        while pos < len(word):
+            for latin, cyrillic in _TO_CYRILLIC:
+                if word.startswith(latin, pos):
+                    result.append(cyrillic)
+                    pos += len(latin)
+                    break
+        return _stem("".join(result))
+    return None
+
+def _query_words(text):
+    """Варианты написания каждого слова запроса: нормальная форма, синоним из ALIASES и латиница"""
+    words = {}
+    for word in _WORD.findall(text.lower().replace('ё', 'е')):
+        variants = words.setdefault(_stem(word), {_stem(word)})
+        if word in ALIASES:
+            variants.add(ALIASES[word])
+        if _CYRILLIC.match(word):
+            variants.add(_transliterate(word))
+    return list(words.values())
+
+def _deletes(word):
+    """Варианты слова без одной буквы"""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+def _within_one_edit(a, b):
+    """Отличаются ли слова не более чем на одну замену, вставку, удаление или перестановку соседних букв"""
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:] or (a[i + 2:] == b[i + 2:] and a[i:i + 2] == b[i:i + 2][::-1])
+    if len(a) < len(b):
+        a, b = b, a
+    return a[i + 1:] == b[i:]
+
+def _car_words(car):
+    """Слова автомобиля с весом поля (для повторяющихся слов - максимальным)"""
+    words = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        value = getattr(car, field)
+        text = " ".join(value) if isinstance(value, list) else str(value)
+        found = normalize(text)
+        if field in TRANSLITERATED_FIELDS:
+            # Марка и модель ищутся и в другом алфавите: Toyota -> тойот, Лада -> lada
+            found += [_transliterate(word) for word in _WORD.findall(text.lower().replace('ё', 'е'))]
+        for word in found:
+            if word and weight > words.get(word, 0):
+                words[word] = weight
+    return words
+
+def new_index():
+    """Пустой поисковый индекс"""
+    return {"postings": {}, "words": [], "variants": {}, "car_words": {}}
+
+def add(index, car):
+    """Добавление автомобиля в поисковый индекс"""
+    words = _car_words(car)
+    postings = index["postings"]
+    for word, weight in words.items():
+        ids = postings.get(word)
+        if ids is None:
+            ids = postings[word] = {}
+            insort(index["words"], word)
+            for variant in _deletes(word) | {word}:
+                index["variants"].setdefault(variant, set()).add(word)
+        ids[car.id] = weight
+    index["car_words"][car.id] = tuple(words)
+
+def remove(index, car):
+    """Удаление автомобиля из поискового индекса (слова без автомобилей убираются из словаря)"""
+    postings = index["postings"]
+    for word in index["car_words"].pop(car.id, ()):
+        ids = postings.get(word)
+        if ids is None:
+            continue
+        ids.pop(car.id, None)
+        if ids:
+            continue
+        del postings[word]
+        words = index["words"]
+        del words[bisect_left(words, word)]
+        for variant in _deletes(word) | {word}:
+            similar = index["variants"].get(variant)
+            if similar is not None:
+                similar.discard(word)
+                if not similar:
+                    del index["variants"][variant]
+
+def fork(index, cars):
+    """Копия индекса для добавления и удаления автомобилей cars; index не изменяется.
+
+    Копируются верхние словари и записи слов этих автомобилей, остальные записи
+    остаются общими со старым индексом.
+    """
+    words = set()
+    for car in cars:
+        words.update(index["car_words"].get(car.id, ()))
+        words.update(_car_words(car))
+    postings = dict(index["postings"])
+    variants = dict(index["variants"])
+    for word in words:
+        if word in postings:
+            postings[word] = dict(postings[word])
+        for variant in _deletes(word) | {word}:
+            if variant in variants:
+                variants[variant] = set(variants[variant])
+    return {"postings": postings, "words": list(index["words"]), "variants": variants,
+            "car_words": dict(index["car_words"])}
+
+def build(cars):
+    """Поисковый индекс по списку автомобилей"""
+    index = new_index()
+    for car in cars:
+        add(index, car)
+    return index
+
+def _match_word(index, word):
+    """Автомобили, подходящие под одно слово запроса: {id: вес}"""
+    postings = index["postings"]
+    scores = {}
+
+    def take(found, kind):
+        for car_id, weight in postings[found].items():
+            score = kind * weight
+            if score > scores.get(car_id, 0):
+                scores[car_id] = score
+
+    if word in postings:
+        take(word, EXACT)
+    if len(word) >= PREFIX_MIN_LEN:
+        words = index["words"]
+        pos = bisect_left(words, word)
+        while pos < len(words) and words[pos].startswith(word):
+            if words[pos] != word:
+                take(words[pos], PREFIX)
+            pos += 1
+    # Опечатки ищутся, только если слово не нашлось ни целиком, ни по префиксу
+    if not scores and len(word) >= FUZZY_MIN_LEN:
+        candidates = set()
+        for variant in _deletes(word) | {word}:
+            candidates |= index["variants"].get(variant, set())
+        for found in candidates:
+            if _within_one_edit(word, found):
+                take(found, FUZZY)
+    return scores
+
+def match(index, text):
+    """Автомобили, в которых есть все слова запроса: {id: суммарный вес}.
+
+    Слово запроса совпадает, если совпал любой из его вариантов написания
+    (например, "тойота" находит Toyota, "ситроен" - Citroen, "lada" - Лада).
+    """
+    matches = []
+    for variants in _query_words(text):
+        scores = {}
+        for variant in variants:
+            for car_id, score in _match_word(index, variant).items():
+                if score > scores.get(car_id, 0):
+                    scores[car_id] = score
+        if not scores:
+            return {}
+        matches.append(scores)
+    if not matches:
+        return {}
+    # Пересечение начинается с самого короткого списка
+    matches.sort(key=len)
+    result = matches[0]
+    for scores in matches[1:]:
+        result = {car_id: score + scores[car_id] for car_id, score in result.items() if car_id in scores}
+    return result
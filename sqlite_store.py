@@ -0,0 +1,167 @@
+"""
+Хранение каталога в SQLite (STORAGE_BACKEND = "sqlite")
+
+Автомобили лежат в таблице cars: запись - JSON в колонке doc, порядок каталога -
+в колонке position. Фильтры и сортировка работают по индексам в памяти
+(database._build_index), поэтому отдельных колонок и индексов для полей
+фильтров в базе нет - они только замедляли бы каждую запись. Каждое изменение дополнительно
+пишется в таблицу changes, чтобы другие процессы могли догнать каталог
+по последним записям, а не перечитывать его целиком.
+"""
+import json
+import logging
+import zlib
+import sqlite_util
+from config import SQLITE_FILE, SQLITE_CHANGES_KEEP
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cars (
+    id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cars_position ON cars(position);
+DROP INDEX IF EXISTS cars_brand;
+DROP INDEX IF EXISTS cars_body_type;
+DROP INDEX IF EXISTS cars_engine_type;
+DROP INDEX IF EXISTS cars_transmission;
+DROP INDEX IF EXISTS cars_price;
+CREATE TABLE IF NOT EXISTS changes (
+    rev INTEGER PRIMARY KEY AUTOINCREMENT,
+    record TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Запросы с параметрами: sqlite3 компилирует каждый текст один раз и берет его из кэша выражений
+_INSERT_CAR = "INSERT OR REPLACE INTO cars (id, position, doc) VALUES (?, ?, ?)"
+_UPDATE_CAR = "UPDATE cars SET doc = ? WHERE id = ?"
+_DELETE_CAR = "DELETE FROM cars WHERE id = ?"
+_NEXT_POSITION = "SELECT COALESCE(MAX(position), -1) + 1 FROM cars"
+_INSERT_CHANGE = "INSERT INTO changes (record) VALUES (?)"
+_PRUNE_CHANGES = "DELETE FROM changes WHERE rev <= ?"
+_LAST_REV = "SELECT seq FROM sqlite_sequence WHERE name = 'changes'"
+_GET_META = "SELECT value FROM meta WHERE key = ?"
+_SET_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+
+# Два соединения на процесс: для записи и для чтения. В режиме WAL чтение не ждет
+# записи, поэтому читатели каталога не ждут fsync писателя. Обращения к каждому
+# соединению сериализуются своей блокировкой
+_connections = {
+    "write": sqlite_util.LazyConnection(SQLITE_FILE, schema=_SCHEMA),
+    "read": sqlite_util.LazyConnection(SQLITE_FILE),
+}
+
+def _connect(role="write"):
+    """Соединение для записи или чтения (создается при первом обращении)"""
+    if role == "read" and not _connections["read"].is_open:
+        _connections["write"].get()  # Схему создает соединение для записи
+    return _connections[role].get()
+
+def _transaction(immediate=False, role="write"):
+    """Транзакция; immediate сразу берет блокировку записи"""
+    _connect(role)
+    return _connections[role].transaction(immediate)
+
+def _car_doc(car):
+    """JSON автомобиля для колонки doc"""
+    return json.dumps(car, ensure_ascii=False)
+
+def _get_meta(conn, key, default=None):
+    row = conn.execute(_GET_META, (key,)).fetchone()
+    return row[0] if row else default
+
+def _last_rev(conn):
+    row = conn.execute(_LAST_REV).fetchone()
+    return row[0] if row else 0
+
+def data_version():
+    """Счетчик, который меняется после каждой записи (соединение для чтения видит и записи этого процесса)"""
+    with _connections["read"].lock:
+        return _connect("read").execute("PRAGMA data_version").fetchone()[0]
+
+def is_initialized():
+    """Был ли каталог уже записан в базу (иначе нужен перенос из JSON)"""
+    with _connections["read"].lock:
+        return _get_meta(_connect("read"), "generation") is not None
+
+def read_all():
+    """Весь каталог: (данные, номер последнего изменения, поколение)"""
+    with _transaction(role="read") as conn:
+        data = json.loads(_get_meta(conn, "document", "{}"))
+        data["cars"] = [json.loads(doc) for (doc,) in conn.execute("SELECT doc FROM cars ORDER BY position")]
+        data.setdefault("contacts", {})
+        return data, _last_rev(conn), _get_meta(conn, "generation")
+
+def changes_since(rev, generation):
+    """Изменения после rev: список (номер, запись) или None, если нужно полное чтение.
+
+    Полное чтение требуется после записи снимка (сменилось поколение) или если
+    нужные изменения уже удалены из таблицы changes.
+    """
+    with _transaction(role="read") as conn:
+        if _get_meta(conn, "generation") != generation:
+            return None
+        rows = conn.execute("SELECT rev, record FROM changes WHERE rev > ? ORDER BY rev", (rev,)).fetchall()
+        if rows and rows[0][0] != rev + 1:
+            return None
+        return [(row_rev, json.loads(record)) for row_rev, record in rows]
+
+def write_all(data):
+    """Замена всего каталога одной транзакцией.
+
+    Возвращает (номер изменения, поколение, CRC32 записанных JSON-документов).
+    """
+    rows = [(car.get("id"), position, _car_doc(car)) for position, car in enumerate(data.get("cars", []))]
+    document = json.dumps({key: value for key, value in data.items() if key != "cars"}, ensure_ascii=False)
+    checksum = zlib.crc32(document.encode('utf-8'))
+    for row in rows:
+        checksum = zlib.crc32(row[-1].encode('utf-8'), checksum)
+    with _transaction(immediate=True) as conn:
+        conn.execute("DELETE FROM cars")
+        conn.executemany(_INSERT_CAR, rows)
+        conn.execute("DELETE FROM changes")
+        conn.execute(_SET_META, ("document", document))
+        generation = str(int(_get_meta(conn, "generation", "0")) + 1)
+        conn.execute(_SET_META, ("generation", generation))
+        return _last_rev(conn), generation, checksum
+
+def _apply(conn, record, cars):
+    """Применение записи журнала (в том числе пачки) к таблице cars"""
+    op = record.get("op")
+    if op == "batch":
+        for sub_record in record["records"]:
+            _apply(conn, sub_record, cars)
+    elif op == "update":
+        conn.execute(_UPDATE_CAR, (_car_doc(cars[record["id"]]), record["id"]))
+    elif op == "add":
+        car = cars[record["car"]["id"]]
+        position = conn.execute(_NEXT_POSITION).fetchone()[0]
+        conn.execute(_DELETE_CAR, (car.get("id"),))
+        conn.execute(_INSERT_CAR, (car.get("id"), position, _car_doc(car)))
+    elif op == "delete":
+        conn.execute(_DELETE_CAR, (record["id"],))
+
+def append(record, cars):
+    """Применение записи журнала к таблице cars одной транзакцией.
+
+    cars - новые версии затронутых автомобилей: {id: запись или None при удалении}.
+    Возвращает (номер изменения, CRC32 записанной записи журнала).
+    """
+    with _transaction(immediate=True) as conn:
+        _apply(conn, record, cars)
+        text = json.dumps(record, ensure_ascii=False)
+        rev = conn.execute(_INSERT_CHANGE, (text,)).lastrowid
+        if rev % 100 == 0:
+            conn.execute(_PRUNE_CHANGES, (rev - SQLITE_CHANGES_KEEP,))
+        return rev, zlib.crc32(text.encode('utf-8'))
+
+def close():
+    """Закрытие соединений"""
+    for role in ("read", "write"):
+        _connections[role].close()
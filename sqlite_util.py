@@ -0,0 +1,70 @@
+"""
+Общее для хранилищ на SQLite (каталог, очередь заявок, состояние бота):
+соединение в режиме WAL и транзакции
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+def connect(path, synchronous="FULL", schema=None):
+    """Соединение с файлом базы в режиме WAL (транзакции открываются явно, см. transaction).
+
+    synchronous="FULL" - каждый коммит переживает сбой питания, "NORMAL" - только
+    падение процесса, зато без fsync на каждый коммит. schema выполняется при открытии.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    if schema:
+        conn.executescript(schema)
+    return conn
+
+@contextmanager
+def transaction(conn, immediate=False):
+    """Транзакция: COMMIT при выходе, ROLLBACK при исключении; immediate сразу берет блокировку записи"""
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+class LazyConnection:
+    """Одно соединение на процесс, открывается при первом обращении.
+
+    Соединение общее для потоков, поэтому обращения к нему сериализуются lock:
+    запросы выполняются под `with conn.lock`, транзакции - через transaction().
+    """
+
+    def __init__(self, path, synchronous="FULL", schema=None):
+        self.path = path
+        self.synchronous = synchronous
+        self.schema = schema
+        self.lock = threading.RLock()
+        self._conn = None
+
+    @property
+    def is_open(self):
+        return self._conn is not None
+
+    def get(self):
+        """Соединение (открывается при первом вызове)"""
+        with self.lock:
+            if self._conn is None:
+                self._conn = connect(self.path, self.synchronous, self.schema)
+            return self._conn
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """Транзакция под блокировкой соединения"""
+        with self.lock, transaction(self.get(), immediate) as conn:
+            yield conn
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
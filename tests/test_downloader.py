@@ -0,0 +1,106 @@
+"""
+Скачивание фото по URL (downloader.py) с локальным HTTP-сервером вместо внешних адресов.
+Запуск: python -m unittest discover tests
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import downloader
+
+class _Handler(BaseHTTPRequestHandler):
+    requests = {}
+
+    def do_GET(self):
+        _Handler.requests[self.path] = _Handler.requests.get(self.path, 0) + 1
+        if self.path.startswith("/slow"):
+            time.sleep(1)
+        body = f"photo {self.path}".encode()
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass  # Клиент не дождался ответа
+
+    def log_message(self, *args):
+        pass
+
+async def _keep(filepath):
+    return filepath
+
+class DownloaderTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.daemon_threads = True
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        # Пути хранилища относительные (data/...), поэтому тест работает в пустом каталоге
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs("data/photos")
+        _Handler.requests.clear()
+        patcher = mock.patch("images.optimize_image_async", _keep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def asyncTearDown(self):
+        await downloader.close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    async def test_inflight_url_downloaded_once(self):
+        url = f"{self.base}/car.jpg"
+        first = downloader.download_image_from_url(url, 1, 1)
+        second = downloader.download_image_from_url(url, 1, 1)
+        self.assertIs(first, second)
+        self.assertEqual(await first, "car_1_1.jpg")
+        self.assertEqual(_Handler.requests["/car.jpg"], 1)
+
+    async def test_existing_photo_not_overwritten(self):
+        with open("data/photos/car_5_1.jpg", "w") as f:
+            f.write("admin")
+        filename = await downloader.download_image_from_url(f"{self.base}/new.jpg", 5, 1)
+        self.assertEqual(filename, "car_5_2.jpg")
+        with open("data/photos/car_5_1.jpg") as f:
+            self.assertEqual(f.read(), "admin")
+
+    async def test_wait_timeout_falls_back_while_download_continues(self):
+        # Как в handlers.show_car: обработчик ждет ограниченное время, загрузка продолжается
+        download = downloader.download_image_from_url(f"{self.base}/slow.jpg", 2, 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.shield(download), 0.1)
+        self.assertEqual(await download, "car_2_1.jpg")
+
+    async def test_request_timeout_gives_none(self):
+        with mock.patch("downloader.DOWNLOAD_TIMEOUT", 0.2):
+            result = await downloader.download_image_from_url(f"{self.base}/slow.jpg", 3, 1)
+        self.assertIsNone(result)
+        self.assertEqual(os.listdir("data/photos"), [])
+
+    async def test_cancelled_worker_resolves_future(self):
+        download = downloader.download_image_from_url(f"{self.base}/slow.jpg", 4, 1)
+        await asyncio.sleep(0.1)
+        for task in downloader._state["workers"]:
+            task.cancel()
+        self.assertIsNone(await asyncio.wait_for(download, 1))
+        self.assertNotIn(f"{self.base}/slow.jpg", downloader._inflight)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Поиск марок и моделей, записанных латиницей, по русскому написанию.
+Запуск: python -m unittest discover tests
+"""
+import unittest
+
+import search
+from models import Car
+
+CARS = [
+    Car(id=1, brand="Citroen", model="C4 Grand Picasso"),
+    Car(id=2, brand="Toyota", model="Camry"),
+    Car(id=3, brand="Skoda", model="Octavia"),
+    Car(id=4, brand="Peugeot", model="307"),
+    Car(id=5, brand="Volkswagen", model="Passat"),
+    Car(id=6, brand="Лада", model="Гранта"),
+]
+
+class TransliterationTest(unittest.TestCase):
+    def setUp(self):
+        self.index = search.build(CARS)
+
+    def assertFound(self, query, car_id):
+        self.assertEqual(set(search.match(self.index, query)), {car_id}, query)
+
+    def test_russian_brand(self):
+        self.assertFound("тойота", 2)
+        self.assertFound("ситроен", 1)
+        self.assertFound("шкода", 3)
+
+    def test_russian_model(self):
+        self.assertFound("пикассо", 1)
+        self.assertFound("камри", 2)
+        self.assertFound("октавия", 3)
+
+    def test_alias(self):
+        self.assertFound("пежо", 4)
+        self.assertFound("фольксваген пассат", 5)
+
+    def test_inflected_and_prefix(self):
+        self.assertFound("тойоту", 2)
+        self.assertFound("тойо", 2)
+
+    def test_latin_query_for_russian_name(self):
+        self.assertFound("lada granta", 6)
+
+    def test_latin_query_still_exact(self):
+        self.assertEqual(search.match(self.index, "toyota camry"), {2: 18})
+
+    def test_remove_clears_transliterated_words(self):
+        for car in CARS:
+            search.remove(self.index, car)
+        self.assertEqual(self.index["postings"], {})
+        self.assertEqual(self.index["variants"], {})
+
+if __name__ == "__main__":
+    unittest.main()
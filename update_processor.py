@@ -0,0 +1,82 @@
+"""
+Параллельная обработка обновлений с сохранением порядка внутри чата
+
+Обновления разных чатов обрабатываются одновременно (не больше UPDATE_CONCURRENCY),
+а обновления одного чата - строго по очереди, в порядке поступления. Поэтому
+медленная отправка фото одному клиенту не задерживает остальных, а состояния
+ConversationHandler (заявка, добавление авто, поиск) меняются в правильном порядке.
+"""
+import asyncio
+import logging
+from collections import deque
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+def _chat_key(update):
+    """Ключ очереди обновления: id чата, для обновлений без чата - id пользователя, иначе None"""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+    return None
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений: параллельно между чатами, по порядку внутри чата.
+
+    Для чата, в котором уже идет обработка, обновление ставится в очередь чата и
+    выполняется той же задачей после предыдущих, не занимая отдельный слот.
+    Порядок фиксируется в момент поступления, без ожидания между получением
+    обновления и постановкой в очередь, поэтому не зависит от порядка пробуждения задач.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        # Семафор базового класса не должен задерживать обновления до постановки в очередь
+        # чата, поэтому он делается неограниченным, а число одновременных обработок
+        # ограничивает собственный семафор
+        super().__init__(max_concurrent_updates=2 ** 31 - 1)
+        self.concurrency = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = _chat_key(update)
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            # В чате уже идет обработка: обновление выполнит задача, которая ее ведет
+            queue.append(coroutine)
+            return
+
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            async with self._slots:
+                while queue:
+                    try:
+                        await queue[0]
+                    except Exception as e:
+                        # Ошибки обработчиков разбирает Application; здесь важно не потерять очередь
+                        logger.error(f"Ошибка обработки обновления чата {key}: {e}")
+                    finally:
+                        queue.popleft()
+        finally:
+            del self._queues[key]
+            # Если задачу отменили, оставшиеся корутины закрываются, чтобы не было предупреждений
+            for pending in queue:
+                pending.close()
+
+    def pending_updates(self):
+        """Число обновлений, ожидающих в очередях чатов"""
+        return sum(len(queue) - 1 for queue in self._queues.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -2,11 +2,10 @@
 Вспомогательные функции для телеграм бота
 """
 import os
-import requests
 import logging
 from telegram import Update
 from telegram.ext import ContextTypes
-from config import ADMIN_IDS
+from config import ADMIN_IDS, RANGE_FILTERS
 
 logger = logging.getLogger(__name__)
 
@@ -16,37 +15,24 @@ def ensure_photos_dir():
     if not os.path.exists(PHOTOS_DIR):
         os.makedirs(PHOTOS_DIR)
 
-def download_image_from_url(url, car_id, photo_index):
-    """Скачивает изображение по URL и сохраняет локально"""
-    from config import PHOTOS_DIR
-    try:
-        ensure_photos_dir()
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-
-        # Определяем расширение файла
-        content_type = response.headers.get('content-type', '')
-        if 'jpeg' in content_type or 'jpg' in content_type:
-            ext = '.jpg'
-        elif 'png' in content_type:
-            ext = '.png'
-        elif 'webp' in content_type:
-            ext = '.webp'
-        else:
-            ext = '.jpg'  # По умолчанию
+def reserve_photo_path(car_id, number, taken=(), extension=".jpg"):
+    """Свободный путь для нового фото автомобиля (имя не из taken и не занятое на диске).
 
-        filename = f"car_{car_id}_{photo_index}{ext}"
+    Файл создается сразу (O_EXCL), чтобы параллельно добавляемое или скачиваемое
+    фото не получило то же имя и не перезаписало существующее.
+    """
+    from config import PHOTOS_DIR
+    while True:
+        filename = f"car_{car_id}_{number}{extension}"
         filepath = os.path.join(PHOTOS_DIR, filename)
-
-        # Сохраняем файл
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
-
-        logger.info(f"Изображение скачано: {url} -> {filepath}")
-        return filename
-    except Exception as e:
-        logger.error(f"Ошибка скачивания изображения {url}: {e}")
-        return None
+        if filename in taken:
+            number += 1
+            continue
+        try:
+            os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filepath
+        except FileExistsError:
+            number += 1
 
 async def safe_edit_message_text(query, text, reply_markup=None, parse_mode=None):
     """Безопасное редактирование сообщения с обработкой медиа"""
@@ -84,11 +70,24 @@ def is_admin(user_id, username=None):
                 continue
     return False
 
-def get_next_car_id():
-    """Получение следующего ID для автомобиля"""
-    import database
-    data = database.load_data()
-    cars = data.get("cars", [])
-    if not cars:
-        return 1
-    return max(car.get("id", 0) for car in cars) + 1
+def format_range(field, lower, upper):
+    """Подпись числового диапазона, например: до 5000 $, 2015 – 2018, от 2.5 л"""
+    unit = RANGE_FILTERS[field][1]
+
+    def number(value):
+        if isinstance(value, float):
+            # С настоящей точностью границы: 1.25 -> "1.25", 2.0 -> "2.0"
+            return str(round(value, 3))
+        return f"{value:,}".replace(',', ' ') if value >= 10000 else str(value)
+
+    if lower is None and upper is None:
+        text = "любой"
+    elif lower is None:
+        text = f"до {number(upper)} {unit}"
+    elif upper is None:
+        text = f"от {number(lower)} {unit}"
+    elif lower == upper:
+        text = f"{number(lower)} {unit}"
+    else:
+        text = f"{number(lower)} – {number(upper)} {unit}"
+    return text.strip()